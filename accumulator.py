@@ -0,0 +1,146 @@
+"""
+/* Copyright (C) William Lyles - All Rights Reserved
+ * Unauthorized copying of this file, via any medium is strictly prohibited
+ * Proprietary and confidential
+ * Written by William Lyles <willglyles@gmail.com>, January 4th, 2022
+ */
+ """
+import math
+from typing import Dict
+import numpy as np
+
+DEFAULT_RELATIVE_ACCURACY = .01  # Quantiles are within 1% of the true value
+MIN_SKETCH_MAGNITUDE = 1e-9  # Values closer to 0 than this are counted as 0
+
+
+class RunningStats():
+    '''Count, mean, min and max of a stream of values, without keeping the values. Whatever info is passed along with
+    the smallest and largest values is kept too (the first one wins ties). Partial RunningStats can be merged.'''
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+        self.min_info = None
+        self.max_info = None
+
+    def add(self, value: float, info=None):
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+            self.min_info = info
+        if self.max is None or value > self.max:
+            self.max = value
+            self.max_info = info
+
+    def add_values(self, values, get_info=None):
+        '''Adds every value of an array at once. get_info(index) is only called for the new smallest and largest values.'''
+        values = np.asarray(values, dtype=np.float64)
+        if len(values) == 0:
+            return
+        self.count += len(values)
+        # Summed in order (np.sum sums pairwise), so the total is the same as adding the values one by one
+        self.total = float(np.cumsum(np.concatenate(([self.total], values)))[-1])
+        min_index = int(values.argmin())
+        if self.min is None or values[min_index] < self.min:
+            self.min = float(values[min_index])
+            self.min_info = None if get_info is None else get_info(min_index)
+        max_index = int(values.argmax())
+        if self.max is None or values[max_index] > self.max:
+            self.max = float(values[max_index])
+            self.max_info = None if get_info is None else get_info(max_index)
+
+    def merge(self, other: "RunningStats"):
+        '''Folds other into self, as if other's values had been added after self's'''
+        if other.count == 0:
+            return
+        self.count += other.count
+        self.total += other.total
+        if self.min is None or other.min < self.min:
+            self.min = other.min
+            self.min_info = other.min_info
+        if self.max is None or other.max > self.max:
+            self.max = other.max
+            self.max_info = other.max_info
+
+    def mean(self) -> float:
+        return self.total / self.count
+
+
+class QuantileSketch():
+    '''Mergeable quantile sketch (DDSketch). Values are counted in logarithmically sized buckets, so every quantile is
+    known to within relative_accuracy of the true value, and memory only grows with the log of the range of the values,
+    never with how many were added. Sketches with the same relative_accuracy can be merged.'''
+    def __init__(self, relative_accuracy: float=DEFAULT_RELATIVE_ACCURACY):
+        self.relative_accuracy = relative_accuracy
+        self._gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma = math.log(self._gamma)
+        self.positive_counts: Dict[int, int] = {}
+        self.negative_counts: Dict[int, int] = {}
+        self.zero_count = 0
+        self.count = 0
+
+    def _get_bucket(self, magnitude: float) -> int:
+        return math.ceil(math.log(magnitude) / self._log_gamma)
+
+    def _get_bucket_value(self, bucket: int) -> float:
+        # Value every member of the bucket is within relative_accuracy of
+        return 2 * (self._gamma ** bucket) / (self._gamma + 1)
+
+    def add(self, value: float):
+        self.count += 1
+        if abs(value) < MIN_SKETCH_MAGNITUDE:
+            self.zero_count += 1
+            return
+        bucket_counts = self.positive_counts if value > 0 else self.negative_counts
+        bucket = self._get_bucket(abs(value))
+        bucket_counts[bucket] = bucket_counts.get(bucket, 0) + 1
+
+    def add_values(self, values):
+        '''Adds every value of an array at once'''
+        values = np.asarray(values, dtype=np.float64).ravel()
+        magnitudes = np.abs(values)
+        is_zero = magnitudes < MIN_SKETCH_MAGNITUDE
+        self.count += len(values)
+        self.zero_count += int(is_zero.sum())
+        for bucket_counts, is_sign in ((self.positive_counts, values > 0), (self.negative_counts, values < 0)):
+            selected = is_sign & ~is_zero
+            if not selected.any():
+                continue
+            buckets, counts = np.unique(np.ceil(np.log(magnitudes[selected]) / self._log_gamma).astype(np.int64), return_counts=True)
+            for bucket, count in zip(buckets.tolist(), counts.tolist()):
+                bucket_counts[bucket] = bucket_counts.get(bucket, 0) + count
+
+    def merge(self, other: "QuantileSketch"):
+        if other.relative_accuracy != self.relative_accuracy:
+            raise ValueError(f"Cannot merge a sketch with relative accuracy {other.relative_accuracy} into one with relative accuracy {self.relative_accuracy}")
+        self.count += other.count
+        self.zero_count += other.zero_count
+        for bucket_counts, other_bucket_counts in ((self.positive_counts, other.positive_counts), (self.negative_counts, other.negative_counts)):
+            for bucket, count in other_bucket_counts.items():
+                bucket_counts[bucket] = bucket_counts.get(bucket, 0) + count
+
+    def _iterate_ascending(self):
+        # (value, count) of every non-empty bucket, from the most negative value to the largest
+        for bucket in sorted(self.negative_counts, reverse=True):
+            yield -self._get_bucket_value(bucket), self.negative_counts[bucket]
+        if self.zero_count > 0:
+            yield 0.0, self.zero_count
+        for bucket in sorted(self.positive_counts):
+            yield self._get_bucket_value(bucket), self.positive_counts[bucket]
+
+    def get_quantile(self, quantile: float) -> float:
+        '''Value below which roughly the given fraction (0.0 to 1.0) of the values fall'''
+        if self.count == 0:
+            raise ValueError("Cannot get a quantile of an empty sketch")
+        rank = quantile * (self.count - 1)
+        seen = 0
+        for value, count in self._iterate_ascending():
+            seen += count
+            if seen > rank:
+                return value
+        return value
+
+    def get_median(self) -> float:
+        return self.get_quantile(.5)
@@ -6,14 +6,107 @@
  */
  """
 
+import csv
+from datetime import date
+from itertools import zip_longest
+import re
 from typing import List
 from dateutil.parser import parse
+import numpy as np
 
 
 def fix_dollars(amount:str) -> float:
     fixed_amount = amount.replace("$", "").replace(" ", "").replace(",", "")
     return round(float(fixed_amount), 2)
 
+
+def get_years(dates: np.ndarray) -> np.ndarray:
+    return dates.astype("datetime64[Y]").astype(np.int64) + 1970
+
+
+# Date formats that can be parsed a whole column at a time. Anything else goes through dateutil one row at a time.
+ISO_DATE_FORMAT = re.compile(r"\d{4}-\d{2}-\d{2}")  # 2022-01-24
+US_DATE_FORMAT = re.compile(r"(\d{1,2})/(\d{1,2})/(\d{4})")  # 1/24/2022
+
+def detect_date_format(date_string: str):
+    for date_format in (ISO_DATE_FORMAT, US_DATE_FORMAT):
+        if date_format.fullmatch(date_string.strip()):
+            return date_format
+    return None
+
+def parse_date_column(date_strings: List[str]) -> np.ndarray:
+    '''Parses a column of dates to datetime64[D]. The format is detected once from the first row and every
+    matching row is converted in bulk; only rows that do not match fall back to dateutil.'''
+    dates = np.empty(len(date_strings), dtype="datetime64[D]")
+    if len(date_strings) == 0:
+        return dates
+    date_format = detect_date_format(date_strings[0])
+    matches = [date_format.fullmatch(date_string.strip()) for date_string in date_strings] if date_format is not None else [None] * len(date_strings)
+    matched = np.array([match is not None for match in matches], dtype=bool)
+
+    if date_format is ISO_DATE_FORMAT and matched.any():
+        dates[matched] = np.array([match.group(0) for match in matches if match is not None], dtype="datetime64[D]")
+    elif date_format is US_DATE_FORMAT and matched.any():
+        month_day_years = np.array([match.groups() for match in matches if match is not None], dtype=np.int64).reshape(-1, 3)
+        months = (month_day_years[:, 2] - 1970) * 12 + (month_day_years[:, 0] - 1)
+        bulk_dates = months.astype("datetime64[M]").astype("datetime64[D]") + (month_day_years[:, 1] - 1)
+        # Impossible days (eg 2/30) would roll over into the next month here, so leave them to dateutil to reject
+        valid = (month_day_years[:, 0] >= 1) & (month_day_years[:, 0] <= 12) & (bulk_dates.astype("datetime64[M]") == months.astype("datetime64[M]"))
+        matched_indexes = np.flatnonzero(matched)
+        dates[matched_indexes[valid]] = bulk_dates[valid]
+        matched[matched_indexes[~valid]] = False
+
+    for index in np.flatnonzero(~matched).tolist():
+        dates[index] = parse(date_strings[index]).date()
+    return dates
+
+def parse_price_column(price_strings: List[str]) -> np.ndarray:
+    '''Parses a column of prices, rounded to the cent. Plain numbers are converted in bulk; anything else
+    (eg "$1,234.50") goes through fix_dollars one row at a time.'''
+    try:
+        prices = np.array(price_strings, dtype=np.float64)
+    except ValueError:
+        prices = np.empty(len(price_strings))
+        for index, price_string in enumerate(price_strings):
+            try:
+                prices[index] = float(price_string)
+            except ValueError:
+                prices[index] = fix_dollars(price_string)
+    # Bulk rounding can disagree with round() on the rare values that are not already whole cents, so those use round()
+    rounded_prices = np.round(prices, 2)
+    for index in np.flatnonzero(rounded_prices != prices).tolist():
+        rounded_prices[index] = round(float(prices[index]), 2)
+    return rounded_prices
+
+def parse_volume_column(volume_strings: List[str]) -> np.ndarray:
+    '''Parses a column of whole volumes. Missing volumes become NaN.'''
+    volume = np.full(len(volume_strings), np.nan)
+    present = np.array([volume_string != "" for volume_string in volume_strings], dtype=bool)
+    if present.any():
+        volume[present] = np.array([volume_string for volume_string in volume_strings if volume_string != ""]).astype(np.int64)
+    return volume
+
+def read_csv_rows(reader, should_break=None) -> List[List[str]]:
+    '''Every row of a csv reader, up to the first row should_break rejects'''
+    rows = []
+    for r in reader:
+        if should_break is not None and should_break(r):
+            break
+        rows.append(r)
+    return rows
+
+def get_columns_of_rows(rows: List[List[str]]) -> List[List[str]]:
+    '''Rows turned into columns. Short rows are padded with empty strings.'''
+    return [list(column) for column in zip_longest(*rows, fillvalue="")]
+
+def read_csv_columns(file_name: str, should_break=None) -> List[List[str]]:
+    '''Reads every row after the header (up to the first row should_break rejects) and returns it as columns.
+    Short rows are padded with empty strings.'''
+    with open(file_name) as csvfile:
+        reader = csv.reader(csvfile, delimiter=',')
+        header = next(reader)
+        return get_columns_of_rows(read_csv_rows(reader, should_break))
+
 class DailyAssetData(object):
 
     def __init__(self, data:List[str], previous_day=None):
@@ -44,3 +137,130 @@ class DailyAssetData(object):
 
     def __repr__(self):
         return str(self)
+
+
+class DateIndex(object):
+    '''Binary search lookups of trading days by date. dates must be sorted ascending.
+    Each lookup has a scalar form taking a date and an array form taking an array of datetime64 dates.'''
+
+    def __init__(self, dates: np.ndarray):
+        self.dates = np.asarray(dates, dtype="datetime64[D]")
+
+    def floor_indices(self, target_dates) -> np.ndarray:
+        '''Index of the last trading day on or before each target date, -1 where there is none'''
+        return np.searchsorted(self.dates, np.asarray(target_dates, dtype="datetime64[D]"), side="right") - 1
+
+    def ceiling_indices(self, target_dates) -> np.ndarray:
+        '''Index of the first trading day on or after each target date, len(dates) where there is none'''
+        return np.searchsorted(self.dates, np.asarray(target_dates, dtype="datetime64[D]"), side="left")
+
+    def nearest_indices(self, target_dates) -> np.ndarray:
+        '''Index of the trading day closest to each target date. Ties go to the later trading day.'''
+        target_dates = np.asarray(target_dates, dtype="datetime64[D]")
+        after_indices = np.minimum(self.ceiling_indices(target_dates), len(self.dates) - 1)
+        # When a date appears more than once, the last of them is the later trading day
+        after_indices = np.searchsorted(self.dates, self.dates[after_indices], side="right") - 1
+        before_indices = np.maximum(self.ceiling_indices(target_dates) - 1, 0)
+        after_deltas = np.abs(self.dates[after_indices] - target_dates)
+        before_deltas = np.abs(target_dates - self.dates[before_indices])
+        return np.where(after_deltas <= before_deltas, after_indices, before_indices)
+
+    def floor(self, target_date: date) -> int:
+        return int(self.floor_indices(np.datetime64(target_date, "D")))
+
+    def ceiling(self, target_date: date) -> int:
+        return int(self.ceiling_indices(np.datetime64(target_date, "D")))
+
+    def nearest(self, target_date: date) -> int:
+        return int(self.nearest_indices(np.datetime64(target_date, "D")))
+
+
+class PriceSeries(object):
+    '''Columnar daily price data for a single security.
+
+    Every column is a contiguous NumPy array indexed by trading day, so a day's data is
+    read as series.close[index] rather than through one DailyAssetData object per row.
+    dollar_change and ratio_change are derived from close exactly as DailyAssetData does.'''
+
+    COLUMNS = ("dates", "open", "high", "low", "close", "volume", "dollar_change", "ratio_change")
+
+    def __init__(self, dates, open_prices, high_prices, low_prices, close_prices, volume=None):
+        self.dates = np.asarray(dates, dtype="datetime64[D]")
+        self.open = np.asarray(open_prices, dtype=np.float64)
+        self.high = np.asarray(high_prices, dtype=np.float64)
+        self.low = np.asarray(low_prices, dtype=np.float64)
+        self.close = np.asarray(close_prices, dtype=np.float64)
+        # Missing volumes (rows with only 5 columns) are stored as NaN
+        self.volume = np.full(len(self.dates), np.nan) if volume is None else np.asarray(volume, dtype=np.float64)
+        self.dollar_change = np.zeros(len(self.close))
+        self.ratio_change = np.zeros(len(self.close))
+        if len(self.close) > 1:
+            self.dollar_change[1:] = np.round(np.diff(self.close), 2)
+            self.ratio_change[1:] = self.dollar_change[1:] / self.close[:-1]
+
+    @classmethod
+    def from_columns(cls, columns) -> "PriceSeries":
+        '''Wraps already computed columns (see COLUMNS) without copying them, eg arrays living in shared memory'''
+        series = cls.__new__(cls)
+        for column_name in cls.COLUMNS:
+            setattr(series, column_name, columns[column_name])
+        return series
+
+    def get_columns(self):
+        return {column_name: getattr(self, column_name) for column_name in self.COLUMNS}
+
+    @classmethod
+    def from_csv(cls, file_name: str, should_break=None) -> "PriceSeries":
+        return cls.from_csv_columns(read_csv_columns(file_name, should_break))
+
+    @classmethod
+    def from_csv_columns(cls, columns: List[List[str]]) -> "PriceSeries":
+        if len(columns) == 0:
+            return cls([], [], [], [], [])
+        volume = parse_volume_column(columns[5]) if len(columns) >= 6 else None
+        return cls(parse_date_column(columns[0]), parse_price_column(columns[1]), parse_price_column(columns[2]),
+                   parse_price_column(columns[3]), parse_price_column(columns[4]), volume)
+
+    def append(self, other: "PriceSeries") -> "PriceSeries":
+        '''New series with the days of other (which must all come after the last day of self) added at the end.
+        Only the changes of the first added day are computed again, so the result is the same as parsing every row at once.'''
+        if len(self) > 0 and len(other) > 0 and other.dates[0] <= self.dates[-1]:
+            raise ValueError(f"Cannot append days starting {other.get_date(0)} to a series ending {self.get_date(-1)}")
+        columns = {column_name: np.concatenate((getattr(self, column_name), getattr(other, column_name))) for column_name in self.COLUMNS}
+        if len(self) > 0 and len(other) > 0:
+            columns["dollar_change"][len(self)] = np.round(other.close[0] - self.close[-1], 2)
+            columns["ratio_change"][len(self)] = columns["dollar_change"][len(self)] / self.close[-1]
+        return PriceSeries.from_columns(columns)
+
+    def __len__(self):
+        return len(self.dates)
+
+    def get_date(self, index: int) -> date:
+        return self.dates[index].item()
+
+    def get_date_index(self) -> DateIndex:
+        if getattr(self, "_date_index", None) is None:
+            self._date_index = DateIndex(self.dates)
+        return self._date_index
+
+    def get_previous_day_close(self, index: int) -> float:
+        return round(self.close[index] - self.dollar_change[index], 2)
+
+    def get_daily_asset_data(self, index: int) -> DailyAssetData:
+        '''Builds the row-oriented view of a single day, mainly for printing'''
+        volume = self.volume[index]
+        row = [str(self.get_date(index)), str(self.open[index]), str(self.high[index]), str(self.low[index]), str(self.close[index])]
+        if not np.isnan(volume):
+            row.append(str(int(volume)))
+        daily_data = DailyAssetData(row)
+        daily_data.dollar_change = float(self.dollar_change[index])
+        daily_data.ratio_change = float(self.ratio_change[index])
+        return daily_data
+
+    def __str__(self):
+        if len(self) == 0:
+            return "Empty price series"
+        return f"{len(self)} trading days from {self.get_date(0)} to {self.get_date(-1)}"
+
+    def __repr__(self):
+        return str(self)
@@ -0,0 +1,122 @@
+"""
+/* Copyright (C) William Lyles - All Rights Reserved
+ * Unauthorized copying of this file, via any medium is strictly prohibited
+ * Proprietary and confidential
+ * Written by William Lyles <willglyles@gmail.com>, January 4th, 2022
+ */
+ """
+from typing import List, Tuple
+import numpy as np
+
+from asset_data import PriceSeries
+from common import BOOTSTRAP_MEAN_BLOCK_LENGTH, KnownIndexMetaData
+import engine
+
+DEFAULT_VOLATILITY_WINDOW = 21  # Trading days of trailing volatility used to tell regimes apart
+DEFAULT_NUM_REGIMES = 2  # Calm and volatile
+SYNTHETIC_START_PRICE = 100.0
+
+
+def stationary_block_bootstrap(ratio_changes: np.ndarray, num_paths: int, path_length: int, rng: np.random.Generator,
+                               mean_block_length: float=BOOTSTRAP_MEAN_BLOCK_LENGTH) -> np.ndarray:
+    '''(num_paths x path_length) daily ratio changes resampled from ratio_changes with the stationary bootstrap of
+    Politis and Romano: blocks of consecutive days (wrapping around the end) with geometrically distributed lengths
+    of mean mean_block_length, each starting on a random day. Every path is built at once, without a loop.'''
+    new_blocks = rng.random((num_paths, path_length)) < 1 / mean_block_length
+    new_blocks[:, 0] = True
+    block_starts = rng.integers(0, len(ratio_changes), size=(num_paths, path_length))
+    days = np.arange(path_length)
+    # Day of the path on which the block holding each day started
+    block_start_days = np.maximum.accumulate(np.where(new_blocks, days, 0), axis=1)
+    indices = (np.take_along_axis(block_starts, block_start_days, axis=1) + (days - block_start_days)) % len(ratio_changes)
+    return ratio_changes[indices]
+
+
+def get_regimes(ratio_changes: np.ndarray, volatility_window: int=DEFAULT_VOLATILITY_WINDOW, num_regimes: int=DEFAULT_NUM_REGIMES) -> np.ndarray:
+    '''Regime (0 = calmest to num_regimes - 1 = most volatile) of every day, from the quantile its trailing
+    volatility falls in. The first days use the volatility of the days available so far.'''
+    prefix_sums = np.concatenate(([0.0], np.cumsum(ratio_changes)))
+    prefix_squares = np.concatenate(([0.0], np.cumsum(ratio_changes ** 2)))
+    ends = np.arange(1, len(ratio_changes) + 1)
+    starts = np.maximum(ends - volatility_window, 0)
+    counts = ends - starts
+    means = (prefix_sums[ends] - prefix_sums[starts]) / counts
+    volatilities = np.sqrt(np.maximum((prefix_squares[ends] - prefix_squares[starts]) / counts - means ** 2, 0.0))
+    return np.searchsorted(np.quantile(volatilities, np.arange(1, num_regimes) / num_regimes), volatilities, side="right")
+
+def get_transition_matrix(regimes: np.ndarray, num_regimes: int=DEFAULT_NUM_REGIMES) -> np.ndarray:
+    '''(from regime x to regime) probabilities of the regime of one day given the previous day's, as observed'''
+    transition_counts = np.zeros((num_regimes, num_regimes))
+    np.add.at(transition_counts, (regimes[:-1], regimes[1:]), 1)
+    # A regime never left (or never seen) stays put
+    transition_counts[transition_counts.sum(axis=1) == 0] = np.eye(num_regimes)[transition_counts.sum(axis=1) == 0]
+    return transition_counts / transition_counts.sum(axis=1, keepdims=True)
+
+
+def regime_switching_bootstrap(ratio_changes: np.ndarray, num_paths: int, path_length: int, rng: np.random.Generator,
+                               mean_block_length: float=BOOTSTRAP_MEAN_BLOCK_LENGTH, volatility_window: int=DEFAULT_VOLATILITY_WINDOW,
+                               num_regimes: int=DEFAULT_NUM_REGIMES) -> np.ndarray:
+    '''Like stationary_block_bootstrap, but every path first walks through volatility regimes with the transition
+    probabilities seen in history (see get_regimes), and blocks are only drawn from days of the path's current regime.
+    A new block starts whenever the regime changes. Paths are built together, one day at a time.'''
+    historical_regimes = get_regimes(ratio_changes, volatility_window, num_regimes)
+    cumulative_transitions = np.cumsum(get_transition_matrix(historical_regimes, num_regimes), axis=1)
+    regime_days = [np.flatnonzero(historical_regimes == regime) for regime in range(num_regimes)]
+    regime_days = [days if len(days) > 0 else np.arange(len(ratio_changes)) for days in regime_days]
+    stationary_regimes = historical_regimes[rng.integers(0, len(ratio_changes), size=num_paths)]
+
+    def draw_days(regimes: np.ndarray) -> np.ndarray:
+        drawn_days = np.empty(len(regimes), dtype=np.int64)
+        for regime, days in enumerate(regime_days):
+            in_regime = regimes == regime
+            drawn_days[in_regime] = days[rng.integers(0, len(days), size=int(in_regime.sum()))]
+        return drawn_days
+
+    indices = np.empty((num_paths, path_length), dtype=np.int64)
+    regimes = stationary_regimes
+    indices[:, 0] = draw_days(regimes)
+    for day in range(1, path_length):
+        next_regimes = (rng.random(num_paths)[:, np.newaxis] > cumulative_transitions[regimes]).sum(axis=1)
+        next_regimes = np.minimum(next_regimes, num_regimes - 1)
+        continued_days = (indices[:, day-1] + 1) % len(ratio_changes)
+        new_blocks = (next_regimes != regimes) | (rng.random(num_paths) < 1 / mean_block_length)
+        indices[:, day] = np.where(new_blocks, draw_days(next_regimes), continued_days)
+        regimes = next_regimes
+    return ratio_changes[indices]
+
+
+def get_path_series(return_paths: np.ndarray, path_dates: np.ndarray) -> PriceSeries:
+    '''One PriceSeries holding every path back to back, so the engine can simulate path i as the window
+    (i*path_length, (i+1)*path_length - 1). path_dates gives every day of every path a date, for CAGRs and yearly charges.'''
+    closes = SYNTHETIC_START_PRICE * np.cumprod(1 + return_paths, axis=1)
+    previous_closes = np.concatenate((np.full((len(closes), 1), SYNTHETIC_START_PRICE), closes[:, :-1]), axis=1)
+    closes = closes.ravel()
+    return PriceSeries.from_columns({"dates": np.asarray(path_dates, dtype="datetime64[D]").ravel(),
+                                     "open": closes, "high": closes, "low": closes, "close": closes,
+                                     "volume": np.full(len(closes), np.nan),
+                                     "dollar_change": np.round(closes - previous_closes.ravel(), 2),
+                                     "ratio_change": np.ascontiguousarray(return_paths, dtype=np.float64).ravel()})
+
+def get_path_windows(num_paths: int, path_length: int) -> Tuple[np.ndarray, np.ndarray]:
+    start_indices = np.arange(num_paths, dtype=np.int64) * path_length
+    return start_indices, start_indices + path_length - 1
+
+
+def iterate_bootstrap_results(series: PriceSeries, num_paths: int, path_length: int, leverage_variants: List[engine.LeverageVariant], rng: np.random.Generator,
+                              mean_block_length: float=BOOTSTRAP_MEAN_BLOCK_LENGTH, regime_switching: bool=False, start_investment: float=None,
+                              round_to_cents: bool=None, chunk_size: int=engine.DEFAULT_CHUNK_SIZE // 64, index_data: KnownIndexMetaData=None):
+    '''Yields a BatchResults for every chunk of at most chunk_size synthetic paths of path_length trading days,
+    resampled from series. Each path is dated like a random stretch of path_length days of history, so its
+    CAGR and yearly charges/dividends are those of a real holding period.'''
+    if path_length > len(series):
+        raise ValueError(f"Paths of {path_length} days are longer than the {len(series)} days of history")
+    bootstrap = regime_switching_bootstrap if regime_switching else stationary_block_bootstrap
+    # The first day has no previous close, so its ratio change is always 0.0 and not a return that can be drawn
+    historical_ratio_changes = series.ratio_change[1:]
+    for chunk_start in range(0, num_paths, chunk_size):
+        chunk_num_paths = min(chunk_size, num_paths - chunk_start)
+        return_paths = bootstrap(historical_ratio_changes, chunk_num_paths, path_length, rng, mean_block_length)
+        date_starts = rng.integers(0, len(series) - path_length, size=chunk_num_paths, endpoint=True)
+        path_series = get_path_series(return_paths, series.dates[date_starts[:, np.newaxis] + np.arange(path_length)])
+        start_indices, end_indices = get_path_windows(chunk_num_paths, path_length)
+        yield engine.evaluate_windows(path_series, start_indices, end_indices, leverage_variants, start_investment, round_to_cents, index_data=index_data)
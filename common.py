@@ -5,17 +5,28 @@
  * Written by William Lyles <willglyles@gmail.com>, January 4th, 2022
  */
  """
-import csv
-from dateutil.parser import parse
+import threading
 from typing import Union
+from price_cache import load_dividend_ratios
 
 file_names = ["dji_d.csv", "spx_d.csv", "ndx_d.csv"]
 OUTPUT_FILE_NAME = "results.txt"
+RESULT_STORE_DIRECTORY = None  # Set to a directory to also keep every simulated window's results there, one store per file (see result_store.py). Not written by parallel or incremental runs
 
 DAYS_PER_YEAR = 365.2422
 STARTING_INVESTMENT_AMOUNT = 10000
 
 NUMBER_OF_INVESTMENTS = 1
+PORTFOLIOS = None  # Set to lists of (file name, leverage, weight) sleeves, eg [[("spx_d.csv", 2.0, 0.6), ("ndx_d.csv", 1.0, 0.4)]], to also simulate them on the files' common trading days (see portfolio.py)
+SIMULATE_ALL_WINDOWS = False  # Simulate every possible investment window once instead of NUMBER_OF_INVESTMENTS random ones
+USE_WINDOW_CACHE = False  # Reuse the results of windows already simulated with the same data and expense/dividend settings (see window_cache.py)
+WINDOW_CACHE_DIRECTORY = None  # Set to a directory to spill the window cache there, and reuse it in later runs
+WINDOW_CACHE_MAX_CELLS = 2**24  # (window, leverage) results the window cache keeps in memory, about 400MB
+INCREMENTAL_STATS = False  # With SIMULATE_ALL_WINDOWS, save the stats next to each CSV (.stats.pkl) and only simulate the windows rows appended since then add
+SIMULATE_BOOTSTRAP_PATHS = False  # Simulate NUMBER_OF_INVESTMENTS synthetic paths resampled from history (see bootstrap.py) instead of historical windows
+BOOTSTRAP_PATH_YEARS = 3
+BOOTSTRAP_MEAN_BLOCK_LENGTH = 21  # Mean number of consecutive historical trading days copied at a time, so volatility clusters survive resampling
+BOOTSTRAP_REGIME_SWITCHING = False  # Only resample days of the same volatility regime, switching regimes as often as history does
 MIN_INVESTMENT_YEARS = 2
 MAX_INVESTMENT_YEARS = 4
 
@@ -28,6 +39,19 @@ EXTRA_STAT_CAGR_THRESHOLD = .01  # This threshold is used for additional display
 PRINT_EXTRA_RETURN_THRESHOLD_STATS = True
 
 PRINT_PROGRESS = True
+COLLECT_METRICS = False  # Time every phase of each run and print its throughput (see instrumentation.py). Costs next to nothing when off
+PROFILE_MODE = None  # Or "cprofile" (time per function) or "tracemalloc" (memory per line) to profile the whole run and print the report. Slows the run down
+
+NUMBER_OF_WORKERS = 1  # More than 1 runs all files in parallel worker processes (see parallel.py)
+RANDOM_SEED = None  # Set to an int to get the same random investments every run, whatever NUMBER_OF_WORKERS is
+
+SERVICE_HOST = "127.0.0.1"  # Where service.py listens for simulation requests
+SERVICE_PORT = 8765
+SERVICE_UNIX_SOCKET = None  # Set to a path to listen on a Unix socket instead of SERVICE_HOST:SERVICE_PORT
+SERVICE_COALESCE_SECONDS = .005  # How long service.py waits for more requests for the same file before simulating them in one batch
+SERVICE_MAX_SAMPLES = 1000000  # Most windows one service request can ask for
+SERVICE_MAX_LEVERAGES = 16  # Most leverage ratios one service request can ask for
+SERVICE_MAX_PREFIX_TABLES = 8  # Most sets of sleeve leverages service.py keeps the prefix tables of for each file, least recently used evicted first
 
 INCLUDE_DIVIDENDS = True
 CHARGE_ETF_EXPENSES = True
@@ -35,6 +59,12 @@ LEVERAGED_ETF_EXPENSE_RATIO = .01  # 1%
 UNLEVERAGED_ETF_EXPENSE_RATIO = .001  # .1%
 
 USE_REALISTIC_SPLIT_LEVERAGE = True
+SPLIT_REBALANCE_FREQUENCY = None  # "daily", "monthly", "quarterly" or "annual" to rebalance split leverage ETFs back to their weights (see rebalance.py). None lets them drift
+SPLIT_REBALANCE_DRIFT_BAND = None  # Or set to eg 0.05 to rebalance whenever their weights drift 5 percentage points from their targets
+
+USE_PARSE_CACHE = True  # Keep parsed CSVs in a binary .cache.npz file next to each CSV. Rebuilt automatically when the CSV changes
+
+ROUND_TO_CENTS_DAILY = False  # Round investment values to the cent after every day like the original day by day simulation did. Exact, but much slower
 
 
 def reversed_enumerate(collection: list):
@@ -48,97 +78,147 @@ def should_break(csv_line):
         return True
 
 
+class SimulationConfig():
+    '''Every module level setting above a simulation reads, as they are when the config is built unless given
+    (by lowercase name, eg SimulationConfig(include_dividends=False)). A config is never changed once built, so
+    simulations with different configs can run at once in one process.'''
+    SETTING_NAMES = ("STARTING_INVESTMENT_AMOUNT", "MIN_INVESTMENT_YEARS", "MAX_INVESTMENT_YEARS", "MINIMUM_START_YEAR", "MAXIMUM_END_YEAR",
+                     "INCLUDE_DIVIDENDS", "CHARGE_ETF_EXPENSES", "LEVERAGED_ETF_EXPENSE_RATIO", "UNLEVERAGED_ETF_EXPENSE_RATIO",
+                     "USE_REALISTIC_SPLIT_LEVERAGE", "SPLIT_REBALANCE_FREQUENCY", "SPLIT_REBALANCE_DRIFT_BAND", "ROUND_TO_CENTS_DAILY")
+
+    def __init__(self, **settings):
+        unknown_settings = set(settings) - {setting_name.lower() for setting_name in self.SETTING_NAMES}
+        if len(unknown_settings) > 0:
+            raise TypeError(f"Unknown settings {sorted(unknown_settings)}, expected some of {[setting_name.lower() for setting_name in self.SETTING_NAMES]}")
+        for setting_name in self.SETTING_NAMES:
+            setattr(self, setting_name.lower(), settings.get(setting_name.lower(), globals()[setting_name]))
+
+    def get_settings(self) -> dict:
+        return {setting_name.lower(): getattr(self, setting_name.lower()) for setting_name in self.SETTING_NAMES}
+
+    def replace(self, **settings) -> "SimulationConfig":
+        '''A copy of this config with some settings changed'''
+        return SimulationConfig(**{**self.get_settings(), **settings})
+
+    def __eq__(self, other):
+        return isinstance(other, SimulationConfig) and self.get_settings() == other.get_settings()
+
+    def __hash__(self):
+        return hash(tuple(self.get_settings().items()))
+
+    def __repr__(self):
+        return f"SimulationConfig({', '.join(f'{name}={value!r}' for name, value in self.get_settings().items())})"
+
+
 class KnownIndexMetaData():
+    '''Expenses and dividends of the real ETFs tracking the index of file_name, charged and paid as config says.
+    Without a config, the module level settings are read whenever they are needed. The dividend data of every known
+    index is loaded once per process and shared, read only, by every instance.'''
     KNOWN_FILE_NAMES = {"dji_d.csv": "^DJI",
                         "spx_d.csv": "^INX",
                         "ndx_d.csv": "^IXIC"}
+    KNOWN_LEVERAGES = (1.0, 2.0, 3.0)  # Leverage ratios with real ETF expense and dividend data
+    _shared_known_index_data = None
+    _load_lock = threading.Lock()
 
-    def __init__(self):
-        self._file_name = None
+    def __init__(self, file_name: str=None, config: SimulationConfig=None):
+        self._file_name = file_name
+        self.config = config
         self._load_data()
 
     def _load_data(self):
-        self._known_index_data = {"^DJI": {"file_name": "dji_d.csv",
-                                           "dividend_data_file": "./dividends/dji_d_dividends.csv",
-                                           "yearly_dividend_ratios": {},
-                                           "leverage_data": {1.0: {"symbol": "DIA",
-                                                                 "annual_expense_ratio": .0016,
-                                                                 "dividend_multiplier": 1.0
-                                                                 },
-                                                             2.0: {"symbol": "DDM",
-                                                                 "annual_expense_ratio": .0095,
-                                                                 "dividend_multiplier": .12
-                                                                 },
-                                                             3.0: {"symbol": "UDOW",
-                                                                 "annual_expense_ratio": .0095,
-                                                                 "dividend_multiplier": .18
-                                                                 }
-                                                             }
-                                           },
-                                  "^INX": {"file_name": "spx_d.csv",
-                                           "dividend_data_file": "./dividends/spx_d_dividends.csv",
-                                           "yearly_dividend_ratios": {},
-                                           "leverage_data": {1.0: {"symbol": "SWPPX",
-                                                                 "annual_expense_ratio": .0002,
-                                                                 "dividend_multiplier": 1.0
-                                                                 },
-                                                             2.0: {"symbol": "SPUU",
-                                                                 "annual_expense_ratio": .0064,
-                                                                 "dividend_multiplier": .15
-                                                                 },
-                                                             3.0: {"symbol": "UPRO",
-                                                                 "annual_expense_ratio": .0091,
-                                                                 "dividend_multiplier": .06
-                                                                 }
-                                                             }
-                                           },
-                                  "^IXIC": {"file_name": "ndx_d.csv",
-                                            "dividend_data_file": .0055,
-                                            "yearly_dividend_ratios": .0055,
-                                            "leverage_data": {1.0: {"symbol": "VUG",
-                                                                  "annual_expense_ratio": .0004,
-                                                                  "dividend_multiplier": 1.0
-                                                                  },
-                                                              2.0: {"symbol": "QLD",
-                                                                  "annual_expense_ratio": .0095,
-                                                                  "dividend_multiplier": 0
-                                                                  },
-                                                              3.0: {"symbol": "TQQQ",
-                                                                  "annual_expense_ratio": .0095,
-                                                                  "dividend_multiplier": 0
-                                                                  }
-                                                              }
-                                            }
-                                  }
-        for symbol_dividend_data in self._known_index_data.values():
+        with KnownIndexMetaData._load_lock:
+            if KnownIndexMetaData._shared_known_index_data is None:
+                KnownIndexMetaData._shared_known_index_data = self._read_known_index_data()
+        self._known_index_data = KnownIndexMetaData._shared_known_index_data
+
+    @staticmethod
+    def _read_known_index_data() -> dict:
+        known_index_data = {"^DJI": {"file_name": "dji_d.csv",
+                                     "dividend_data_file": "./dividends/dji_d_dividends.csv",
+                                     "yearly_dividend_ratios": {},
+                                     "leverage_data": {1.0: {"symbol": "DIA",
+                                                           "annual_expense_ratio": .0016,
+                                                           "dividend_multiplier": 1.0
+                                                           },
+                                                       2.0: {"symbol": "DDM",
+                                                           "annual_expense_ratio": .0095,
+                                                           "dividend_multiplier": .12
+                                                           },
+                                                       3.0: {"symbol": "UDOW",
+                                                           "annual_expense_ratio": .0095,
+                                                           "dividend_multiplier": .18
+                                                           }
+                                                       }
+                                     },
+                            "^INX": {"file_name": "spx_d.csv",
+                                     "dividend_data_file": "./dividends/spx_d_dividends.csv",
+                                     "yearly_dividend_ratios": {},
+                                     "leverage_data": {1.0: {"symbol": "SWPPX",
+                                                           "annual_expense_ratio": .0002,
+                                                           "dividend_multiplier": 1.0
+                                                           },
+                                                       2.0: {"symbol": "SPUU",
+                                                           "annual_expense_ratio": .0064,
+                                                           "dividend_multiplier": .15
+                                                           },
+                                                       3.0: {"symbol": "UPRO",
+                                                           "annual_expense_ratio": .0091,
+                                                           "dividend_multiplier": .06
+                                                           }
+                                                       }
+                                     },
+                            "^IXIC": {"file_name": "ndx_d.csv",
+                                      "dividend_data_file": .0055,
+                                      "yearly_dividend_ratios": .0055,
+                                      "leverage_data": {1.0: {"symbol": "VUG",
+                                                            "annual_expense_ratio": .0004,
+                                                            "dividend_multiplier": 1.0
+                                                            },
+                                                        2.0: {"symbol": "QLD",
+                                                            "annual_expense_ratio": .0095,
+                                                            "dividend_multiplier": 0
+                                                            },
+                                                        3.0: {"symbol": "TQQQ",
+                                                            "annual_expense_ratio": .0095,
+                                                            "dividend_multiplier": 0
+                                                            }
+                                                        }
+                                      }
+                            }
+        for symbol_dividend_data in known_index_data.values():
             if not isinstance(symbol_dividend_data["dividend_data_file"], str):
                 symbol_dividend_data["yearly_dividend_ratios"] = float(symbol_dividend_data["dividend_data_file"])
             else:
-                with open(symbol_dividend_data["dividend_data_file"]) as csvfile:
-                    reader = csv.reader(csvfile, delimiter=',')
-                    header = next(reader)
-                    previous_day = None
-                    for r in reader:
-                        if should_break(r):
-                            break
-                        cur_year = parse(r[0]).date().year
-                        dividend_ratio = 0.0
-                        try:
-                            dividend_ratio = float(r[1])
-                        except:
-                            pass
-                        symbol_dividend_data["yearly_dividend_ratios"][cur_year] = dividend_ratio
-        
-                        
-            
-                
+                symbol_dividend_data["yearly_dividend_ratios"] = load_dividend_ratios(symbol_dividend_data["dividend_data_file"], should_break=should_break, use_cache=USE_PARSE_CACHE)
+        return known_index_data
 
 
     def set_file_name(self, file_name: str):
         self._file_name = file_name
 
+    def get_file_name(self) -> str:
+        return self._file_name
+
+    def for_file(self, file_name: str) -> "KnownIndexMetaData":
+        '''Metadata of another file with the same config, without changing this one'''
+        return KnownIndexMetaData(file_name, self.config)
+
+    def get_config(self) -> SimulationConfig:
+        return SimulationConfig() if self.config is None else self.config
+
+    def with_current_config(self) -> "KnownIndexMetaData":
+        '''This metadata if it has a config, or a copy with the module level settings as they are now, so many
+        lookups do not each read them again'''
+        return self if self.config is not None else KnownIndexMetaData(self._file_name, self.get_config())
+
+    def get_settings_key(self) -> tuple:
+        '''Everything the yearly charges and dividends depend on'''
+        config = self.get_config()
+        return (self._file_name, config.include_dividends, config.charge_etf_expenses, config.leveraged_etf_expense_ratio, config.unleveraged_etf_expense_ratio)
+
     def get_annual_dividend(self, year: int, leverage: Union[int, float]) -> float:        
-        if not INCLUDE_DIVIDENDS or self._file_name not in self.KNOWN_FILE_NAMES:
+        if not self.get_config().include_dividends or self._file_name not in self.KNOWN_FILE_NAMES:
             return 0.0
 
         leverage = float(leverage)
@@ -146,6 +226,7 @@ class KnownIndexMetaData():
             leverage = 3.0
         if leverage < 1.0:  # Use 1.0 leverage if less than 1.0
             leverage = 1.0
+        leverage = float(int(leverage))  # Use the next lower known leverage in between, eg 2.0 for 2.5
         yearly_dividend = 0.0
         annual_dividend_ratios = self._known_index_data[self.KNOWN_FILE_NAMES[self._file_name]]["yearly_dividend_ratios"]
         if isinstance(annual_dividend_ratios, float):
@@ -157,12 +238,13 @@ class KnownIndexMetaData():
         return yearly_dividend * leverage_dividend_multiplier
 
     def get_annual_cost(self, year: int, leverage: Union[int, float]) -> float:
-        if not CHARGE_ETF_EXPENSES:
+        config = self.get_config()
+        if not config.charge_etf_expenses:
             return 0.0
 
         leverage = float(leverage)
-        if self._file_name not in self.KNOWN_FILE_NAMES or leverage not in {1.0, 2.0, 3.0}:
-            return UNLEVERAGED_ETF_EXPENSE_RATIO if leverage == 1.0 else LEVERAGED_ETF_EXPENSE_RATIO
+        if self._file_name not in self.KNOWN_FILE_NAMES or leverage not in self.KNOWN_LEVERAGES:
+            return config.unleveraged_etf_expense_ratio if leverage == 1.0 else config.leveraged_etf_expense_ratio
         
         return self._known_index_data[self.KNOWN_FILE_NAMES[self._file_name]]["leverage_data"][leverage]["annual_expense_ratio"]
         
@@ -0,0 +1,552 @@
+"""
+/* Copyright (C) William Lyles - All Rights Reserved
+ * Unauthorized copying of this file, via any medium is strictly prohibited
+ * Proprietary and confidential
+ * Written by William Lyles <willglyles@gmail.com>, January 4th, 2022
+ */
+ """
+from typing import List, Tuple
+import numpy as np
+
+from asset_data import PriceSeries, get_years
+from common import DAYS_PER_YEAR, KnownIndexMetaData, SimulationConfig, dividend_cost_data
+from rebalance import DriftTable, RebalancePolicy, compute_rebalanced_equity_path, get_rebalance_policy, get_rebalanced_end_values
+
+
+def get_annual_change(year: int, leverage: float, index_data: KnownIndexMetaData=None) -> float:
+    '''Net yearly change ratio of an ETF: dividends paid minus expenses charged, as index_data (by default
+    dividend_cost_data, for the file currently set in it) says. Either is 0 when its config leaves it out.'''
+    index_data = dividend_cost_data if index_data is None else index_data
+    change = 0.0
+    change -= index_data.get_annual_cost(year, leverage)
+    change += index_data.get_annual_dividend(year, leverage)
+    return change
+
+
+def get_weighted_leverage_split(leverage_ratio: float, real_small_leverage: float, real_large_leverage: float) -> Tuple[Tuple[float, float], Tuple[float, float]]:
+    # s = smaller leverage to use
+    # b = larger leverage to use
+    # y = weight of larger leverage
+    # x = weight of smaller leverage
+    # v = actual leverage ratio
+    # At the time the equation needs to be solved, s, b, and v will be known constants
+    # x + y = 1
+    # s*x + b*y = v
+    v = leverage_ratio
+    s = real_small_leverage
+    b = real_large_leverage
+    # x = 1 - y
+    # s*(1 - y) + b*y = v
+    # s - s*y + b*y = v
+    # (b - s)*y + s = v
+    # (b - s)*y = v - s
+    # y = (v - s)/(b - s)
+    # y can be solved. Finding x is trivial now.
+    y = (v - s)/(b - s)
+    y = round(y, 8)
+    x = 1 - y
+    x = round(x, 8)
+    return (s, x), (b, y)
+
+
+class LeverageVariant():
+    '''A leverage ratio to simulate, either held directly or (when real_large_leverage is given) built from two
+    real leveraged ETFs, eg 2.5 as half 2x and half 3x. sleeves is the list of (leverage, weight) actually held.
+    The real ETFs are bought once and left to drift, unless a rebalance_policy brings them back to their weights.'''
+    def __init__(self, leverage_ratio, real_large_leverage=None, real_small_leverage=None, rebalance_policy: RebalancePolicy=None):
+        self.leverage_ratio = leverage_ratio
+        self.real_large_leverage = real_large_leverage
+        self.real_small_leverage = None
+        self.sleeves = [(leverage_ratio, 1.0)]
+        if real_large_leverage is not None:
+            self.real_small_leverage = 1.0 if real_small_leverage is None else real_small_leverage
+            if self.can_split_weights():
+                self.sleeves = list(self.get_weighted_leverage_split())
+        # Rebalancing only changes anything with more than one ETF held
+        self.rebalance_policy = rebalance_policy if len(self.sleeves) > 1 else None
+
+    def is_split(self) -> bool:
+        return self.real_large_leverage is not None
+
+    def is_rebalanced(self) -> bool:
+        return self.rebalance_policy is not None
+
+    def get_weighted_leverage_split(self):
+        return get_weighted_leverage_split(self.leverage_ratio, self.real_small_leverage, self.real_large_leverage)
+
+    def can_split_weights(self) -> bool:
+        if not self.is_split():
+            return False
+        (low_leverage, low_leverage_weight), (high_leverage, high_leverage_weight) = self.get_weighted_leverage_split()
+        return low_leverage_weight > 0.0 and high_leverage_weight > 0.0
+
+    def get_sleeve_investments(self, start_investment: float) -> List[Tuple[float, float]]:
+        '''(leverage, amount invested) of each real ETF held. Each real ETF is bought with whole cents.'''
+        if not self.is_split():
+            return [(self.leverage_ratio, start_investment)]
+        return [(leverage, round(start_investment * weight, 2)) for leverage, weight in self.sleeves]
+
+    def get_leverage_ratio_str(self) -> str:
+        if not self.can_split_weights():
+            return str(self.leverage_ratio)
+        (low_leverage, low_leverage_weight), (high_leverage, high_leverage_weight) = self.get_weighted_leverage_split()
+        rebalance_str = f", {self.rebalance_policy}" if self.is_rebalanced() else ""
+        return f"{self.leverage_ratio} ({low_leverage_weight:.1%} {low_leverage}, {high_leverage_weight:.1%} {high_leverage}{rebalance_str})"
+
+    def __str__(self):
+        return self.get_leverage_ratio_str()
+
+    def __repr__(self):
+        return str(self)
+
+
+def get_leverage_variants(leverage_ratios, use_realistic_split_leverage: bool=None, rebalance_policies: List[RebalancePolicy]=None) -> List[LeverageVariant]:
+    '''Every leverage variant simulated for the given leverage ratios. With realistic split leverage, a ratio is
+    simulated with every pair of real ETFs (1x/2x, 1x/3x, 2x/3x) it can be split between, and only held
+    directly when it is a whole number or cannot be split at all.
+    Every split is simulated once per rebalance policy (None to let the ETFs drift).
+    Both default to the settings in common as they are when called.'''
+    if use_realistic_split_leverage is None or rebalance_policies is None:
+        config = SimulationConfig()
+        use_realistic_split_leverage = config.use_realistic_split_leverage if use_realistic_split_leverage is None else use_realistic_split_leverage
+        rebalance_policies = [get_rebalance_policy(config.split_rebalance_frequency, config.split_rebalance_drift_band)] if rebalance_policies is None else rebalance_policies
+    leverage_variants = []
+    for leverage_ratio in leverage_ratios:
+        if not use_realistic_split_leverage:
+            leverage_variants.append(LeverageVariant(leverage_ratio))
+            continue
+        split_variants = [LeverageVariant(leverage_ratio, real_large_leverage, real_small_leverage, rebalance_policy)
+                          for real_large_leverage, real_small_leverage in ((2.0, None), (3.0, None), (3.0, 2.0)) for rebalance_policy in rebalance_policies]
+        split_variants = [split_variant for split_variant in split_variants if split_variant.can_split_weights()]
+        if float(leverage_ratio).is_integer() or len(split_variants) == 0:
+            leverage_variants.append(LeverageVariant(leverage_ratio))
+        leverage_variants.extend(split_variants)
+    return leverage_variants
+
+
+def get_sleeve_leverages(leverage_variants: List[LeverageVariant]) -> List[float]:
+    '''Every distinct leverage actually held by the given variants'''
+    return sorted({leverage for leverage_variant in leverage_variants for leverage, weight in leverage_variant.sleeves})
+
+
+class AnnualAdjustmentTable():
+    '''Net yearly change (dividends minus expenses) of every leverage (columns) for every calendar year (rows) of a
+    PriceSeries, with the index of the first trading day of every new year and how much of its year each day has
+    gone by and has left. Built once per file, so yearly adjustments are applied by direct indexing.'''
+    def __init__(self, series: PriceSeries, leverages, index_data: KnownIndexMetaData=None):
+        self.leverages = np.asarray(leverages, dtype=np.float64)
+        self.years = get_years(series.dates)
+        # min/max rather than first/last, so series made of several dated stretches back to back (see bootstrap.py) work too
+        self.first_year = int(self.years.min()) if len(series) > 0 else 0
+        last_year = int(self.years.max()) if len(series) > 0 else self.first_year - 1
+        year_starts = series.dates.astype("datetime64[Y]")
+        self.fraction_of_year = (series.dates - year_starts.astype("datetime64[D]")).astype(np.int64) / DAYS_PER_YEAR
+        self.fraction_of_year_from_end = (((year_starts + 1).astype("datetime64[D]") - 1) - series.dates).astype(np.int64) / DAYS_PER_YEAR
+        self.new_year_indices = np.flatnonzero(self.years[1:] > self.years[:-1]) + 1
+        index_data = (dividend_cost_data if index_data is None else index_data).with_current_config()
+        self.annual_changes = np.array([[get_annual_change(year, leverage, index_data) for leverage in self.leverages.tolist()]
+                                        for year in range(self.first_year, last_year + 1)]).reshape(-1, len(self.leverages))
+
+    def get_annual_changes(self, indices) -> np.ndarray:
+        '''Net yearly change of every leverage for the year of the day at each index'''
+        return self.annual_changes[self.years[indices] - self.first_year]
+
+    def get_new_year_indices(self, start_index: int, end_index: int) -> np.ndarray:
+        '''Indices of the first trading days of a new year after start_index, up to end_index (inclusive)'''
+        return self.new_year_indices[np.searchsorted(self.new_year_indices, start_index, side="right"):np.searchsorted(self.new_year_indices, end_index, side="right")]
+
+
+def get_annual_adjustment_table(series: PriceSeries, leverages, index_data: KnownIndexMetaData=None) -> AnnualAdjustmentTable:
+    '''AnnualAdjustmentTable of series with the charges/dividends of index_data (by default dividend_cost_data, for the
+    file currently set in it). Kept on the series for reuse by any index_data with the same settings.'''
+    index_data = dividend_cost_data if index_data is None else index_data
+    key = (index_data.get_settings_key(), tuple(float(leverage) for leverage in leverages))
+    if getattr(series, "_annual_adjustment_tables", None) is None:
+        series._annual_adjustment_tables = {}
+    if key not in series._annual_adjustment_tables:
+        series._annual_adjustment_tables[key] = AnnualAdjustmentTable(series, key[1], index_data)
+    return series._annual_adjustment_tables[key]
+
+
+def get_adjustment_factors(series: PriceSeries, start_index: int, end_index: int, leverages, index_data: KnownIndexMetaData=None) -> Tuple[np.ndarray, np.ndarray]:
+    '''Returns, for each leverage, the yearly charge/dividend factor to apply after each day of the window (1.0 on days
+    that do not start a new year), and the final prorated factor applied once the window closes.
+    The first year is prorated from the start date to the end of that year, full years are charged on
+    the first trading day of the following year, and the final partial year is prorated to the end date.'''
+    adjustment_table = get_annual_adjustment_table(series, leverages, index_data)
+    factors = np.ones((len(leverages), end_index - start_index + 1))
+    first_year_changes = adjustment_table.get_annual_changes(start_index) * adjustment_table.fraction_of_year_from_end[start_index]
+    new_year_indices = adjustment_table.get_new_year_indices(start_index, end_index)
+    if len(new_year_indices) == 0:
+        return factors, 1 + first_year_changes
+    factors[:, new_year_indices[0] - start_index] = 1 + first_year_changes
+    factors[:, new_year_indices[1:] - start_index] = 1 + adjustment_table.get_annual_changes(new_year_indices[1:] - 1).T
+    final_factors = 1 + (adjustment_table.get_annual_changes(end_index) * adjustment_table.fraction_of_year[end_index])
+    return factors, final_factors
+
+
+def compute_equity_paths(series: PriceSeries, start_index: int, end_index: int, leverages, start_investment: float=None,
+                         index_data: KnownIndexMetaData=None) -> Tuple[np.ndarray, np.ndarray]:
+    '''Returns the value of the investment at each leverage (rows) at the close of every day in the window (columns),
+    and the final prorated charge/dividend factor that still has to be applied to the last value of each row'''
+    start_investment = SimulationConfig().starting_investment_amount if start_investment is None else start_investment
+    leverages = np.asarray(leverages, dtype=np.float64)
+    daily_growth = 1 + (leverages[:, np.newaxis] * series.ratio_change[start_index:end_index+1])
+    factors, final_factors = get_adjustment_factors(series, start_index, end_index, leverages.tolist(), index_data)
+    return start_investment * np.cumprod(daily_growth * factors, axis=1), final_factors
+
+
+def compute_equity_path(series: PriceSeries, start_index: int, end_index: int, leverage: float, start_investment: float=None,
+                        index_data: KnownIndexMetaData=None) -> Tuple[np.ndarray, float]:
+    equity_paths, final_factors = compute_equity_paths(series, start_index, end_index, [leverage], start_investment, index_data)
+    return equity_paths[0], float(final_factors[0])
+
+
+def get_ruin_offset(equity_path: np.ndarray) -> int:
+    '''Offset into the window of the first day the investment is worth nothing, or -1 if it never is'''
+    ruined = np.minimum.accumulate(equity_path) <= 0.0
+    return int(ruined.argmax()) if len(ruined) > 0 and ruined[-1] else -1
+
+def get_first_ruin_offsets(ratio_changes: np.ndarray, leverages) -> np.ndarray:
+    '''Offset of the first day each leverage loses everything (1 + L*r <= 0) over the given daily changes, or -1, found
+    without computing any equity path. Once the running minimum of the changes crosses a leverage's ruin threshold
+    (r <= -1/L) it stays crossed, so the first crossing is also the last day it had not.'''
+    running_min = np.minimum.accumulate(ratio_changes)
+    ruined = 1 + np.multiply.outer(np.asarray(leverages, dtype=np.float64), running_min) <= 0.0
+    return np.where(ruined[:, -1], ruined.argmax(axis=1), -1) if len(running_min) > 0 else np.full(len(leverages), -1)
+
+
+def _compute_equity_path_in_cents(series: PriceSeries, start_index: int, end_index: int, leverage: float, start_investment: float,
+                                  index_data: KnownIndexMetaData=None) -> Tuple[np.ndarray, float]:
+    # Rounds to the cent after every day and every yearly adjustment, exactly like a brokerage statement would
+    factors, final_factors = get_adjustment_factors(series, start_index, end_index, [leverage], index_data)
+    current_investment_amount = start_investment
+    equity_path = []
+    for ratio_change, factor in zip(series.ratio_change[start_index:end_index+1].tolist(), factors[0].tolist()):
+        current_investment_amount *= 1 + (ratio_change * leverage)
+        current_investment_amount = round(current_investment_amount, 2)
+        if factor != 1.0:
+            current_investment_amount = round(current_investment_amount * factor, 2)
+        equity_path.append(current_investment_amount)
+    return np.array(equity_path), round(current_investment_amount * float(final_factors[0]), 2)
+
+
+def compute_end_value(series: PriceSeries, start_index: int, end_index: int, leverage: float, start_investment: float=None, round_to_cents: bool=False,
+                      index_data: KnownIndexMetaData=None) -> Tuple[float, int]:
+    '''Returns the final value of a leveraged investment held from start_index to end_index (inclusive), and the
+    offset into the window of the day all money was lost (-1 if it never was). An investment that lost all its money is worth 0.
+    With round_to_cents, the value is rounded after every day, reproducing the original day by day simulation exactly.'''
+    start_investment = SimulationConfig().starting_investment_amount if start_investment is None else start_investment
+    ruin_offset = int(get_first_ruin_offsets(series.ratio_change[start_index:end_index+1], [leverage])[0])
+    if ruin_offset >= 0:
+        return 0.0, ruin_offset
+    if round_to_cents:
+        equity_path, end_value = _compute_equity_path_in_cents(series, start_index, end_index, leverage, start_investment, index_data)
+    else:
+        equity_path, final_factor = compute_equity_path(series, start_index, end_index, leverage, start_investment, index_data)
+        end_value = round(float(equity_path[-1]) * final_factor, 2)
+    # Rounding to the cent can still wipe out a (tiny) investment without a ruinous day
+    ruin_offset = get_ruin_offset(equity_path)
+    return (0.0, ruin_offset) if ruin_offset >= 0 else (end_value, -1)
+
+
+class BatchResults():
+    '''End values of every leverage variant (columns) for every simulated window (rows). Investments that lost all
+    their money are worth 0, and ruin_offsets holds the offset into the window of the day they did (-1 otherwise).'''
+    def __init__(self, series: PriceSeries, leverage_variants: List[LeverageVariant], start_indices, end_indices, end_values, ruin_offsets, start_investment: float=None):
+        self.series = series
+        self.leverage_variants = leverage_variants
+        self.start_indices = np.asarray(start_indices, dtype=np.int64)
+        self.end_indices = np.asarray(end_indices, dtype=np.int64)
+        self.end_values = np.asarray(end_values, dtype=np.float64)
+        self.ruin_offsets = np.asarray(ruin_offsets, dtype=np.int64)
+        self.start_investment = SimulationConfig().starting_investment_amount if start_investment is None else start_investment
+
+    def num_windows(self) -> int:
+        return len(self.start_indices)
+
+    def get_start_dates(self) -> np.ndarray:
+        return self.series.dates[self.start_indices]
+
+    def get_end_dates(self) -> np.ndarray:
+        return self.series.dates[self.end_indices]
+
+    def get_ruined(self) -> np.ndarray:
+        return self.ruin_offsets >= 0
+
+    def get_ruin_dates(self) -> np.ndarray:
+        '''Date each investment lost all its money, NaT if it never did'''
+        ruin_indices = self.start_indices[:, np.newaxis] + np.maximum(self.ruin_offsets, 0)
+        return np.where(self.get_ruined(), self.series.dates[ruin_indices], np.datetime64("NaT"))
+
+    def get_investment_years(self) -> np.ndarray:
+        return (self.get_end_dates() - self.get_start_dates()).astype(np.int64) / DAYS_PER_YEAR
+
+    def get_total_return_dollars(self) -> np.ndarray:
+        return np.round(self.end_values - self.start_investment, 2)
+
+    def get_total_return_ratios(self) -> np.ndarray:
+        return np.round(self.get_total_return_dollars() / self.start_investment, 5)
+
+    #CAGR ratio = [[((price of security at exit)/(price of security at entry)) ^ (1 / number of years security is held)] - 1]
+    def get_CAGR_ratios(self) -> np.ndarray:
+        final_ratios = self.end_values / self.start_investment
+        return final_ratios ** (1 / self.get_investment_years()[:, np.newaxis]) - 1
+
+
+def evaluate_window(series: PriceSeries, start_index: int, end_index: int, leverage_variants: List[LeverageVariant], start_investment: float=None,
+                    round_to_cents: bool=None, index_data: KnownIndexMetaData=None) -> BatchResults:
+    '''Simulates every leverage variant over one window in a single pass. Each distinct leverage held by any
+    variant is computed once, and split variants are the weighted sum of the real ETFs they hold.
+    Rebalanced split variants are simulated day by day (see rebalance.compute_rebalanced_equity_path).
+    Leverages past the window's ruin threshold are never simulated: a real ETF that loses everything is worth nothing,
+    and a variant only loses everything on the day the last real ETF it holds does, like a Portfolio.'''
+    start_investment = SimulationConfig().starting_investment_amount if start_investment is None else start_investment
+    round_to_cents = SimulationConfig().round_to_cents_daily if round_to_cents is None else round_to_cents
+    sleeve_leverages = get_sleeve_leverages(leverage_variants)
+    sleeve_ruin_offsets = dict(zip(sleeve_leverages, get_first_ruin_offsets(series.ratio_change[start_index:end_index+1], sleeve_leverages).tolist()))
+    surviving_leverages = [leverage for leverage in sleeve_leverages if sleeve_ruin_offsets[leverage] < 0]
+    sleeve_indexes = {leverage: sleeve_index for sleeve_index, leverage in enumerate(surviving_leverages)}
+    if not round_to_cents and len(surviving_leverages) > 0:
+        unit_equity_paths, final_factors = compute_equity_paths(series, start_index, end_index, surviving_leverages, 1.0, index_data)
+
+    end_values = np.zeros((1, len(leverage_variants)))
+    ruin_offsets = np.full((1, len(leverage_variants)), -1, dtype=np.int64)
+    for variant_index, leverage_variant in enumerate(leverage_variants):
+        sleeve_investments = leverage_variant.get_sleeve_investments(start_investment)
+        held_ruin_offsets = [sleeve_ruin_offsets[leverage] for leverage, sleeve_investment in sleeve_investments]
+        if min(held_ruin_offsets) >= 0:
+            ruin_offsets[0, variant_index] = max(held_ruin_offsets)
+            continue
+        if leverage_variant.is_rebalanced():
+            sleeve_factors, sleeve_final_factors = get_adjustment_factors(series, start_index, end_index, [leverage for leverage, weight in leverage_variant.sleeves], index_data)
+            equity_path, end_value = compute_rebalanced_equity_path(series, start_index, end_index, leverage_variant.sleeves, sleeve_investments,
+                                                                    leverage_variant.rebalance_policy, sleeve_factors, sleeve_final_factors, round_to_cents)
+            sleeve_investments = []
+        else:
+            equity_path = 0.0
+            end_value = 0.0
+        for leverage, sleeve_investment in sleeve_investments:
+            if sleeve_ruin_offsets[leverage] >= 0:
+                # Worth nothing at the end, and the sleeves left keep the variant above 0
+                continue
+            if round_to_cents:
+                sleeve_equity_path, sleeve_end_value = _compute_equity_path_in_cents(series, start_index, end_index, leverage, sleeve_investment, index_data)
+            else:
+                sleeve_equity_path = sleeve_investment * unit_equity_paths[sleeve_indexes[leverage]]
+                sleeve_end_value = float(sleeve_equity_path[-1]) * float(final_factors[sleeve_indexes[leverage]])
+            equity_path = equity_path + sleeve_equity_path
+            end_value += sleeve_end_value
+        ruin_offset = get_ruin_offset(equity_path)
+        ruin_offsets[0, variant_index] = ruin_offset
+        end_values[0, variant_index] = round(end_value, 2) if ruin_offset < 0 else 0.0
+    return BatchResults(series, leverage_variants, [start_index], [end_index], end_values, ruin_offsets, start_investment)
+
+
+DEFAULT_CHUNK_SIZE = 2**16  # Windows evaluated together. Bounds the temporary (windows x leverages) arrays
+
+
+class PrefixTables():
+    '''Cumulative daily log growth of each sleeve leverage over a whole PriceSeries, so the growth of any window is the
+    difference of two prefix entries. The yearly charges/dividends of full years are kept as a second prefix table,
+    and the prorated first and final years are applied per window.
+    Days where a leverage loses everything (1 + L*r <= 0) contribute nothing to the log growth and are recorded separately.
+    The AnnualAdjustmentTable cached on the series for index_data is used unless one is given.'''
+    def __init__(self, series: PriceSeries, leverages, adjustment_table: AnnualAdjustmentTable=None, index_data: KnownIndexMetaData=None):
+        self.series = series
+        self.index_data = index_data
+        self.leverages = np.asarray(leverages, dtype=np.float64)
+        self.leverage_indexes = {leverage: leverage_index for leverage_index, leverage in enumerate(self.leverages.tolist())}
+
+        daily_growth = 1 + (series.ratio_change[:, np.newaxis] * self.leverages)
+        ruined = daily_growth <= 0.0
+        self.ruin_days = [np.flatnonzero(ruined[:, leverage_index]) for leverage_index in range(len(self.leverages))]
+        self.log_growth_prefix = np.zeros((len(series) + 1, len(self.leverages)))
+        np.cumsum(np.log(np.where(ruined, 1.0, daily_growth)), axis=0, out=self.log_growth_prefix[1:])
+
+        self.adjustment_table = get_annual_adjustment_table(series, self.leverages.tolist(), index_data) if adjustment_table is None else adjustment_table
+        full_year_log_adjustments = np.zeros((len(series), len(self.leverages)))
+        new_year_indices = self.adjustment_table.new_year_indices
+        full_year_log_adjustments[new_year_indices] = np.log1p(self.adjustment_table.get_annual_changes(new_year_indices - 1))
+        self.adjustment_prefix = np.zeros((len(series) + 1, len(self.leverages)))
+        np.cumsum(full_year_log_adjustments, axis=0, out=self.adjustment_prefix[1:])
+        self._drift_tables = {}
+        self._daily_rebalance_prefixes = {}
+
+    def extend(self, series: PriceSeries):
+        '''Extends the tables to series, which is the series they were built for with more days appended (see
+        PriceSeries.append). Only the new days are computed, and every entry is the same as building the tables anew.'''
+        num_days = len(self.series)
+        daily_growth = 1 + (series.ratio_change[num_days:, np.newaxis] * self.leverages)
+        ruined = daily_growth <= 0.0
+        self.ruin_days = [np.concatenate((ruin_days, num_days + np.flatnonzero(ruined[:, leverage_index]))) for leverage_index, ruin_days in enumerate(self.ruin_days)]
+        # Continuing the sums from the last entry adds the new days in the same order as one cumsum over every day would
+        self.log_growth_prefix = np.concatenate((self.log_growth_prefix[:-1], np.cumsum(np.vstack((self.log_growth_prefix[-1:], np.log(np.where(ruined, 1.0, daily_growth)))), axis=0)))
+
+        self.adjustment_table = get_annual_adjustment_table(series, self.leverages.tolist(), self.index_data)
+        full_year_log_adjustments = np.zeros((len(series) - num_days, len(self.leverages)))
+        new_year_indices = self.adjustment_table.new_year_indices[self.adjustment_table.new_year_indices >= num_days]
+        full_year_log_adjustments[new_year_indices - num_days] = np.log1p(self.adjustment_table.get_annual_changes(new_year_indices - 1))
+        self.adjustment_prefix = np.concatenate((self.adjustment_prefix[:-1], np.cumsum(np.vstack((self.adjustment_prefix[-1:], full_year_log_adjustments)), axis=0)))
+        self._drift_tables = {}
+        self._daily_rebalance_prefixes = {}
+        self.series = series
+
+    def get_log_growth(self, start_indices: np.ndarray, end_indices: np.ndarray) -> np.ndarray:
+        '''Log of the growth of every window (rows) at every leverage (columns), yearly charges/dividends included'''
+        log_growth = self.log_growth_prefix[end_indices + 1] - self.log_growth_prefix[start_indices]
+        adjustment_table = self.adjustment_table
+        first_year_changes = adjustment_table.get_annual_changes(start_indices) * adjustment_table.fraction_of_year_from_end[start_indices, np.newaxis]
+        log_growth += np.log1p(first_year_changes)
+
+        # Windows that see a new year pay full years from the prefix table (skipping the prorated first year) and a prorated final year
+        new_year_indices = adjustment_table.new_year_indices
+        first_new_year_positions = np.searchsorted(new_year_indices, start_indices, side="right")
+        first_new_year_indices = new_year_indices[np.minimum(first_new_year_positions, len(new_year_indices) - 1)] if len(new_year_indices) > 0 else end_indices
+        sees_new_year = (first_new_year_positions < len(new_year_indices)) & (first_new_year_indices <= end_indices)
+        multi_year_starts = first_new_year_indices[sees_new_year]
+        multi_year_ends = end_indices[sees_new_year]
+        final_year_changes = adjustment_table.get_annual_changes(multi_year_ends) * adjustment_table.fraction_of_year[multi_year_ends, np.newaxis]
+        log_growth[sees_new_year] += (self.adjustment_prefix[multi_year_ends + 1] - self.adjustment_prefix[multi_year_starts + 1]) + np.log1p(final_year_changes)
+        return log_growth
+
+    def get_segment_log_growth(self, window_start_indices: np.ndarray, window_end_indices: np.ndarray, segment_start_indices: np.ndarray,
+                               segment_end_indices: np.ndarray) -> np.ndarray:
+        '''Log of the growth of every segment (rows) of a window at every leverage (columns), with the yearly
+        charges/dividends the window pays within the segment: the prorated first year on the window's first new
+        year day, full years on later ones, and the prorated final year in the segment ending the window.
+        The log growth of the segments of a window adds up to get_log_growth of the window.'''
+        log_growth = self.log_growth_prefix[segment_end_indices + 1] - self.log_growth_prefix[segment_start_indices]
+        adjustment_table = self.adjustment_table
+        first_year_log_changes = np.log1p(adjustment_table.get_annual_changes(window_start_indices) * adjustment_table.fraction_of_year_from_end[window_start_indices, np.newaxis])
+
+        new_year_indices = adjustment_table.new_year_indices
+        first_new_year_positions = np.searchsorted(new_year_indices, window_start_indices, side="right")
+        first_new_year_indices = new_year_indices[np.minimum(first_new_year_positions, len(new_year_indices) - 1)] if len(new_year_indices) > 0 else window_end_indices
+        sees_new_year = (first_new_year_positions < len(new_year_indices)) & (first_new_year_indices <= window_end_indices)
+        # Full years are the new year days after the window's first one
+        full_year_starts = np.maximum(segment_start_indices, first_new_year_indices + 1)
+        pays_full_years = sees_new_year & (segment_end_indices >= full_year_starts)
+        log_growth[pays_full_years] += self.adjustment_prefix[segment_end_indices[pays_full_years] + 1] - self.adjustment_prefix[full_year_starts[pays_full_years]]
+        pays_first_year = sees_new_year & (first_new_year_indices >= segment_start_indices) & (first_new_year_indices <= segment_end_indices)
+        log_growth[pays_first_year] += first_year_log_changes[pays_first_year]
+
+        ends_window = segment_end_indices == window_end_indices
+        pays_final_year = ends_window & sees_new_year
+        log_growth[pays_final_year] += np.log1p(adjustment_table.get_annual_changes(window_end_indices[pays_final_year]) * adjustment_table.fraction_of_year[window_end_indices[pays_final_year], np.newaxis])
+        # A window within one year pays its prorated first year once it closes
+        log_growth[ends_window & ~sees_new_year] += first_year_log_changes[ends_window & ~sees_new_year]
+        return log_growth
+
+    def get_drift_table(self, low_leverage: float, high_leverage: float) -> DriftTable:
+        key = (low_leverage, high_leverage)
+        if key not in self._drift_tables:
+            self._drift_tables[key] = DriftTable(self.log_growth_prefix, self.leverage_indexes[low_leverage], self.leverage_indexes[high_leverage])
+        return self._drift_tables[key]
+
+    def get_daily_rebalance_prefix(self, sleeves: List[Tuple[float, float]]) -> np.ndarray:
+        '''Prefix sums of the daily log growth of the sleeves, weighted as given, when rebalanced to those weights every day.
+        Every day pays the full year adjustment of a new year, so the days that pay a prorated one must be corrected.'''
+        key = tuple(sleeves)
+        if key not in self._daily_rebalance_prefixes:
+            sleeve_columns = [self.leverage_indexes[leverage] for leverage, weight in sleeves]
+            daily_log_growth = np.diff(self.log_growth_prefix[:, sleeve_columns] + self.adjustment_prefix[:, sleeve_columns], axis=0)
+            daily_rebalance_prefix = np.zeros(len(self.log_growth_prefix))
+            np.cumsum(np.log(np.exp(daily_log_growth) @ np.array([weight for leverage, weight in sleeves])), out=daily_rebalance_prefix[1:])
+            self._daily_rebalance_prefixes[key] = daily_rebalance_prefix
+        return self._daily_rebalance_prefixes[key]
+
+    def get_ruin_offsets(self, start_indices: np.ndarray, end_indices: np.ndarray) -> np.ndarray:
+        '''Offset into each window (rows) of the first day each leverage (columns) loses everything, or -1'''
+        ruin_offsets = np.full((len(start_indices), len(self.leverages)), -1, dtype=np.int64)
+        for leverage_index, ruin_days in enumerate(self.ruin_days):
+            if len(ruin_days) == 0:
+                continue
+            first_ruin_positions = np.searchsorted(ruin_days, start_indices, side="left")
+            first_ruin_days = ruin_days[np.minimum(first_ruin_positions, len(ruin_days) - 1)]
+            ruined = (first_ruin_positions < len(ruin_days)) & (first_ruin_days <= end_indices)
+            ruin_offsets[ruined, leverage_index] = (first_ruin_days - start_indices)[ruined]
+        return ruin_offsets
+
+
+def get_sleeve_allocations(leverage_variants: List[LeverageVariant], sleeve_leverages: List[float], start_investment: float) -> np.ndarray:
+    '''(sleeve leverages x variants) matrix of the amount each variant invests in each real ETF'''
+    sleeve_indexes = {leverage: sleeve_index for sleeve_index, leverage in enumerate(sleeve_leverages)}
+    allocations = np.zeros((len(sleeve_leverages), len(leverage_variants)))
+    for variant_index, leverage_variant in enumerate(leverage_variants):
+        for leverage, sleeve_investment in leverage_variant.get_sleeve_investments(start_investment):
+            allocations[sleeve_indexes[leverage], variant_index] += sleeve_investment
+    return allocations
+
+
+def iterate_window_results(series: PriceSeries, start_indices, end_indices, leverage_variants: List[LeverageVariant], start_investment: float=None,
+                           chunk_size: int=DEFAULT_CHUNK_SIZE, prefix_tables: PrefixTables=None, index_data: KnownIndexMetaData=None):
+    '''Yields a BatchResults for every chunk of at most chunk_size windows, in order.
+    A real ETF that loses everything is worth nothing, and a variant only loses everything on the day the last real
+    ETF it holds does, like a Portfolio (see portfolio.evaluate_portfolios).
+    Rebalanced split variants are grown segment by segment between their rebalances (see rebalance.get_rebalanced_end_values),
+    except in the rare windows where some but not all of their real ETFs lose everything, which are simulated day by day.'''
+    start_investment = SimulationConfig().starting_investment_amount if start_investment is None else start_investment
+    start_indices = np.asarray(start_indices, dtype=np.int64)
+    end_indices = np.asarray(end_indices, dtype=np.int64)
+    sleeve_leverages = get_sleeve_leverages(leverage_variants)
+    if prefix_tables is None:
+        prefix_tables = PrefixTables(series, sleeve_leverages, index_data=index_data)
+    sleeve_columns = [prefix_tables.leverage_indexes[leverage] for leverage in sleeve_leverages]
+    allocations = get_sleeve_allocations(leverage_variants, sleeve_leverages, start_investment)
+    holds_sleeve = allocations > 0.0
+    rebalanced_variant_indexes = [variant_index for variant_index, leverage_variant in enumerate(leverage_variants) if leverage_variant.is_rebalanced()]
+
+    for chunk_start in range(0, len(start_indices), chunk_size):
+        chunk_start_indices = start_indices[chunk_start:chunk_start+chunk_size]
+        chunk_end_indices = end_indices[chunk_start:chunk_start+chunk_size]
+        sleeve_values = np.exp(prefix_tables.get_log_growth(chunk_start_indices, chunk_end_indices)[:, sleeve_columns])
+        sleeve_ruin_offsets = prefix_tables.get_ruin_offsets(chunk_start_indices, chunk_end_indices)[:, sleeve_columns]
+        sleeve_values[sleeve_ruin_offsets >= 0] = 0.0
+        end_values = np.round(sleeve_values @ allocations, 2)
+        for variant_index in rebalanced_variant_indexes:
+            leverage_variant = leverage_variants[variant_index]
+            end_values[:, variant_index] = np.round(get_rebalanced_end_values(prefix_tables, chunk_start_indices, chunk_end_indices, leverage_variant.sleeves,
+                                                                              leverage_variant.get_sleeve_investments(start_investment), leverage_variant.rebalance_policy), 2)
+
+        ruin_offsets = np.full(end_values.shape, -1, dtype=np.int64)
+        if (sleeve_ruin_offsets >= 0).any():
+            for variant_index in range(len(leverage_variants)):
+                held_ruin_offsets = sleeve_ruin_offsets[:, holds_sleeve[:, variant_index]]
+                all_ruined = (held_ruin_offsets >= 0).all(axis=1)
+                ruin_offsets[all_ruined, variant_index] = held_ruin_offsets[all_ruined].max(axis=1)
+                if variant_index in rebalanced_variant_indexes:
+                    for window_index in np.flatnonzero((held_ruin_offsets >= 0).any(axis=1) & ~all_ruined).tolist():
+                        end_values[window_index, variant_index] = evaluate_window(series, int(chunk_start_indices[window_index]), int(chunk_end_indices[window_index]),
+                                                                                  [leverage_variants[variant_index]], start_investment, False,
+                                                                                  prefix_tables.index_data).end_values[0, 0]
+            end_values[ruin_offsets >= 0] = 0.0
+        yield BatchResults(series, leverage_variants, chunk_start_indices, chunk_end_indices, end_values, ruin_offsets, start_investment)
+
+
+def evaluate_windows(series: PriceSeries, start_indices, end_indices, leverage_variants: List[LeverageVariant], start_investment: float=None,
+                     round_to_cents: bool=None, chunk_size: int=DEFAULT_CHUNK_SIZE, prefix_tables: PrefixTables=None,
+                     index_data: KnownIndexMetaData=None) -> BatchResults:
+    '''Simulates every leverage variant over every (start_indices[i], end_indices[i]) window, with the yearly
+    charges/dividends of index_data (by default dividend_cost_data, for the file currently set in it).
+    Rounding to the cent every day is inherently sequential, so round_to_cents falls back to one evaluate_window per window.
+    start_investment and round_to_cents default to the settings in common as they are when called.'''
+    start_investment = SimulationConfig().starting_investment_amount if start_investment is None else start_investment
+    round_to_cents = SimulationConfig().round_to_cents_daily if round_to_cents is None else round_to_cents
+    if round_to_cents:
+        batches = [evaluate_window(series, start_index, end_index, leverage_variants, start_investment, round_to_cents=True, index_data=index_data)
+                   for start_index, end_index in zip(np.asarray(start_indices).tolist(), np.asarray(end_indices).tolist())]
+    else:
+        batches = list(iterate_window_results(series, start_indices, end_indices, leverage_variants, start_investment, chunk_size, prefix_tables, index_data))
+    return concatenate_batch_results(series, leverage_variants, batches, start_investment)
+
+
+def concatenate_batch_results(series: PriceSeries, leverage_variants: List[LeverageVariant], batches: List[BatchResults], start_investment: float=None) -> BatchResults:
+    if len(batches) == 0:
+        return BatchResults(series, leverage_variants, [], [], np.zeros((0, len(leverage_variants))), np.zeros((0, len(leverage_variants))), start_investment)
+    return BatchResults(series, leverage_variants,
+                        np.concatenate([batch.start_indices for batch in batches]),
+                        np.concatenate([batch.end_indices for batch in batches]),
+                        np.concatenate([batch.end_values for batch in batches]),
+                        np.concatenate([batch.ruin_offsets for batch in batches]),
+                        start_investment)
@@ -0,0 +1,109 @@
+"""
+/* Copyright (C) William Lyles - All Rights Reserved
+ * Unauthorized copying of this file, via any medium is strictly prohibited
+ * Proprietary and confidential
+ * Written by William Lyles <willglyles@gmail.com>, January 4th, 2022
+ */
+ """
+import hashlib
+import os
+import pickle
+from typing import Dict, List
+import numpy as np
+
+from asset_data import PriceSeries
+from common import KnownIndexMetaData, SimulationConfig
+import engine
+from instrumentation import Instrumentation
+from investment import InvestmentsStats, get_default_cagr_thresholds
+import main
+from simulation_context import SimulationContext
+
+STATS_FILE_SUFFIX = ".stats.pkl"
+STATS_VERSION = 3  # Bump whenever InvestmentsStats or the simulation changes, so every saved stats file is rebuilt
+
+# Kept between refreshes of a long running process, so appended days extend the tables instead of rebuilding them
+_prefix_tables: Dict[tuple, engine.PrefixTables] = {}
+
+
+class SavedStats():
+    '''Stats of every window of the first num_days days of a file, and what they were simulated with'''
+    def __init__(self, settings: tuple, num_days: int, series_hash: str, leverage_results: Dict[str, InvestmentsStats]):
+        self.version = STATS_VERSION
+        self.settings = settings
+        self.num_days = num_days
+        self.series_hash = series_hash
+        self.leverage_results = leverage_results
+
+
+def get_stats_file_name(file_name: str) -> str:
+    return file_name + STATS_FILE_SUFFIX
+
+def get_settings(file_name: str, leverage_ratios: List[float], config: SimulationConfig) -> tuple:
+    '''Everything the stats of every window depend on, besides the price data'''
+    return (file_name, tuple(leverage_ratios), tuple(config.get_settings().items()), get_default_cagr_thresholds())
+
+def get_series_hash(series: PriceSeries, num_days: int) -> str:
+    '''Hash of the dates and closes of the first num_days days, which is all the windows within them depend on'''
+    content_hasher = hashlib.sha256(np.ascontiguousarray(series.dates[:num_days]).tobytes())
+    content_hasher.update(np.ascontiguousarray(series.close[:num_days]).tobytes())
+    return content_hasher.hexdigest()
+
+
+def load_saved_stats(stats_file_name: str) -> SavedStats:
+    if not os.path.exists(stats_file_name):
+        return None
+    try:
+        with open(stats_file_name, "rb") as f:
+            saved_stats = pickle.load(f)
+    except (OSError, pickle.UnpicklingError, EOFError, AttributeError):
+        return None
+    return saved_stats if isinstance(saved_stats, SavedStats) and saved_stats.version == STATS_VERSION else None
+
+def save_stats(stats_file_name: str, saved_stats: SavedStats):
+    temporary_stats_file_name = stats_file_name + ".tmp"
+    with open(temporary_stats_file_name, "wb") as f:
+        pickle.dump(saved_stats, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(temporary_stats_file_name, stats_file_name)
+
+
+def get_prefix_tables(file_name: str, series: PriceSeries, sleeve_leverages: List[float], index_data: KnownIndexMetaData) -> engine.PrefixTables:
+    '''PrefixTables of series, extended from the ones of an earlier refresh when series only had days appended since'''
+    key = (file_name, tuple(sleeve_leverages)) + index_data.get_settings_key()
+    prefix_tables = _prefix_tables.get(key)
+    num_days = 0 if prefix_tables is None else len(prefix_tables.series)
+    if prefix_tables is None or num_days > len(series) or get_series_hash(prefix_tables.series, num_days) != get_series_hash(series, num_days):
+        prefix_tables = engine.PrefixTables(series, sleeve_leverages, index_data=index_data)
+    elif num_days < len(series):
+        prefix_tables.extend(series)
+    _prefix_tables[key] = prefix_tables
+    return prefix_tables
+
+
+def run_incremental_stats(file_name: str, leverage_ratios=[1.0, 2.0, 3.0], chunk_size=engine.DEFAULT_CHUNK_SIZE, stats_file_name: str=None,
+                          context: SimulationContext=None, instrumentation: Instrumentation=None) -> Dict[str, InvestmentsStats]:
+    '''Same stats as main.run_all_windows_stats for the context of file_name (by default the loaded file, see main.get_context), but saved to stats_file_name
+    (next to the CSV by default). When the file only had days appended since the stats were saved, with the same
+    settings, only the windows the new days add are simulated and folded into the saved stats. Anything else
+    starts over. Sums in the stats may differ in their last digits from a full run, which adds windows in another order.
+    instrumentation is given the phases and progress of the windows simulated, none when nothing was appended.'''
+    if 1.0 not in leverage_ratios:
+        leverage_ratios.append(1.0)
+    stats_file_name = get_stats_file_name(file_name) if stats_file_name is None else stats_file_name
+    context = main.get_context(context)
+    series = context.series
+    settings = get_settings(file_name, leverage_ratios, context.config)
+    saved_stats = load_saved_stats(stats_file_name)
+    if (saved_stats is None or saved_stats.settings != settings or saved_stats.num_days > len(series)
+        or saved_stats.series_hash != get_series_hash(series, saved_stats.num_days)):
+        saved_stats = SavedStats(settings, 0, get_series_hash(series, 0), {})
+
+    if saved_stats.num_days < len(series):
+        sleeve_leverages = engine.get_sleeve_leverages(context.get_leverage_variants(leverage_ratios))
+        main.run_all_windows_stats(leverage_ratios, chunk_size, saved_stats.leverage_results, saved_stats.num_days if saved_stats.num_days > 0 else None,
+                                   get_prefix_tables(file_name, series, sleeve_leverages, context.index_data), context=context,
+                                   instrumentation=instrumentation)
+        saved_stats.num_days = len(series)
+        saved_stats.series_hash = get_series_hash(series, len(series))
+        save_stats(stats_file_name, saved_stats)
+    return saved_stats.leverage_results
@@ -0,0 +1,198 @@
+"""
+/* Copyright (C) William Lyles - All Rights Reserved
+ * Unauthorized copying of this file, via any medium is strictly prohibited
+ * Proprietary and confidential
+ * Written by William Lyles <willglyles@gmail.com>, January 4th, 2022
+ */
+ """
+import cProfile
+import io
+import pstats
+import time
+import tracemalloc
+from typing import Callable, Dict, List
+
+# Phases of a run, timed separately
+PHASE_DATA_LOAD = "data load"
+PHASE_WINDOW_SAMPLING = "window sampling"
+PHASE_DATE_LOOKUPS = "date lookups"
+PHASE_RETURN_COMPUTATION = "return computation"
+PHASE_STATS_AGGREGATION = "stats aggregation"
+PHASE_REPORT_FORMATTING = "report formatting"
+PHASES = (PHASE_DATA_LOAD, PHASE_WINDOW_SAMPLING, PHASE_DATE_LOOKUPS, PHASE_RETURN_COMPUTATION, PHASE_STATS_AGGREGATION, PHASE_REPORT_FORMATTING)
+
+# Profile capture modes
+PROFILE_CPROFILE = "cprofile"  # Time spent in every function
+PROFILE_TRACEMALLOC = "tracemalloc"  # Memory allocated by every line still held at the end
+PROFILE_MODES = (PROFILE_CPROFILE, PROFILE_TRACEMALLOC)
+
+
+class _NullPhase():
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+_NULL_PHASE = _NullPhase()
+
+
+class Instrumentation():
+    '''What a simulation reports while it runs. This one ignores everything: phase() hands back one shared no-op
+    context manager and add_progress() does nothing, so a run without metrics only pays for a few calls per chunk of
+    windows. See SimulationMetrics for one that records them.'''
+
+    def phase(self, phase_name: str):
+        '''Context manager timing one phase of the run (one of PHASES)'''
+        return _NULL_PHASE
+
+    def add_progress(self, num_windows: int, num_variants: int, total_windows: int=None):
+        '''num_windows more windows were simulated at num_variants leverage variants each, out of total_windows in the run'''
+        pass
+
+NULL_INSTRUMENTATION = Instrumentation()
+
+
+def get_instrumentation(instrumentation: Instrumentation=None) -> Instrumentation:
+    return NULL_INSTRUMENTATION if instrumentation is None else instrumentation
+
+
+class _Phase():
+    def __init__(self, metrics: "SimulationMetrics", phase_name: str):
+        self.metrics = metrics
+        self.phase_name = phase_name
+
+    def __enter__(self):
+        self.start_time = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.metrics.add_phase_time(self.phase_name, time.perf_counter() - self.start_time)
+        return False
+
+
+class SimulationMetrics(Instrumentation):
+    '''Records the time spent in every phase and the windows simulated so far, for samples (windows) and investments
+    (windows x leverage variants) per second and an ETA. Every progress_callbacks callback is called with the metrics
+    whenever progress is added, at most once per callback_interval seconds (and always once the run is done).'''
+
+    def __init__(self, progress_callbacks: List[Callable[["SimulationMetrics"], None]]=None, callback_interval: float=0.0):
+        self.progress_callbacks = [] if progress_callbacks is None else list(progress_callbacks)
+        self.callback_interval = callback_interval
+        self.phase_seconds: Dict[str, float] = {}
+        self.phase_calls: Dict[str, int] = {}
+        self.start_time = None
+        self.num_windows = 0
+        self.num_investments = 0
+        self.total_windows = None
+        self._last_callback_time = None
+
+    def start(self):
+        '''Restarts the clock throughput and the ETA are measured from. Called by the first phase or progress otherwise.'''
+        self.start_time = time.perf_counter()
+
+    def phase(self, phase_name: str) -> _Phase:
+        if self.start_time is None:
+            self.start()
+        return _Phase(self, phase_name)
+
+    def add_phase_time(self, phase_name: str, seconds: float):
+        self.phase_seconds[phase_name] = self.phase_seconds.get(phase_name, 0.0) + seconds
+        self.phase_calls[phase_name] = self.phase_calls.get(phase_name, 0) + 1
+
+    def add_progress(self, num_windows: int, num_variants: int, total_windows: int=None):
+        if self.start_time is None:
+            self.start()
+        self.num_windows += num_windows
+        self.num_investments += num_windows * num_variants
+        if total_windows is not None:
+            self.total_windows = total_windows
+        now = time.perf_counter()
+        if (len(self.progress_callbacks) > 0 and (self._last_callback_time is None or now - self._last_callback_time >= self.callback_interval
+                                                  or self.get_progress() >= 1.0)):
+            self._last_callback_time = now
+            for progress_callback in self.progress_callbacks:
+                progress_callback(self)
+
+    def get_elapsed_seconds(self) -> float:
+        return 0.0 if self.start_time is None else time.perf_counter() - self.start_time
+
+    def get_samples_per_second(self) -> float:
+        elapsed_seconds = self.get_elapsed_seconds()
+        return self.num_windows / elapsed_seconds if elapsed_seconds > 0 else 0.0
+
+    def get_investments_per_second(self) -> float:
+        elapsed_seconds = self.get_elapsed_seconds()
+        return self.num_investments / elapsed_seconds if elapsed_seconds > 0 else 0.0
+
+    def get_progress(self) -> float:
+        '''Fraction of the run's windows simulated, 0 when the total is not known'''
+        return min(self.num_windows / self.total_windows, 1.0) if self.total_windows else 0.0
+
+    def get_eta_seconds(self) -> float:
+        '''Seconds left at the throughput so far, None until it is known'''
+        samples_per_second = self.get_samples_per_second()
+        if not self.total_windows or samples_per_second == 0.0:
+            return None
+        return max(self.total_windows - self.num_windows, 0) / samples_per_second
+
+    def get_progress_str(self) -> str:
+        eta_seconds = self.get_eta_seconds()
+        return (f"{self.get_progress():.0%} finished, {self.get_samples_per_second():,.0f} samples/s, {self.get_investments_per_second():,.0f} investments/s"
+                + ("" if eta_seconds is None else f", ETA {eta_seconds:.1f}s"))
+
+    def get_report(self) -> str:
+        '''Throughput and the time spent in every phase that ran'''
+        timed_seconds = sum(self.phase_seconds.values())
+        report = (f"{self.num_windows} samples, {self.num_investments} investments in {self.get_elapsed_seconds():.3f}s: "
+                  f"{self.get_samples_per_second():,.0f} samples/s, {self.get_investments_per_second():,.0f} investments/s")
+        for phase_name in [phase_name for phase_name in PHASES if phase_name in self.phase_seconds] + sorted(set(self.phase_seconds) - set(PHASES)):
+            report += (f"\n    - {phase_name}: {self.phase_seconds[phase_name]:.3f}s in {self.phase_calls[phase_name]} calls"
+                       f" ({self.phase_seconds[phase_name] / timed_seconds if timed_seconds > 0 else 0.0:.1%})")
+        return report
+
+
+def print_progress(metrics: SimulationMetrics):
+    '''Progress callback printing throughput and the ETA'''
+    print(metrics.get_progress_str())
+
+
+class ProfileCapture():
+    '''Context manager profiling everything run within it with cProfile (PROFILE_CPROFILE) or tracemalloc
+    (PROFILE_TRACEMALLOC). Both slow the run down, so they are only started when asked for.'''
+    def __init__(self, mode: str=PROFILE_CPROFILE):
+        if mode not in PROFILE_MODES:
+            raise ValueError(f"Unknown profile mode {mode!r}, expected one of {PROFILE_MODES}")
+        self.mode = mode
+        self.profiler: cProfile.Profile = None
+        self.snapshot: tracemalloc.Snapshot = None
+
+    def start(self):
+        if self.mode == PROFILE_CPROFILE:
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        else:
+            tracemalloc.start()
+
+    def stop(self):
+        if self.mode == PROFILE_CPROFILE:
+            self.profiler.disable()
+        else:
+            self.snapshot = tracemalloc.take_snapshot()
+            tracemalloc.stop()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+        return False
+
+    def get_report(self, limit: int=25) -> str:
+        '''The limit functions with the most cumulative time, or lines holding the most memory'''
+        if self.mode == PROFILE_CPROFILE:
+            stats_stream = io.StringIO()
+            pstats.Stats(self.profiler, stream=stats_stream).sort_stats(pstats.SortKey.CUMULATIVE).print_stats(limit)
+            return stats_stream.getvalue()
+        return "\n".join(str(statistic) for statistic in self.snapshot.statistics("lineno")[:limit])
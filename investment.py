@@ -5,88 +5,50 @@
  * Written by William Lyles <willglyles@gmail.com>, January 4th, 2022
  */
  """
-from common import DAYS_PER_YEAR, INCLUDE_DIVIDENDS, STARTING_INVESTMENT_AMOUNT, CHARGE_ETF_EXPENSES, dividend_cost_data
+import common
+from common import DAYS_PER_YEAR, SimulationConfig
 from datetime import datetime, date
+import numpy as np
+from accumulator import QuantileSketch, RunningStats
+import engine
+from simulation_context import SimulationContext
 
 
-class AllMoneyLost(Exception):
-    pass
-
 class Investment():
-    def __init__(self, start_index, end_index, security_historical_data, leverage_ratio):
+    '''Without a context, the investment is simulated with the settings and index data in common'''
+    def __init__(self, start_index, end_index, security_historical_data, leverage_ratio, context: SimulationContext=None):
         self.start_index = start_index
         self.end_index = end_index
         self.security_historical_data = security_historical_data
-        self.start_date = security_historical_data[start_index].date
-        self.end_date = security_historical_data[end_index].date
+        self.start_date = security_historical_data.get_date(start_index)
+        self.end_date = security_historical_data.get_date(end_index)
         # print(f"{self.start_date} to {self.end_date}")
-        self.start_investment = STARTING_INVESTMENT_AMOUNT
+        self.context = context
+        self.start_investment = (SimulationConfig() if context is None else context.config).starting_investment_amount
         self.leverage_ratio = leverage_ratio
 
-    def is_new_year(self, cur_date:date, previous_date:date):
-        if previous_date is None:
-            return False
-        return cur_date.year > previous_date.year
-
-    def is_full_year(self, first_date, previous_date, cur_date):
-        if previous_date.year == first_date.year: # Case 1 is first year
-            return False
-        elif cur_date.year > previous_date.year: # Case 2 is full year
-            return True
-        else: # Case 3 is final year (not full)
-            return False
-
-    def after_charges_and_dividends(self, first_date: date, previous_date: date, cur_date: date, current_investment_amount: float, leverage: float):
-        prorated_change = 1
-        year = None
-        if previous_date.year == first_date.year: # Prorated change for first year
-            prorated_change = self.get_fractional_year_from_end(first_date)
-            year = first_date.year
-        elif cur_date.year > previous_date.year: # No prorate. Full year - it is not a partial first year, and the year did change
-            prorated_change = 1
-            year = previous_date.year
-        else: #prorate change for partial final year
-            prorated_change = self.get_fractional_year(cur_date)
-            year = cur_date.year
-
-        change = 0
-        if CHARGE_ETF_EXPENSES:
-            print(f"Annual cost for {year} @ {leverage} leverage: {dividend_cost_data.get_annual_cost(year, leverage)}")
-            change -= dividend_cost_data.get_annual_cost(year, leverage)
-        if INCLUDE_DIVIDENDS:
-            print(f"Annual dividend for {year} @ {leverage} leverage: {dividend_cost_data.get_annual_dividend(year, leverage)}")
-            change += dividend_cost_data.get_annual_dividend(year, leverage)
-        final_change_ratio = 1 + (change * prorated_change)
-        return round(current_investment_amount * final_change_ratio, 2)
+    def get_round_to_cents(self) -> bool:
+        return (SimulationConfig() if self.context is None else self.context.config).round_to_cents_daily
 
+    def get_index_data(self):
+        return None if self.context is None else self.context.index_data
 
     def compute_return(self):
         '''Returns self for easy chaining'''
-        current_investment_amount = self.start_investment
-        first_date = None
-        previous_date = None
-        for daily_data in self.security_historical_data[self.start_index:self.end_index+1]:
-            if first_date is None:
-                first_date = daily_data.date
-
-            current_investment_amount *= 1 + (daily_data.ratio_change * self.leverage_ratio)
-            current_investment_amount = round(current_investment_amount, 2)
-            
-            if self.is_new_year(daily_data.date, previous_date):
-                current_investment_amount = self.after_charges_and_dividends(first_date, previous_date, daily_data.date, current_investment_amount, self.leverage_ratio)
-
-            if current_investment_amount <= 0.0:
-                raise AllMoneyLost(f"If you see this exception, this leveraged ETF ceased operations because it dropped to 0. You lost all your money on {daily_data.date} for this investment:\n{str(self)}")
-
-            previous_date = daily_data.date
+        end_investment, ruin_offset = engine.compute_end_value(self.security_historical_data, self.start_index, self.end_index, self.leverage_ratio,
+                                                               self.start_investment, round_to_cents=self.get_round_to_cents(), index_data=self.get_index_data())
+        self.set_end_investment(end_investment, ruin_offset)
+        return self
 
-        
-        current_investment_amount = self.after_charges_and_dividends(first_date, previous_date, daily_data.date, current_investment_amount, self.leverage_ratio)
-        self.end_investment = current_investment_amount
+    def set_end_investment(self, end_investment: float, ruin_offset: int=-1):
+        '''A ruin_offset of 0 or more means the leveraged ETF ceased operations because it dropped to 0 that many days
+        into the investment. All money was lost on ruin_date, and the investment is worth nothing.'''
+        self.ruin_offset = ruin_offset
+        self.ruin_date = self.security_historical_data.get_date(self.start_index + ruin_offset) if ruin_offset >= 0 else None
+        self.end_investment = 0.0 if ruin_offset >= 0 else end_investment
         self.total_return_dollars = round(self.end_investment - self.start_investment, 2)
         self.total_return_ratio = round((self.total_return_dollars / self.start_investment), 5)
         self.CAGR = self.get_CAGR_ratio()
-        return self
 
     #CAGR ratio = [[((price of security at exit)/(price of security at entry)) ^ (1 / number of years security is held)] - 1]
     def get_CAGR_ratio(self):
@@ -95,16 +57,6 @@ class Investment():
         CAGR_ratio = final_ratio ** (1 / number_of_years_invested)
         return CAGR_ratio - 1
 
-    def get_fractional_year(self, date):
-        start_of_year = datetime(date.year, 1, 1).date()
-        fraction_of_year = (date - start_of_year).days / DAYS_PER_YEAR
-        return fraction_of_year
-
-    def get_fractional_year_from_end(self, date):
-        end_of_year = datetime(date.year, 12, 31).date()
-        fraction_of_year = (end_of_year - date).days / DAYS_PER_YEAR
-        return fraction_of_year
-
     def _convert_to_scalar_year(self, date):
         start_of_year = datetime(date.year, 1, 1).date()
         fraction_of_year = (date - start_of_year).days / DAYS_PER_YEAR
@@ -117,6 +69,9 @@ class Investment():
     def get_scalar_end_year(self):
         return self._convert_to_scalar_year(self.end_date)
 
+    def lost_all_money(self) -> bool:
+        return self.ruin_date is not None
+
     def get_leverage_ratio_str(self) -> str:
         return str(self.leverage_ratio)
         
@@ -136,14 +91,16 @@ Ratio:  {self.leverage_ratio}
 Original Investment:   ${self.start_investment:.2f}
 End Value: ${self.end_investment:.2f}
 Total Return: {self.total_return_ratio:.2%}
-CAGR: {self.CAGR:.2%}"""
+CAGR: {self.CAGR:.2%}""" + (f"\nAll money lost on: {self.ruin_date}" if self.lost_all_money() else "")
 
 
 class InvestmentSplitLeverage(Investment):
-    def __init__(self, start_index, end_index, security_historical_data, leverage_ratio, real_large_leverage, real_small_leverage=None):
-        super().__init__(start_index, end_index, security_historical_data, leverage_ratio)
+    def __init__(self, start_index, end_index, security_historical_data, leverage_ratio, real_large_leverage, real_small_leverage=None, rebalance_policy=None,
+                 context: SimulationContext=None):
+        super().__init__(start_index, end_index, security_historical_data, leverage_ratio, context)
         self.real_large_leverage = real_large_leverage 
         self.real_small_leverage = 1.0 if real_small_leverage is None else real_small_leverage
+        self.rebalance_policy = rebalance_policy
 
     def compute_return(self):
         '''Returns self for easy chaining'''
@@ -151,96 +108,111 @@ class InvestmentSplitLeverage(Investment):
             super().compute_return()
             return self
 
-        (low_leverage, low_leverage_weight), (high_leverage, high_leverage_weight) = self.get_weighted_leverage_split()
-        low_leverage_investment_amount = round(self.start_investment * low_leverage_weight, 2)
-        high_leverage_investment_amount = round(self.start_investment * high_leverage_weight, 2)
-        first_date = None
-        previous_date = None
-        for daily_data in self.security_historical_data[self.start_index:self.end_index+1]:
-            if first_date is None:
-                first_date = daily_data.date
-
-            low_leverage_investment_amount *= 1 + (daily_data.ratio_change * low_leverage)
-            low_leverage_investment_amount = round(low_leverage_investment_amount, 2)
-            high_leverage_investment_amount *= 1 + (daily_data.ratio_change * high_leverage)
-            high_leverage_investment_amount = round(high_leverage_investment_amount, 2)
-            
-            if self.is_new_year(daily_data.date, previous_date):
-                low_leverage_investment_amount = self.after_charges_and_dividends(first_date, previous_date, daily_data.date, low_leverage_investment_amount, low_leverage)
-                high_leverage_investment_amount = self.after_charges_and_dividends(first_date, previous_date, daily_data.date, high_leverage_investment_amount, high_leverage)
-
-            if (low_leverage_investment_amount + high_leverage_investment_amount) <= 0.0:
-                raise AllMoneyLost(f"If you see this exception, this leveraged ETF ceased operations because it dropped to 0. You lost all your money on {daily_data.date} for this investment:\n{str(self)}")
-
-            previous_date = daily_data.date
-
-        low_leverage_investment_amount = self.after_charges_and_dividends(first_date, previous_date, daily_data.date, low_leverage_investment_amount, low_leverage)
-        high_leverage_investment_amount = self.after_charges_and_dividends(first_date, previous_date, daily_data.date, high_leverage_investment_amount, high_leverage)
-        self.end_investment = round(low_leverage_investment_amount + high_leverage_investment_amount, 2)
-        self.total_return_dollars = round(self.end_investment - self.start_investment, 2)
-        self.total_return_ratio = round((self.total_return_dollars / self.start_investment), 5)
-        self.CAGR = self.get_CAGR_ratio()
+        results = engine.evaluate_window(self.security_historical_data, self.start_index, self.end_index, [self.get_leverage_variant()],
+                                         self.start_investment, round_to_cents=self.get_round_to_cents(), index_data=self.get_index_data())
+        self.set_end_investment(float(results.end_values[0, 0]), int(results.ruin_offsets[0, 0]))
         return self
 
+    def get_leverage_variant(self) -> engine.LeverageVariant:
+        return engine.LeverageVariant(self.leverage_ratio, self.real_large_leverage, self.real_small_leverage, self.rebalance_policy)
+
     def can_split_weights(self):
         (low_leverage, low_leverage_weight), (high_leverage, high_leverage_weight) = self.get_weighted_leverage_split()
         return low_leverage_weight > 0.0 and high_leverage_weight > 0.0
 
     def get_weighted_leverage_split(self):
-        # s = smaller leverage to use
-        # b = larger leverage to use
-        # y = weight of larger leverage
-        # x = weight of smaller leverage
-        # v = actual leverage ratio
-        # At the time the equation needs to be solved, s, b, and v will be known constants
-        # x + y = 1
-        # s*x + b*y = v
-        v = self.leverage_ratio
-        s = self.real_small_leverage
-        b = self.real_large_leverage
-        # x = 1 - y
-        # s*(1 - y) + b*y = v
-        # s - s*y + b*y = v
-        # (b - s)*y + s = v
-        # (b - s)*y = v - s
-        # y = (v - s)/(b - s)
-        # y can be solved. Finding x is trivial now.
-        y = (v - s)/(b - s)
-        y = round(y, 8)
-        x = 1 - y
-        x = round(x, 8)
-        return (s, x), (b, y)
+        return engine.get_weighted_leverage_split(self.leverage_ratio, self.real_small_leverage, self.real_large_leverage)
 
     def get_leverage_ratio_str(self) -> str:
         if not self.can_split_weights():
             return super().get_leverage_ratio_str()
         (low_leverage, low_leverage_weight), (high_leverage, high_leverage_weight) = self.get_weighted_leverage_split()
         #print(high_leverage_weight)
-        return f"{self.leverage_ratio} ({low_leverage_weight:.1%} {low_leverage}, {high_leverage_weight:.1%} {high_leverage})"
+        rebalance_str = f", {self.rebalance_policy}" if self.rebalance_policy is not None else ""
+        return f"{self.leverage_ratio} ({low_leverage_weight:.1%} {low_leverage}, {high_leverage_weight:.1%} {high_leverage}{rebalance_str})"
+
+
+def investment_from_batch_results(batch_results: engine.BatchResults, window_index: int, variant_index: int, context: SimulationContext=None) -> Investment:
+    '''Builds the Investment for one cell of an engine.BatchResults, simulated with context'''
+    leverage_variant = batch_results.leverage_variants[variant_index]
+    start_index = int(batch_results.start_indices[window_index])
+    end_index = int(batch_results.end_indices[window_index])
+    if leverage_variant.is_split():
+        investment = InvestmentSplitLeverage(start_index, end_index, batch_results.series, leverage_variant.leverage_ratio, leverage_variant.real_large_leverage,
+                                             leverage_variant.real_small_leverage, leverage_variant.rebalance_policy, context)
+    else:
+        investment = Investment(start_index, end_index, batch_results.series, leverage_variant.leverage_ratio, context)
+    investment.start_investment = batch_results.start_investment
+    investment.set_end_investment(float(batch_results.end_values[window_index, variant_index]), int(batch_results.ruin_offsets[window_index, variant_index]))
+    return investment
+
 
 
 
+def get_scalar_years(dates) -> np.ndarray:
+    '''Vectorized Investment.get_scalar_start_year of datetime64[D] dates, eg 2000-07-02 is about 2000.5'''
+    dates = np.asarray(dates, dtype="datetime64[D]")
+    year_starts = dates.astype("datetime64[Y]")
+    return (year_starts.astype(np.int64) + 1970) + (dates - year_starts.astype("datetime64[D]")).astype(np.int64) / DAYS_PER_YEAR
 
 
+class InvestmentSummary():
+    '''What is kept about an individual investment once it is folded into an InvestmentsStats'''
+    def __init__(self, CAGR: float, total_return_dollars: float, total_return_ratio: float, was_largest_return: bool, returned_more_than_1_ratio: bool,
+                 start_date: date, end_date: date, investment_period: float, ruin_date: date=None):
+        self.CAGR = CAGR
+        self.total_return_dollars = total_return_dollars
+        self.total_return_ratio = total_return_ratio
+        self.was_largest_return = was_largest_return
+        self.returned_more_than_1_ratio = returned_more_than_1_ratio
+        self.start_date = start_date
+        self.end_date = end_date
+        self.investment_period = investment_period
+        self.ruin_date = ruin_date  # None unless all money was lost
+
+
+def get_default_cagr_thresholds() -> tuple:
+    '''CAGR thresholds InvestmentsStats keeps stats for, read from common whenever stats are built'''
+    return (0.0, common.EXTRA_STAT_CAGR_THRESHOLD)
 
 
 class InvestmentsStats():
-    def __init__(self, leverage_ratio, leverage_ratio_str: str):
+    '''Running statistics of every investment made at one leverage ratio. Investments are folded in one at a time and
+    not kept, so memory does not grow with the number of investments. Partial stats (eg from parallel workers) can be merged.
+    CAGR threshold stats are only kept for the cagr_thresholds given here, by default 0% and common.EXTRA_STAT_CAGR_THRESHOLD
+    as it is when the stats are built.'''
+    # Total return ratio thresholds counted for the overview
+    RETURN_THRESHOLDS_BELOW = [t/4 for t in range(-3, 1)]
+    RETURN_THRESHOLDS_ABOVE = [t/4 for t in range(5)] + [float(t) for t in range(2, 6)]
+
+    def __init__(self, leverage_ratio, leverage_ratio_str: str, cagr_thresholds=None):
         self.leverage_ratio = leverage_ratio
         self.leverage_ratio_str = leverage_ratio_str
-        self.CAGR_ratios = []
-        self.total_dollar_returns = []
-        self.total_return_ratios = []
-        self.was_largest_return_list = []
-        self.returned_more_than_1_ratio_list = []
-        self.start_dates = []
-        self.end_dates = []
-        self.start_years = []
-        self.end_years = []
-        self.investment_periods = []
+        self.CAGR_stats = RunningStats()
+        self.total_dollar_return_stats = RunningStats()
+        self.total_return_ratio_stats = RunningStats()
+        self.start_year_stats = RunningStats()
+        self.end_year_stats = RunningStats()
+        self.investment_period_stats = RunningStats()
+        self.was_largest_return_count = 0
+        self.returned_more_than_1_ratio_count = 0
+        self.all_money_lost_count = 0
+        # Threshold stats are arrays aligned with sorted threshold arrays, so a whole batch is counted with one searchsorted
+        if cagr_thresholds is None:
+            cagr_thresholds = get_default_cagr_thresholds()
+        self.cagr_thresholds = np.unique(np.asarray(cagr_thresholds, dtype=np.float64))
+        self.CAGR_below_threshold_counts = np.zeros(len(self.cagr_thresholds), dtype=np.int64)
+        self.CAGR_below_threshold_totals = np.zeros(len(self.cagr_thresholds))
+        self.CAGR_above_threshold_counts = np.zeros(len(self.cagr_thresholds), dtype=np.int64)
+        self.CAGR_above_threshold_totals = np.zeros(len(self.cagr_thresholds))
+        self.return_thresholds = np.unique(self.RETURN_THRESHOLDS_BELOW + self.RETURN_THRESHOLDS_ABOVE)
+        self.return_ratio_below_threshold_counts = np.zeros(len(self.return_thresholds), dtype=np.int64)
+        self.return_ratio_above_threshold_counts = np.zeros(len(self.return_thresholds), dtype=np.int64)
+        self.CAGR_sketch = QuantileSketch()
+        self.total_return_ratio_sketch = QuantileSketch()
 
     def num_investments(self) -> int:
-        return len(self.CAGR_ratios)
+        return self.CAGR_stats.count
 
     def get_leverage_ratio_str(self) -> str:
         return self.leverage_ratio_str
@@ -248,120 +220,227 @@ class InvestmentsStats():
     def add_investment_results(self, investment:Investment, was_largest_return, returned_more_than_1_ratio):
         assert(investment.leverage_ratio == self.leverage_ratio)
         assert(investment.get_leverage_ratio_str() == self.get_leverage_ratio_str())
-        self.CAGR_ratios.append(investment.CAGR)
-        self.total_dollar_returns.append(investment.total_return_dollars)
-        self.total_return_ratios.append(investment.total_return_ratio)
-        self.was_largest_return_list.append(was_largest_return)
-        self.returned_more_than_1_ratio_list.append(returned_more_than_1_ratio)
         scalar_start_year = investment.get_scalar_start_year()
         scalar_end_year = investment.get_scalar_end_year()
-        self.start_years.append(scalar_start_year)
-        self.start_dates.append(investment.start_date)
-        self.end_years.append(scalar_end_year)
-        self.end_dates.append(investment.end_date)
-        self.investment_periods.append(scalar_end_year-scalar_start_year)
+        summary = InvestmentSummary(investment.CAGR, investment.total_return_dollars, investment.total_return_ratio, was_largest_return, returned_more_than_1_ratio,
+                                    investment.start_date, investment.end_date, scalar_end_year-scalar_start_year, investment.ruin_date)
+        self.CAGR_stats.add(investment.CAGR, summary)
+        self.total_dollar_return_stats.add(investment.total_return_dollars, summary)
+        self.total_return_ratio_stats.add(investment.total_return_ratio, summary)
+        self.start_year_stats.add(scalar_start_year)
+        self.end_year_stats.add(scalar_end_year)
+        self.investment_period_stats.add(summary.investment_period)
+        self.was_largest_return_count += was_largest_return
+        self.returned_more_than_1_ratio_count += returned_more_than_1_ratio
+        self.all_money_lost_count += investment.lost_all_money()
+        is_below_CAGR_threshold = investment.CAGR < self.cagr_thresholds
+        is_above_CAGR_threshold = investment.CAGR > self.cagr_thresholds
+        self.CAGR_below_threshold_counts += is_below_CAGR_threshold
+        self.CAGR_below_threshold_totals[is_below_CAGR_threshold] += investment.CAGR
+        self.CAGR_above_threshold_counts += is_above_CAGR_threshold
+        self.CAGR_above_threshold_totals[is_above_CAGR_threshold] += investment.CAGR
+        self.return_ratio_below_threshold_counts += investment.total_return_ratio < self.return_thresholds
+        self.return_ratio_above_threshold_counts += investment.total_return_ratio > self.return_thresholds
+        self.CAGR_sketch.add(investment.CAGR)
+        self.total_return_ratio_sketch.add(investment.total_return_ratio)
+
+    def add_results(self, CAGR_ratios, total_dollar_returns, total_return_ratios, was_largest_return, returned_more_than_1_ratio, start_dates, end_dates,
+                    scalar_start_years=None, scalar_end_years=None, ruin_dates=None):
+        '''Folds a whole batch of investments at once, given as arrays with one entry per investment (dates as datetime64[D]).
+        Every stat is computed in one vectorized pass, and every threshold is counted with a single searchsorted.
+        The scalar years of the dates (see get_scalar_years) can be passed in when they are shared by several calls.
+        ruin_dates holds the day each investment lost all its money, NaT if it did not (the default for all of them).'''
+        CAGR_ratios = np.asarray(CAGR_ratios, dtype=np.float64)
+        total_dollar_returns = np.asarray(total_dollar_returns, dtype=np.float64)
+        total_return_ratios = np.asarray(total_return_ratios, dtype=np.float64)
+        was_largest_return = np.asarray(was_largest_return, dtype=bool)
+        returned_more_than_1_ratio = np.asarray(returned_more_than_1_ratio, dtype=bool)
+        start_dates = np.asarray(start_dates, dtype="datetime64[D]")
+        end_dates = np.asarray(end_dates, dtype="datetime64[D]")
+        ruin_dates = np.full(len(CAGR_ratios), np.datetime64("NaT"), dtype="datetime64[D]") if ruin_dates is None else np.asarray(ruin_dates, dtype="datetime64[D]")
+        num_investments = len(CAGR_ratios)
+        if num_investments == 0:
+            return
+        scalar_start_years = get_scalar_years(start_dates) if scalar_start_years is None else scalar_start_years
+        scalar_end_years = get_scalar_years(end_dates) if scalar_end_years is None else scalar_end_years
+        investment_periods = scalar_end_years - scalar_start_years
+
+        def get_summary(index: int) -> InvestmentSummary:
+            return InvestmentSummary(float(CAGR_ratios[index]), float(total_dollar_returns[index]), float(total_return_ratios[index]), bool(was_largest_return[index]),
+                                     bool(returned_more_than_1_ratio[index]), start_dates[index].item(), end_dates[index].item(), float(investment_periods[index]),
+                                     ruin_dates[index].item())
+
+        self.CAGR_stats.add_values(CAGR_ratios, get_summary)
+        self.total_dollar_return_stats.add_values(total_dollar_returns, get_summary)
+        self.total_return_ratio_stats.add_values(total_return_ratios, get_summary)
+        self.start_year_stats.add_values(scalar_start_years)
+        self.end_year_stats.add_values(scalar_end_years)
+        self.investment_period_stats.add_values(investment_periods)
+        self.was_largest_return_count += int(np.count_nonzero(was_largest_return))
+        self.returned_more_than_1_ratio_count += int(np.count_nonzero(returned_more_than_1_ratio))
+        self.all_money_lost_count += int(np.count_nonzero(~np.isnat(ruin_dates)))
+
+        sorted_CAGR_ratios = np.sort(CAGR_ratios)
+        CAGR_prefix_totals = np.concatenate(([0.0], np.cumsum(sorted_CAGR_ratios)))
+        below_positions = np.searchsorted(sorted_CAGR_ratios, self.cagr_thresholds, side="left")
+        above_positions = np.searchsorted(sorted_CAGR_ratios, self.cagr_thresholds, side="right")
+        self.CAGR_below_threshold_counts += below_positions
+        self.CAGR_below_threshold_totals += CAGR_prefix_totals[below_positions]
+        self.CAGR_above_threshold_counts += num_investments - above_positions
+        self.CAGR_above_threshold_totals += CAGR_prefix_totals[-1] - CAGR_prefix_totals[above_positions]
+
+        sorted_total_return_ratios = np.sort(total_return_ratios)
+        self.return_ratio_below_threshold_counts += np.searchsorted(sorted_total_return_ratios, self.return_thresholds, side="left")
+        self.return_ratio_above_threshold_counts += num_investments - np.searchsorted(sorted_total_return_ratios, self.return_thresholds, side="right")
+        self.CAGR_sketch.add_values(CAGR_ratios)
+        self.total_return_ratio_sketch.add_values(total_return_ratios)
+
+    def merge(self, other: "InvestmentsStats"):
+        '''Folds the investments of other into self, as if they had been added after self's'''
+        assert(other.get_leverage_ratio_str() == self.get_leverage_ratio_str())
+        if not np.array_equal(other.cagr_thresholds, self.cagr_thresholds):
+            raise ValueError(f"Cannot merge stats of CAGR thresholds {other.cagr_thresholds.tolist()} into stats of CAGR thresholds {self.cagr_thresholds.tolist()}")
+        for stats, other_stats in ((self.CAGR_stats, other.CAGR_stats), (self.total_dollar_return_stats, other.total_dollar_return_stats),
+                                   (self.total_return_ratio_stats, other.total_return_ratio_stats), (self.start_year_stats, other.start_year_stats),
+                                   (self.end_year_stats, other.end_year_stats), (self.investment_period_stats, other.investment_period_stats)):
+            stats.merge(other_stats)
+        self.was_largest_return_count += other.was_largest_return_count
+        self.returned_more_than_1_ratio_count += other.returned_more_than_1_ratio_count
+        self.all_money_lost_count += other.all_money_lost_count
+        self.CAGR_below_threshold_counts += other.CAGR_below_threshold_counts
+        self.CAGR_below_threshold_totals += other.CAGR_below_threshold_totals
+        self.CAGR_above_threshold_counts += other.CAGR_above_threshold_counts
+        self.CAGR_above_threshold_totals += other.CAGR_above_threshold_totals
+        self.return_ratio_below_threshold_counts += other.return_ratio_below_threshold_counts
+        self.return_ratio_above_threshold_counts += other.return_ratio_above_threshold_counts
+        self.CAGR_sketch.merge(other.CAGR_sketch)
+        self.total_return_ratio_sketch.merge(other.total_return_ratio_sketch)
 
     def avg_start_year(self):
-        return round((sum(self.start_years) / len(self.start_years)), 2)
+        return round(self.start_year_stats.mean(), 2)
     def avg_end_year(self):
-        return round((sum(self.end_years) / len(self.end_years)), 2)
+        return round(self.end_year_stats.mean(), 2)
     def avg_investment_time(self):
-        return round((sum(self.investment_periods) / len(self.investment_periods)), 2)
+        return round(self.investment_period_stats.mean(), 2)
 
 
     def returned_more_than_leverage_1_frequency(self):
-        return sum(self.returned_more_than_1_ratio_list) / len(self.returned_more_than_1_ratio_list)
+        return self.returned_more_than_1_ratio_count / self.num_investments()
     
     def returned_more_than_leverage_1_times(self):
-        return sum(self.returned_more_than_1_ratio_list)
+        return self.returned_more_than_1_ratio_count
+
+    def all_money_lost_frequency(self):
+        return self.all_money_lost_count / self.num_investments()
 
     def was_largest_return_frequency(self):
-        return sum(self.was_largest_return_list) / len(self.was_largest_return_list)
+        return self.was_largest_return_count / self.num_investments()
     
     def was_largest_return_times(self):
-        return sum(self.was_largest_return_list)
+        return self.was_largest_return_count
 
 
 
     # ==== Return Dollars Functions ====
     def average_dollar_return(self) -> float:
-        return sum(self.total_dollar_returns) / len(self.total_dollar_returns)
+        return self.total_dollar_return_stats.mean()
 
     def worst_dollar_return(self) -> float:
-        return min(self.total_dollar_returns)
+        return self.total_dollar_return_stats.min
 
     def best_dollar_return(self) -> float:
-        return max(self.total_dollar_returns)
+        return self.total_dollar_return_stats.max
 
-    def worst_dollar_return_index(self):
-        return self.total_dollar_returns.index(self.worst_dollar_return())
+    def worst_dollar_return_investment(self) -> InvestmentSummary:
+        return self.total_dollar_return_stats.min_info
     
-    def best_dollar_return_index(self):
-        return self.total_dollar_returns.index(self.best_dollar_return())
+    def best_dollar_return_investment(self) -> InvestmentSummary:
+        return self.total_dollar_return_stats.max_info
 
 
     # ==== Return Ratio Functions ====
     def average_return_ratio(self) -> float:
-        return sum(self.total_return_ratios) / len(self.total_return_ratios)
+        return self.total_return_ratio_stats.mean()
     
     def worst_return_ratio(self) -> float:
-        return min(self.total_return_ratios)
+        return self.total_return_ratio_stats.min
     
     def best_return_ratio(self) -> float:
-        return max(self.total_return_ratios)
+        return self.total_return_ratio_stats.max
     
-    def worst_return_index(self):
-        return self.total_return_ratios.index(self.worst_return_ratio())
+    def worst_return_investment(self) -> InvestmentSummary:
+        return self.total_return_ratio_stats.min_info
     
-    def best_return_index(self):
-        return self.total_return_ratios.index(self.best_return_ratio())
+    def best_return_investment(self) -> InvestmentSummary:
+        return self.total_return_ratio_stats.max_info
+
+    def return_ratio_quantile(self, quantile: float) -> float:
+        '''Approximate (see QuantileSketch) total return ratio below which the given fraction of investments fall'''
+        return self.total_return_ratio_sketch.get_quantile(quantile)
 
 
 
     # ==== CAGR Functions ====
     def average_CAGR(self) -> float:
-        return sum(self.CAGR_ratios) / len(self.CAGR_ratios)
+        return self.CAGR_stats.mean()
 
     def worst_CAGR(self) -> float:
-        return min(self.CAGR_ratios)
+        return self.CAGR_stats.min
 
     def best_CAGR(self) -> float:
-        return max(self.CAGR_ratios)
+        return self.CAGR_stats.max
 
-    def worst_CAGR_index(self):
-        return self.CAGR_ratios.index(self.worst_CAGR())
+    def worst_CAGR_investment(self) -> InvestmentSummary:
+        return self.CAGR_stats.min_info
 
-    def best_CAGR_index(self):
-        return self.CAGR_ratios.index(self.best_CAGR())
+    def best_CAGR_investment(self) -> InvestmentSummary:
+        return self.CAGR_stats.max_info
+
+    def CAGR_quantile(self, quantile: float) -> float:
+        '''Approximate (see QuantileSketch) CAGR below which the given fraction of investments fall'''
+        return self.CAGR_sketch.get_quantile(quantile)
+
+    def median_CAGR(self) -> float:
+        return self.CAGR_quantile(.5)
+
+    @staticmethod
+    def _get_threshold_indexes(tracked_thresholds: np.ndarray, thresholds, threshold_name: str) -> np.ndarray:
+        thresholds = np.asarray(thresholds, dtype=np.float64)
+        threshold_indexes = np.minimum(np.searchsorted(tracked_thresholds, thresholds), len(tracked_thresholds) - 1)
+        if len(tracked_thresholds) == 0 or (tracked_thresholds[threshold_indexes] != thresholds).any():
+            raise KeyError(f"{threshold_name} thresholds {thresholds.tolist()} were not all tracked. Tracked thresholds: {tracked_thresholds.tolist()}")
+        return threshold_indexes
+
+    def is_CAGR_threshold_tracked(self, threshold: float) -> bool:
+        return bool(np.isin(threshold, self.cagr_thresholds))
 
     def avg_CAGR_when_less_than(self, threshold: float):
-        cagr_ratios_below_threshold = list(filter(lambda x: x < threshold, self.CAGR_ratios))
-        if len(cagr_ratios_below_threshold) == 0:
+        threshold_index = self._get_threshold_indexes(self.cagr_thresholds, threshold, "CAGR")
+        if self.CAGR_below_threshold_counts[threshold_index] == 0:
             return f"N/A (none below {threshold:.2%})"
-        return sum(cagr_ratios_below_threshold) / len(cagr_ratios_below_threshold)
+        return float(self.CAGR_below_threshold_totals[threshold_index] / self.CAGR_below_threshold_counts[threshold_index])
 
     def avg_CAGR_when_greater_than(self, threshold: float):
-        cagr_ratios_above_threshold = list(filter(lambda x: x > threshold, self.CAGR_ratios))
-        if len(cagr_ratios_above_threshold) == 0:
+        threshold_index = self._get_threshold_indexes(self.cagr_thresholds, threshold, "CAGR")
+        if self.CAGR_above_threshold_counts[threshold_index] == 0:
             return f"N/A (none above {threshold:.2%})"
-        return sum(cagr_ratios_above_threshold) / len(cagr_ratios_above_threshold)
+        return float(self.CAGR_above_threshold_totals[threshold_index] / self.CAGR_above_threshold_counts[threshold_index])
 
     def CAGR_less_than_frequency(self, threshold: float):
-        return len(list(filter(lambda x: x < threshold, self.CAGR_ratios))) / len(self.CAGR_ratios)
+        return float(self.CAGR_below_threshold_counts[self._get_threshold_indexes(self.cagr_thresholds, threshold, "CAGR")] / self.num_investments())
         
     def CAGR_greater_than_frequency(self, threshold: float):
-        return (len(list(filter(lambda x: x > threshold, self.CAGR_ratios))) / len(self.CAGR_ratios))
+        return float(self.CAGR_above_threshold_counts[self._get_threshold_indexes(self.cagr_thresholds, threshold, "CAGR")] / self.num_investments())
 
-    @staticmethod
-    def get_tab_printed_overview_headers(cagr_threshold=0.0, cagr_threshold_stats=True, return_threshold_stats=True):
+    @classmethod
+    def get_tab_printed_overview_headers(cls, cagr_threshold=0.0, cagr_threshold_stats=True, return_threshold_stats=True):
         cagr_threshold_headers = [f"Final CAGR < {cagr_threshold:.1%}",
         f"Avg of CAGRs when CAGR < {cagr_threshold:.2%}",
         f"Final CAGR > {cagr_threshold:.1%}",
         f"Avg of CAGRs when CAGR > {cagr_threshold:.2%}"]
 
-        all_return_threshold_headers = [f"Final return < {t/4:.0%}" for t in range(-3, 1)]
-        all_return_threshold_headers.extend([f"Final return > {t/4:.0%}" for t in range(5)])
-        all_return_threshold_headers.extend([f"Final return > {t:.0%}" for t in range(2, 6)])
+        all_return_threshold_headers = [f"Final return < {t:.0%}" for t in cls.RETURN_THRESHOLDS_BELOW]
+        all_return_threshold_headers.extend([f"Final return > {t:.0%}" for t in cls.RETURN_THRESHOLDS_ABOVE])
 
         headers = ["Leverage Ratio",
         "# of times largest return",
@@ -376,7 +455,8 @@ class InvestmentsStats():
         "Best CAGR",
         "Worst CAGR",
         f"Final CAGR > 1.0 leverage's CAGR",
-        "# of times > 1.0 leverage"]
+        "# of times > 1.0 leverage",
+        "All money lost"]
 
         headers_2 = [
         "Avg start year (same for all)",
@@ -391,21 +471,29 @@ class InvestmentsStats():
         return "\t".join(final_data)
 
     def return_beyond_threshold_times(self, threshold_percentage:float, below=True):
-        filter_func = (lambda x: x < threshold_percentage) if below else (lambda x: x > threshold_percentage)
-        return len(list(filter(filter_func, self.total_return_ratios)))
+        threshold_counts = self.return_ratio_below_threshold_counts if below else self.return_ratio_above_threshold_counts
+        return int(threshold_counts[self._get_threshold_indexes(self.return_thresholds, threshold_percentage, "Return")])
+
+    def return_beyond_threshold_frequencies(self, threshold_percentages, below=True) -> np.ndarray:
+        threshold_counts = self.return_ratio_below_threshold_counts if below else self.return_ratio_above_threshold_counts
+        return threshold_counts[self._get_threshold_indexes(self.return_thresholds, threshold_percentages, "Return")] / self.num_investments()
 
 
     def get_tab_printed_overview_data(self, cagr_threshold=0.0, cagr_threshold_stats=True, return_threshold_stats=True):
-        cagr_avg_when_less_than_threshold = self.avg_CAGR_when_less_than(cagr_threshold)
-        cagr_avg_when_more_than_threshold = self.avg_CAGR_when_greater_than(cagr_threshold)
-        cagr_threshold_data = [f"{self.CAGR_less_than_frequency(cagr_threshold):.2%}",
-        f"{cagr_avg_when_less_than_threshold:.2%}" if isinstance(cagr_avg_when_less_than_threshold, float) else f"{cagr_avg_when_less_than_threshold}",
-        f"{self.CAGR_greater_than_frequency(cagr_threshold):.2%}",
-        f"{cagr_avg_when_more_than_threshold:.2%}" if isinstance(cagr_avg_when_more_than_threshold, float) else f"{cagr_avg_when_more_than_threshold}"]
-
-        below_return_threshold_percentages = [f"{self.return_beyond_threshold_times(t/4, below=True) / self.num_investments():.2%}" for t in range(-3, 1)]
-        above_return_threshold_percentages = [f"{self.return_beyond_threshold_times(t/4, below=False) / self.num_investments():.2%}" for t in range(5)]
-        above_return_threshold_percentages.extend([f"{self.return_beyond_threshold_times(t, below=False) / self.num_investments():.2%}" for t in range(2, 6)]) 
+        cagr_threshold_data = []
+        if cagr_threshold_stats and not self.is_CAGR_threshold_tracked(cagr_threshold):
+            # eg common.EXTRA_STAT_CAGR_THRESHOLD was changed after these stats were built
+            cagr_threshold_data = [f"N/A ({cagr_threshold:.2%} not tracked, only {', '.join(f'{t:.2%}' for t in self.cagr_thresholds.tolist())})"] * 4
+        elif cagr_threshold_stats:
+            cagr_avg_when_less_than_threshold = self.avg_CAGR_when_less_than(cagr_threshold)
+            cagr_avg_when_more_than_threshold = self.avg_CAGR_when_greater_than(cagr_threshold)
+            cagr_threshold_data = [f"{self.CAGR_less_than_frequency(cagr_threshold):.2%}",
+            f"{cagr_avg_when_less_than_threshold:.2%}" if isinstance(cagr_avg_when_less_than_threshold, float) else f"{cagr_avg_when_less_than_threshold}",
+            f"{self.CAGR_greater_than_frequency(cagr_threshold):.2%}",
+            f"{cagr_avg_when_more_than_threshold:.2%}" if isinstance(cagr_avg_when_more_than_threshold, float) else f"{cagr_avg_when_more_than_threshold}"]
+
+        below_return_threshold_percentages = [f"{frequency:.2%}" for frequency in self.return_beyond_threshold_frequencies(self.RETURN_THRESHOLDS_BELOW, below=True).tolist()]
+        above_return_threshold_percentages = [f"{frequency:.2%}" for frequency in self.return_beyond_threshold_frequencies(self.RETURN_THRESHOLDS_ABOVE, below=False).tolist()]
         all_return_threshold_percentages = below_return_threshold_percentages + above_return_threshold_percentages
 
 
@@ -422,7 +510,8 @@ class InvestmentsStats():
         f"{self.best_CAGR():.2%}",
         f"{self.worst_CAGR():.2%}",
         f"{self.returned_more_than_leverage_1_frequency():.0%}",
-        f"{self.returned_more_than_leverage_1_times()}"]
+        f"{self.returned_more_than_leverage_1_times()}",
+        f"{self.all_money_lost_frequency():.2%}"]
 
         data_2 = [
         f"{self.avg_start_year():.2f}",
@@ -431,30 +520,26 @@ class InvestmentsStats():
         ]
 
         final_data = data
-        final_data.extend((cagr_threshold_data if cagr_threshold_stats else []))
+        final_data.extend(cagr_threshold_data)
         final_data.extend((all_return_threshold_percentages if return_threshold_stats else []))
         final_data.extend(data_2)
         return "\t".join(final_data)
 
     @staticmethod
     def get_tab_printed_invesment_headers(is_CAGR=False):
-        return """Leverage Ratio\tCAGR\tTotal Return ($)\tTotal Return (%)\tWas largest return for ratios\tReturned more than 1.0 ratio\tStart Date\tEnd Date\tInvestment Period (yrs)"""
+        return """Leverage Ratio\tCAGR\tTotal Return ($)\tTotal Return (%)\tWas largest return for ratios\tReturned more than 1.0 ratio\tStart Date\tEnd Date\tInvestment Period (yrs)\tAll Money Lost On"""
         
-    def get_tab_printed_investment(self, index):
-        if index < 0 or index >= len(self.CAGR_ratios):
-            raise IndexError(f"Index {index} not in range of recorded investments (0 to {len(self.CAGR_ratios)-1})")
-        return f"""{self.get_leverage_ratio_str()}\t{self.CAGR_ratios[index]:.2%}\t{self.total_dollar_returns[index]:.2f}\t{self.total_return_ratios[index]:.2%}\t{"Yes" if self.was_largest_return_list[index] else "No"}\t{"Yes" if self.returned_more_than_1_ratio_list[index] else "No"}\t{self.start_dates[index]}\t{self.end_dates[index]}\t{self.investment_periods[index]:.2f}"""
+    def get_tab_printed_investment(self, investment_summary: InvestmentSummary):
+        return f"""{self.get_leverage_ratio_str()}\t{investment_summary.CAGR:.2%}\t{investment_summary.total_return_dollars:.2f}\t{investment_summary.total_return_ratio:.2%}\t{"Yes" if investment_summary.was_largest_return else "No"}\t{"Yes" if investment_summary.returned_more_than_1_ratio else "No"}\t{investment_summary.start_date}\t{investment_summary.end_date}\t{investment_summary.investment_period:.2f}\t{investment_summary.ruin_date if investment_summary.ruin_date is not None else "Never"}"""
     
-    def get_printable_index_information(self, index):
-        if index < 0 or index >= len(self.CAGR_ratios):
-            raise IndexError(f"Index {index} not in range of recorded investments (0 to {len(self.CAGR_ratios)-1})")
+    def get_printable_investment_information(self, investment_summary: InvestmentSummary):
         return f"""Leverage Ratio: {self.leverage_ratio}
-CAGR: {self.CAGR_ratios[index]:.0%}
-Total Return ($): ${self.total_dollar_returns[index]:.2f}
-Total Return (%): {self.total_return_ratios[index]:.2%}
-Was largest return for ratios: {"Yes" if self.was_largest_return_list[index] else "No"}
-Returned more than 1.0 ratio:  {"Yes" if self.returned_more_than_1_ratio_list[index] else "No"}
-Start: {self.start_dates[index]}
-End:  {self.end_dates[index]}
-Investment Period: {self.investment_periods[index]:.2f} yrs
-"""
+CAGR: {investment_summary.CAGR:.0%}
+Total Return ($): ${investment_summary.total_return_dollars:.2f}
+Total Return (%): {investment_summary.total_return_ratio:.2%}
+Was largest return for ratios: {"Yes" if investment_summary.was_largest_return else "No"}
+Returned more than 1.0 ratio:  {"Yes" if investment_summary.returned_more_than_1_ratio else "No"}
+Start: {investment_summary.start_date}
+End:  {investment_summary.end_date}
+Investment Period: {investment_summary.investment_period:.2f} yrs
+""" + (f"All money lost on: {investment_summary.ruin_date}\n" if investment_summary.ruin_date is not None else "")
@@ -51,17 +51,30 @@ Compound Annual Growth Rate (%) = [[((price of security at entry)/(price of secu
 I am not offering investment advice. I am obviously not responsible for your investment outcomes. I am simulating these purely out of curiosity. Investing in leveraged ETFs, ETFs, or other securities, can result in loss of money (sometimes all of it) and debt.
 """
 from collections import defaultdict
-import csv
 from datetime import date, datetime, timedelta
+import os
 import random
-from asset_data import DailyAssetData
+import numpy as np
+from asset_data import PriceSeries
+from price_cache import load_price_series
+from rebalance import REBALANCE_ANNUAL, REBALANCE_MONTHLY, REBALANCE_QUARTERLY, RebalancePolicy
 
-from typing import DefaultDict, List
+from typing import DefaultDict, Dict, List
 import common
-from investment import Investment, InvestmentsStats, InvestmentSplitLeverage
+from investment import Investment, InvestmentSplitLeverage, InvestmentsStats, get_default_cagr_thresholds, get_scalar_years, investment_from_batch_results
+import bootstrap
+import engine
+from instrumentation import (PHASE_DATA_LOAD, PHASE_DATE_LOOKUPS, PHASE_REPORT_FORMATTING, PHASE_RETURN_COMPUTATION, PHASE_STATS_AGGREGATION, PHASE_WINDOW_SAMPLING,
+                             Instrumentation, ProfileCapture, SimulationMetrics, get_instrumentation)
+import optimizer
+from portfolio import AlignedPanel, Portfolio, evaluate_portfolios, get_benchmark_portfolio
+from result_store import ResultStoreWriter
+from simulation_context import SimulationContext
+from window_cache import WindowResultCache, evaluate_windows_cached
 
 
-security_historical_data:List[DailyAssetData] = []
+security_historical_data:PriceSeries = None  # Data of the last load_data, only read by get_context when no context is given
+window_cache:WindowResultCache = None  # One cache shared by every context of the process, its results are keyed by data and settings (see window_cache.get_namespace)
 
 
 
@@ -69,120 +82,374 @@ class IncorrectUsage(Exception):
     pass
 
 
-def load_data(file_name = None):
-    common.dividend_cost_data.set_file_name(file_name)
-    with open(file_name) as csvfile:
-        reader = csv.reader(csvfile, delimiter=',')
-        header = next(reader)
-        previous_day = None
-        security_historical_data.clear()
-        for r in reader:
-            if common.should_break(r):
-                break
-            cur_day = DailyAssetData(r, previous_day)
-            security_historical_data.append(cur_day)
-            previous_day = cur_day
+def load_data(file_name = None, instrumentation:Instrumentation=None):
+    global security_historical_data
+    with get_instrumentation(instrumentation).phase(PHASE_DATA_LOAD):
+        common.dividend_cost_data.set_file_name(file_name)
+        security_historical_data = load_price_series(file_name, should_break=common.should_break, use_cache=common.USE_PARSE_CACHE)
+
+def get_context(context:SimulationContext=None) -> SimulationContext:
+    '''context, or without one a context of the loaded data (see load_data) and the settings in common as they are now.
+    Every function below takes a context, so simulations of different files and settings can run at once.'''
+    if context is not None:
+        return context
+    return SimulationContext(security_historical_data, common.dividend_cost_data.get_file_name(), common.SimulationConfig(), common.dividend_cost_data)
 
 #If we had invested the close amount of the security on the first day, using daily return percentages,
 # we should arrive at the security value today
 #Function throws an assertion error if this is not true
-def verify_correctness():
-    starting_investment = security_historical_data[0].close
+def verify_correctness(context:SimulationContext=None):
+    series = get_context(context).series
+    starting_investment = series.close[0]
     current_investment_amount = starting_investment
-    for daily_data in security_historical_data:
-        current_investment_amount *= 1 + daily_data.ratio_change
+    for ratio_change in series.ratio_change.tolist():
+        current_investment_amount *= 1 + ratio_change
         current_investment_amount = round(current_investment_amount, 2)
-    assert(current_investment_amount == security_historical_data[-1].close)
-
-
-def get_min_date_index(min_date:date=None):
+    assert(current_investment_amount == series.close[-1])
+
+def verify_rebalancing(num_windows=20, leverage_ratios=[1.5, 2.5], drift_band=.05, context:SimulationContext=None):
+    '''Checks that the split variants rebalanced monthly, quarterly, annually and at drift_band end every one of
+    num_windows random windows at the same value, to the cent, whether grown segment by segment (engine.evaluate_windows)
+    or day by day (engine.evaluate_window)'''
+    context = get_context(context)
+    rebalance_policies = [RebalancePolicy(REBALANCE_MONTHLY), RebalancePolicy(REBALANCE_QUARTERLY), RebalancePolicy(REBALANCE_ANNUAL), RebalancePolicy(drift_band=drift_band)]
+    leverage_variants = [leverage_variant for leverage_variant in engine.get_leverage_variants(leverage_ratios, True, rebalance_policies) if leverage_variant.is_rebalanced()]
+    start_indices, end_indices = choose_random_windows(num_windows, np.random.default_rng(0), context=context)
+    start_investment = context.config.starting_investment_amount
+    window_results = engine.evaluate_windows(context.series, start_indices, end_indices, leverage_variants, start_investment, False, index_data=context.index_data)
+    for window_index, (start_index, end_index) in enumerate(zip(start_indices.tolist(), end_indices.tolist())):
+        end_values = engine.evaluate_window(context.series, start_index, end_index, leverage_variants, start_investment, False, context.index_data).end_values[0]
+        assert(np.all(np.abs(window_results.end_values[window_index] - end_values) <= .01))
+
+
+def get_min_date_index(min_date:date=None, context:SimulationContext=None):
+    series = get_context(context).series
     if min_date is None:
         return 0
-    for index, day in enumerate(security_historical_data):
-        if day.date >= min_date:
-            return index
-    raise IncorrectUsage(f"You requested a minimum date of {min_date}, but the csv file's latest date is {day.date} which is before your minimum date.")
+    min_index = series.get_date_index().ceiling(min_date)
+    if min_index < len(series):
+        return min_index
+    raise IncorrectUsage(f"You requested a minimum date of {min_date}, but the csv file's latest date is {series.get_date(-1)} which is before your minimum date.")
 
-def get_max_date_index(max_date:date=None):
+def get_max_date_index(max_date:date=None, context:SimulationContext=None):
+    series = get_context(context).series
     if max_date is None:
-        return len(security_historical_data) - 1
-    for index, day in common.reversed_enumerate(security_historical_data):
-        if day.date <= max_date:
-            return index
-    raise IncorrectUsage(f"You requested a maximum date of {max_date}, but the csv file's earliest date is {day.date} which is after your maximum date.")
-
-def get_date_index(date:date=None):
-    def get_delta(needle_date, cur_date):
-        return (needle_date - cur_date).days ** 2
-
-    index_with_lowest_delta = 0
-    lowest_delta = get_delta(date, security_historical_data[0].date)
-    for index, day in enumerate(security_historical_data):
-        cur_delta = get_delta(date, day.date)
-        if cur_delta <= lowest_delta:
-            lowest_delta = cur_delta
-            index_with_lowest_delta = index
-    return index_with_lowest_delta
-
-def choose_random_date(min_date=None, max_date=None):
-    min_index = get_min_date_index(min_date)
-    max_index = get_max_date_index(max_date)
+        return len(series) - 1
+    max_index = series.get_date_index().floor(max_date)
+    if max_index >= 0:
+        return max_index
+    raise IncorrectUsage(f"You requested a maximum date of {max_date}, but the csv file's earliest date is {series.get_date(0)} which is after your maximum date.")
+
+def get_date_index(date:date=None, context:SimulationContext=None):
+    return get_context(context).series.get_date_index().nearest(date)
+
+def choose_random_date(min_date=None, max_date=None, rng=random, context:SimulationContext=None):
+    context = get_context(context)
+    min_index = get_min_date_index(min_date, context)
+    max_index = get_max_date_index(max_date, context)
         
     if min_index > max_index:
         raise IncorrectUsage("Your min_date must be before your max_date. If you're sure it is, your CSV must be sorted backwards.")
 
-    return random.randint(min_index, max_index)
-
-def choose_random_length(min_years=common.MIN_INVESTMENT_YEARS, max_years=common.MAX_INVESTMENT_YEARS):
-    return timedelta(days= random.randint(round(min_years*common.DAYS_PER_YEAR), round(max_years*common.DAYS_PER_YEAR)) )
+    return rng.randint(min_index, max_index)
+
+def choose_random_length(min_years=None, max_years=None, rng=random, context:SimulationContext=None):
+    '''min_years and max_years default to the ones of the context'''
+    config = get_context(context).config
+    min_years = config.min_investment_years if min_years is None else min_years
+    max_years = config.max_investment_years if max_years is None else max_years
+    return timedelta(days= rng.randint(round(min_years*common.DAYS_PER_YEAR), round(max_years*common.DAYS_PER_YEAR)) )
+
+def choose_random_window(rng=random, context:SimulationContext=None):
+    '''Returns the (start_index, end_index) of a random investment period. rng is the random module or a random.Random'''
+    context = get_context(context)
+    series = context.series
+    config = context.config
+    investment_length = choose_random_length(rng=rng, context=context) #Choose random length of time for investment
+    min_start_date = max( series.get_date(0), series.get_date(0) if config.minimum_start_year is None else datetime(config.minimum_start_year, 1, 1).date() ) #Determine the minimum start date for the investment
+    max_start_date = min( series.get_date(-1), series.get_date(-1) if config.maximum_end_year is None else datetime(config.maximum_end_year, 12, 31).date() ) - investment_length #Determine the maximum start date for the investment, which is the maximum start date minus the investment length
+    start_index = choose_random_date(min_date=min_start_date, max_date=max_start_date, rng=rng, context=context) #Get the index in series of a randomly chosen date between the minimum and maximum start date
+    end_date = series.get_date(start_index) + investment_length #The end date is simply the investment's start date plus the investment's length
+    end_index = get_date_index(end_date, context) #Get the index in series of the trading day that is closest to the end date
+    #print(f"{series.get_date(start_index)} to {end_date}")
+    return start_index, end_index
+
+def get_start_date_range(investment_lengths:np.ndarray, num_days:int=None, context:SimulationContext=None):
+    '''Returns the (minimum start date, maximum start dates) an investment of each length can have, as datetime64.
+    Only the first num_days days are considered if it is given.'''
+    context = get_context(context)
+    series = context.series
+    config = context.config
+    last_index = -1 if num_days is None else num_days - 1
+    min_start_date = max( series.get_date(0), series.get_date(0) if config.minimum_start_year is None else datetime(config.minimum_start_year, 1, 1).date() )
+    max_end_date = min( series.get_date(last_index), series.get_date(last_index) if config.maximum_end_year is None else datetime(config.maximum_end_year, 12, 31).date() )
+    return np.datetime64(min_start_date, "D"), np.datetime64(max_end_date, "D") - investment_lengths
+
+def choose_random_windows(num_times:int, rng:np.random.Generator, min_years=None, max_years=None, context:SimulationContext=None, instrumentation:Instrumentation=None):
+    '''Vectorized choose_random_window: returns arrays of num_times (start_index, end_index) drawn with a numpy Generator'''
+    context = get_context(context)
+    instrumentation = get_instrumentation(instrumentation)
+    min_years = context.config.min_investment_years if min_years is None else min_years
+    max_years = context.config.max_investment_years if max_years is None else max_years
+    date_index = context.series.get_date_index()
+    with instrumentation.phase(PHASE_WINDOW_SAMPLING):
+        investment_lengths = rng.integers(round(min_years*common.DAYS_PER_YEAR), round(max_years*common.DAYS_PER_YEAR), size=num_times, endpoint=True).astype("timedelta64[D]")
+    with instrumentation.phase(PHASE_DATE_LOOKUPS):
+        min_start_date, max_start_dates = get_start_date_range(investment_lengths, context=context)
+        min_index = get_min_date_index(min_start_date.item(), context)
+        max_indices = date_index.floor_indices(max_start_dates)
+    if num_times > 0 and max_indices.min() < min_index:
+        raise IncorrectUsage("Your min_date must be before your max_date. If you're sure it is, your CSV must be sorted backwards.")
 
+    with instrumentation.phase(PHASE_WINDOW_SAMPLING):
+        start_indices = rng.integers(min_index, max_indices, endpoint=True)
+    with instrumentation.phase(PHASE_DATE_LOOKUPS):
+        end_indices = date_index.nearest_indices(context.series.dates[start_indices] + investment_lengths)
+    return start_indices, end_indices
+
+def count_all_windows(min_years=None, max_years=None, num_days:int=None, context:SimulationContext=None):
+    '''Returns every investment length (timedelta64[D]) choose_random_window can draw, the first start index and the
+    number of start indices each of those lengths can have. Only the first num_days days are considered if it is given.'''
+    context = get_context(context)
+    min_years = context.config.min_investment_years if min_years is None else min_years
+    max_years = context.config.max_investment_years if max_years is None else max_years
+    investment_lengths = np.arange(round(min_years*common.DAYS_PER_YEAR), round(max_years*common.DAYS_PER_YEAR) + 1).astype("timedelta64[D]")
+    min_start_date, max_start_dates = get_start_date_range(investment_lengths, num_days, context)
+    min_index = get_min_date_index(min_start_date.item(), context)
+    num_start_indices = np.maximum(context.series.get_date_index().floor_indices(max_start_dates) - min_index + 1, 0)
+    return investment_lengths, min_index, num_start_indices
+
+def iterate_all_windows(chunk_size=engine.DEFAULT_CHUNK_SIZE, min_years=None, max_years=None, after_num_days:int=None, context:SimulationContext=None):
+    '''Yields (start_indices, end_indices) arrays of at most chunk_size windows, until every window choose_random_window
+    can draw has been yielded once: every valid start index for every investment length, ordered by length then start.
+    With after_num_days, only the windows that were not already possible with the first after_num_days days are yielded.
+    Those are the windows that end on or close to the days after them.'''
+    context = get_context(context)
+    date_index = context.series.get_date_index()
+    investment_lengths, min_index, num_start_indices = count_all_windows(min_years, max_years, context=context)
+    first_start_indices = np.full(len(investment_lengths), min_index)
+    if after_num_days is not None:
+        # Windows only end past the days they start on, so the earlier days still have every window they had, and the new ones come after them
+        first_start_indices = min_index + np.minimum(count_all_windows(min_years, max_years, after_num_days, context)[2], num_start_indices)
+        num_start_indices = num_start_indices - (first_start_indices - min_index)
+    length_offsets = np.concatenate(([0], np.cumsum(num_start_indices)))
+    for chunk_start in range(0, int(length_offsets[-1]), chunk_size):
+        window_positions = np.arange(chunk_start, min(chunk_start + chunk_size, int(length_offsets[-1])))
+        length_indexes = np.searchsorted(length_offsets, window_positions, side="right") - 1
+        start_indices = first_start_indices[length_indexes] + (window_positions - length_offsets[length_indexes])
+        end_indices = date_index.nearest_indices(context.series.dates[start_indices] + investment_lengths[length_indexes])
+        yield start_indices, end_indices
+
+
+def get_window_cache() -> WindowResultCache:
+    '''The cache shared by every simulation of this process, or None when common.USE_WINDOW_CACHE is off'''
+    global window_cache
+    if common.USE_WINDOW_CACHE and window_cache is None:
+        window_cache = WindowResultCache(common.WINDOW_CACHE_MAX_CELLS, common.WINDOW_CACHE_DIRECTORY)
+    return window_cache
 
 def hint_typed_dd() -> List[Investment]:
     return []
 
-def run_simulation(num_times=1000, leverage_ratios=[1.0, 2.0, 3.0]) -> DefaultDict[float, hint_typed_dd]:
+def simulate_windows(num_times=1000, leverage_ratios=[1.0, 2.0, 3.0], rng=random, print_progress:bool=None, context:SimulationContext=None,
+                     instrumentation:Instrumentation=None) -> engine.BatchResults:
+    '''Draws num_times random windows and simulates every leverage variant over each of them.
+    rng is the random module or a random.Random to draw one window at a time, or a numpy Generator to draw them all at once.
+    Windows drawn one at a time are timed as window sampling, date lookups included.'''
     if 1.0 not in leverage_ratios:
         leverage_ratios.append(1.0)
+    if print_progress is None:
+        print_progress = common.PRINT_PROGRESS
 
-    results_normal = defaultdict(hint_typed_dd)
+    context = get_context(context)
+    instrumentation = get_instrumentation(instrumentation)
+    config = context.config
+    leverage_variants = context.get_leverage_variants(leverage_ratios)
     progress_split_amount = 20
     progress_split_amount = progress_split_amount if (progress_split_amount <= num_times) else num_times
     progress_indexes = {ind:f"{ind_internal*(100/progress_split_amount)/100:.0%}" for ind_internal, ind in enumerate(range(0, num_times, num_times//progress_split_amount), 0)}
     progress_indexes[num_times-1] = f"{1:.0%}"
-    for i in range(num_times):
-        if common.PRINT_PROGRESS and i in progress_indexes:
-            print(f"{progress_indexes[i]} finished")
-        investment_length = choose_random_length() #Choose random length of time for investment
-        min_start_date = max( security_historical_data[0].date, security_historical_data[0].date if common.MINIMUM_START_YEAR is None else datetime(common.MINIMUM_START_YEAR, 1, 1).date() ) #Determine the minimum start date for the investment
-        max_start_date = min( security_historical_data[-1].date, security_historical_data[-1].date if common.MAXIMUM_END_YEAR is None else datetime(common.MAXIMUM_END_YEAR, 12, 31).date() ) - investment_length #Determine the maximum start date for the investment, which is the maximum start date minus the investment length
-        start_index = choose_random_date(min_date=min_start_date, max_date=max_start_date) #Get the index in security_historical_data of a randomly chosen date between the minimum and maximum start date
-        end_date = security_historical_data[start_index].date + investment_length #The end date is simply the investment's start date plus the investment's length
-        end_index = get_date_index(end_date) #Get the index in security_historical_data of the trading day that is closest to the end date
-
-        #print(f"{security_historical_data[start_index].date} to {end_date}")
-        for leverage_ratio in leverage_ratios:
-            if common.USE_REALISTIC_SPLIT_LEVERAGE:
-                split_leverage_2_ratio = InvestmentSplitLeverage(start_index, end_index, security_historical_data, leverage_ratio, 2.0)
-                split_leverage_3_ratio = InvestmentSplitLeverage(start_index, end_index, security_historical_data, leverage_ratio, 3.0)
-                split_leverage_2_3_ratio = InvestmentSplitLeverage(start_index, end_index, security_historical_data, leverage_ratio, 3.0, 2.0)
-                if leverage_ratio.is_integer() or not (split_leverage_2_ratio.can_split_weights()
-                                                    or split_leverage_3_ratio.can_split_weights()
-                                                    or split_leverage_2_3_ratio.can_split_weights()):
-                    cur_investment = Investment(start_index, end_index, security_historical_data, leverage_ratio).compute_return()
-                    results_normal[(leverage_ratio, cur_investment.get_leverage_ratio_str())].append(cur_investment)
-                if split_leverage_2_ratio.can_split_weights():
-                    split_leverage_2_ratio.compute_return()
-                    results_normal[(leverage_ratio, split_leverage_2_ratio.get_leverage_ratio_str())].append(split_leverage_2_ratio)
-                if split_leverage_3_ratio.can_split_weights():
-                    split_leverage_3_ratio.compute_return()
-                    results_normal[(leverage_ratio, split_leverage_3_ratio.get_leverage_ratio_str())].append(split_leverage_3_ratio)
-                if split_leverage_2_3_ratio.can_split_weights():
-                    split_leverage_2_3_ratio.compute_return()
-                    results_normal[(leverage_ratio, split_leverage_2_3_ratio.get_leverage_ratio_str())].append(split_leverage_2_3_ratio)
-
-            else:
-                cur_investment = Investment(start_index, end_index, security_historical_data, leverage_ratio).compute_return()
-                results_normal[(leverage_ratio, cur_investment.get_leverage_ratio_str())].append(cur_investment)
+    start_indices = []
+    end_indices = []
+    if isinstance(rng, np.random.Generator):
+        start_indices, end_indices = choose_random_windows(num_times, rng, context=context, instrumentation=instrumentation)
+    else:
+        with instrumentation.phase(PHASE_WINDOW_SAMPLING):
+            for i in range(num_times):
+                if print_progress and i in progress_indexes:
+                    print(f"{progress_indexes[i]} finished")
+                start_index, end_index = choose_random_window(rng, context)
+                start_indices.append(start_index)
+                end_indices.append(end_index)
+
+    #Every sampled window is simulated at every leverage at once, except the (window, leverage) results already cached
+    with instrumentation.phase(PHASE_RETURN_COMPUTATION):
+        if get_window_cache() is not None:
+            return evaluate_windows_cached(window_cache, context.series, start_indices, end_indices, leverage_variants, config.starting_investment_amount, config.round_to_cents_daily,
+                                           index_data=context.index_data)
+        return engine.evaluate_windows(context.series, start_indices, end_indices, leverage_variants, config.starting_investment_amount, config.round_to_cents_daily,
+                                       index_data=context.index_data)
+
+def run_simulation(num_times=1000, leverage_ratios=[1.0, 2.0, 3.0], rng=random, context:SimulationContext=None,
+                   instrumentation:Instrumentation=None) -> DefaultDict[float, hint_typed_dd]:
+    '''rng is the random module or a random.Random to draw one window at a time, or a numpy Generator to draw them all at once.
+    Simulates the loaded data with the settings in common, or everything in context if given.
+    Phase timings and progress are reported to instrumentation if given (see instrumentation.py).'''
+    context = get_context(context)
+    instrumentation = get_instrumentation(instrumentation)
+    window_results = simulate_windows(num_times, leverage_ratios, rng, context=context, instrumentation=instrumentation)
+    instrumentation.add_progress(window_results.num_windows(), len(window_results.leverage_variants), num_times)
+    with instrumentation.phase(PHASE_STATS_AGGREGATION):
+        return get_investment_results(window_results, context)
+
+def run_simulation_stats(num_times=1000, leverage_ratios=[1.0, 2.0, 3.0], rng=random, chunk_size=engine.DEFAULT_CHUNK_SIZE,
+                         result_store_writer:ResultStoreWriter=None, context:SimulationContext=None, instrumentation:Instrumentation=None) -> Dict[str, InvestmentsStats]:
+    '''Same simulation as run_simulation, but every chunk of chunk_size windows is folded into the stats of each leverage
+    ratio and dropped, so memory does not grow with num_times. Every chunk is also written to result_store_writer if given.'''
+    context = get_context(context)
+    instrumentation = get_instrumentation(instrumentation)
+    leverage_results = {}
+    for chunk_start in range(0, num_times, chunk_size):
+        window_results = simulate_windows(min(chunk_size, num_times - chunk_start), leverage_ratios, rng, print_progress=False, context=context, instrumentation=instrumentation)
+        if result_store_writer is not None:
+            result_store_writer.write(window_results)
+        with instrumentation.phase(PHASE_STATS_AGGREGATION):
+            fold_window_results(leverage_results, window_results)
+        instrumentation.add_progress(window_results.num_windows(), len(window_results.leverage_variants), num_times)
+        if common.PRINT_PROGRESS:
+            print(f"{min(chunk_start + chunk_size, num_times) / num_times:.0%} finished")
+    return leverage_results
+
+def run_all_windows_stats(leverage_ratios=[1.0, 2.0, 3.0], chunk_size=engine.DEFAULT_CHUNK_SIZE, leverage_results:Dict[str, InvestmentsStats]=None,
+                          after_num_days:int=None, prefix_tables:engine.PrefixTables=None, result_store_writer:ResultStoreWriter=None,
+                          context:SimulationContext=None, instrumentation:Instrumentation=None) -> Dict[str, InvestmentsStats]:
+    '''Exhaustive alternative to run_simulation_stats: instead of sampling random windows, simulates every window
+    (see iterate_all_windows) once, so the stats have no sampling noise.
+    With after_num_days, only the windows that the days after the first after_num_days added are simulated, and folded
+    into leverage_results, the stats of every window of those first days (see incremental.py).
+    Every chunk is also written to result_store_writer if given.'''
+    if 1.0 not in leverage_ratios:
+        leverage_ratios.append(1.0)
+    context = get_context(context)
+    instrumentation = get_instrumentation(instrumentation)
+    leverage_variants = context.get_leverage_variants(leverage_ratios)
+    if prefix_tables is None:
+        prefix_tables = engine.PrefixTables(context.series, engine.get_sleeve_leverages(leverage_variants), index_data=context.index_data)
+    num_windows = int(count_all_windows(context=context)[2].sum()) - (0 if after_num_days is None else int(count_all_windows(num_days=after_num_days, context=context)[2].sum()))
+    leverage_results = {} if leverage_results is None else leverage_results
+    for chunk_index, (start_indices, end_indices) in enumerate(iterate_all_windows(chunk_size, after_num_days=after_num_days, context=context)):
+        with instrumentation.phase(PHASE_RETURN_COMPUTATION):
+            window_results = engine.evaluate_windows(context.series, start_indices, end_indices, leverage_variants, context.config.starting_investment_amount,
+                                                     context.config.round_to_cents_daily, chunk_size, prefix_tables, context.index_data)
+        if result_store_writer is not None:
+            result_store_writer.write(window_results)
+        with instrumentation.phase(PHASE_STATS_AGGREGATION):
+            fold_window_results(leverage_results, window_results)
+        instrumentation.add_progress(window_results.num_windows(), len(leverage_variants), num_windows)
+        if common.PRINT_PROGRESS:
+            print(f"{min((chunk_index + 1) * chunk_size, num_windows) / num_windows:.0%} finished")
+    return leverage_results
+
+def load_panel(file_names:List[str]) -> AlignedPanel:
+    '''Loads every file into one AlignedPanel. The loaded data (see load_data) is left as it is, portfolios are simulated with get_panel_context'''
+    return AlignedPanel({file_name: load_price_series(file_name, should_break=common.should_break, use_cache=common.USE_PARSE_CACHE) for file_name in file_names})
+
+def get_panel_context(panel:AlignedPanel) -> SimulationContext:
+    '''The context windows of panel are drawn with: its common calendar, with the settings of its index data'''
+    return SimulationContext(panel.get_calendar_series(), None, panel.index_data.get_config(), panel.index_data)
+
+def run_portfolio_stats(panel:AlignedPanel, portfolios:List[Portfolio], num_times=1000, rng:np.random.Generator=None, chunk_size=engine.DEFAULT_CHUNK_SIZE,
+                        all_windows:bool=None, result_store_writer:ResultStoreWriter=None, context:SimulationContext=None,
+                        instrumentation:Instrumentation=None) -> Dict[str, InvestmentsStats]:
+    '''Multi-index alternative to run_simulation_stats: simulates every portfolio over num_times random windows (or every
+    window with all_windows) of the panel's common calendar, with the context of the panel (see get_panel_context) unless one is given.
+    The equal weight unleveraged portfolio of the panel's files is added as the 1.0 leverage ratio when no portfolio is unleveraged.'''
+    if all_windows is None:
+        all_windows = common.SIMULATE_ALL_WINDOWS
+    if rng is None:
+        rng = np.random.default_rng(common.RANDOM_SEED)
+    if 1.0 not in [portfolio.leverage_ratio for portfolio in portfolios]:
+        portfolios = portfolios + [get_benchmark_portfolio(panel.file_names)]
+    context = get_panel_context(panel) if context is None else context
+    instrumentation = get_instrumentation(instrumentation)
+    if all_windows:
+        num_times = int(count_all_windows(context=context)[2].sum())
+        windows = iterate_all_windows(chunk_size, context=context)
+    else:
+        windows = (choose_random_windows(min(chunk_size, num_times - chunk_start), rng, context=context, instrumentation=instrumentation)
+                   for chunk_start in range(0, num_times, chunk_size))
+    leverage_results = {}
+    for chunk_index, (start_indices, end_indices) in enumerate(windows):
+        with instrumentation.phase(PHASE_RETURN_COMPUTATION):
+            window_results = evaluate_portfolios(panel, start_indices, end_indices, portfolios, context.config.starting_investment_amount, chunk_size)
+        if result_store_writer is not None:
+            result_store_writer.write(window_results)
+        with instrumentation.phase(PHASE_STATS_AGGREGATION):
+            fold_window_results(leverage_results, window_results)
+        instrumentation.add_progress(window_results.num_windows(), len(portfolios), num_times)
+        if common.PRINT_PROGRESS:
+            print(f"{min((chunk_index + 1) * chunk_size, num_times) / num_times:.0%} finished")
+    return leverage_results
+
+def get_trading_days_per_year(context:SimulationContext=None) -> float:
+    series = get_context(context).series
+    return len(series) / ((series.dates[-1] - series.dates[0]).astype(np.int64) / common.DAYS_PER_YEAR)
+
+def run_bootstrap_stats(num_paths=1000, leverage_ratios=[1.0, 2.0, 3.0], rng:np.random.Generator=None, path_years=common.BOOTSTRAP_PATH_YEARS,
+                        mean_block_length=common.BOOTSTRAP_MEAN_BLOCK_LENGTH, regime_switching=common.BOOTSTRAP_REGIME_SWITCHING,
+                        chunk_size=engine.DEFAULT_CHUNK_SIZE // 64, result_store_writer:ResultStoreWriter=None, context:SimulationContext=None,
+                        instrumentation:Instrumentation=None) -> Dict[str, InvestmentsStats]:
+    '''Stress test alternative to run_simulation_stats: simulates num_paths synthetic paths of path_years, block bootstrapped
+    from the loaded history (see bootstrap.py), instead of historical windows. Tail risk, such as how often each leverage
+    ratio lost all its money, can be measured with far more paths than history has windows.
+    Every chunk of paths is also written to result_store_writer if given.'''
+    if 1.0 not in leverage_ratios:
+        leverage_ratios.append(1.0)
+    if rng is None:
+        rng = np.random.default_rng(common.RANDOM_SEED)
+    context = get_context(context)
+    instrumentation = get_instrumentation(instrumentation)
+    leverage_variants = context.get_leverage_variants(leverage_ratios)
+    path_length = round(path_years * get_trading_days_per_year(context))
+    leverage_results = {}
+    num_finished_paths = 0
+    bootstrap_results = bootstrap.iterate_bootstrap_results(context.series, num_paths, path_length, leverage_variants, rng, mean_block_length, regime_switching,
+                                                            context.config.starting_investment_amount, context.config.round_to_cents_daily, chunk_size,
+                                                            context.index_data)
+    while True:
+        # Every chunk of paths is resampled and simulated when the generator is advanced
+        with instrumentation.phase(PHASE_RETURN_COMPUTATION):
+            window_results = next(bootstrap_results, None)
+        if window_results is None:
+            break
+        if result_store_writer is not None:
+            result_store_writer.write(window_results)
+        with instrumentation.phase(PHASE_STATS_AGGREGATION):
+            fold_window_results(leverage_results, window_results)
+        instrumentation.add_progress(window_results.num_windows(), len(leverage_variants), num_paths)
+        num_finished_paths += window_results.num_windows()
+        if common.PRINT_PROGRESS:
+            print(f"{num_finished_paths / num_paths:.0%} finished")
+    return leverage_results
+
+def optimize_file_leverage(file_name, objective=optimizer.OBJECTIVE_MEAN_CAGR, percentile=50.0, num_times=None, rng=None,
+                           min_leverage=1.0, max_leverage=4.0, tolerance=optimizer.DEFAULT_TOLERANCE, context:SimulationContext=None) -> optimizer.OptimizationResult:
+    '''Best leverage ratio for file_name over every window (see iterate_all_windows), or over num_times random windows
+    drawn with the numpy Generator rng. file_name is loaded with the settings in common unless its context is given.'''
+    context = SimulationContext.load(file_name) if context is None else context
+    if num_times is None:
+        windows = list(iterate_all_windows(context=context))
+        start_indices = np.concatenate([start_indices for start_indices, end_indices in windows])
+        end_indices = np.concatenate([end_indices for start_indices, end_indices in windows])
+    else:
+        start_indices, end_indices = choose_random_windows(num_times, np.random.default_rng() if rng is None else rng, context=context)
+    return optimizer.optimize_leverage(context, start_indices, end_indices, objective, percentile, min_leverage, max_leverage, tolerance)
+
+def get_investment_results(window_results:engine.BatchResults, context:SimulationContext=None) -> DefaultDict[float, hint_typed_dd]:
+    results_normal = defaultdict(hint_typed_dd)
+    for window_index in range(window_results.num_windows()):
+        for variant_index, leverage_variant in enumerate(window_results.leverage_variants):
+            results_normal[(leverage_variant.leverage_ratio, leverage_variant.get_leverage_ratio_str())].append(investment_from_batch_results(window_results, window_index, variant_index, context))
     return results_normal
 
 def restructure_results(simulation_results:DefaultDict[float, hint_typed_dd]) -> List[List[Investment]]:
@@ -203,19 +470,64 @@ Original Investment: ${period_investment_results[0].start_investment:.2f}"""
     return result_text
 
 
+def get_results_matrix(simulation_results:DefaultDict[str, hint_typed_dd]) -> engine.BatchResults:
+    '''Period-aligned (periods x leverage ratios) view of the results of run_simulation. Every leverage ratio must have
+    been simulated over the same periods, in the same order.'''
+    investment_lists = list(simulation_results.values())
+    first_investments = investment_lists[0]
+    for investments in investment_lists:
+        if [(investment.start_index, investment.end_index) for investment in investments] != [(investment.start_index, investment.end_index) for investment in first_investments]:
+            raise IncorrectUsage(f"Leverage ratio {investments[0].get_leverage_ratio_str()} was not simulated over the same periods as leverage ratio {first_investments[0].get_leverage_ratio_str()}")
+    leverage_variants = [investments[0].get_leverage_variant() if isinstance(investments[0], InvestmentSplitLeverage) else engine.LeverageVariant(investments[0].leverage_ratio)
+                         for investments in investment_lists]
+    end_values = np.array([[investment.end_investment for investment in investments] for investments in investment_lists]).T.reshape(len(first_investments), len(investment_lists))
+    ruin_offsets = np.array([[investment.ruin_offset for investment in investments] for investments in investment_lists]).T.reshape(end_values.shape)
+    return engine.BatchResults(first_investments[0].security_historical_data if len(first_investments) > 0 else security_historical_data, leverage_variants,
+                               [investment.start_index for investment in first_investments], [investment.end_index for investment in first_investments],
+                               end_values, ruin_offsets, first_investments[0].start_investment if len(first_investments) > 0 else common.STARTING_INVESTMENT_AMOUNT)
+
+def fold_window_results(leverage_results:Dict[str, InvestmentsStats], window_results:engine.BatchResults, cagr_thresholds=None):
+    '''Folds every window of window_results into the stats of each leverage ratio, one column at a time.
+    "Was largest return" is the row-wise argmax of the returns and "returned more than 1.0" a comparison to the 1.0 column.
+    Investments that lost all their money are folded in like any other, worth 0, and counted with their ruin date.
+    Stats created here keep cagr_thresholds, by default those of get_default_cagr_thresholds.'''
+    leverage_variants = window_results.leverage_variants
+    total_dollar_returns = window_results.get_total_return_dollars()
+    total_return_ratios = window_results.get_total_return_ratios()
+    CAGR_ratios = window_results.get_CAGR_ratios()
+    largest_return_variant_indexes = total_dollar_returns.argmax(axis=1)
+    leverage_1_variant_index = [leverage_variant.leverage_ratio for leverage_variant in leverage_variants].index(1.0)
+    returned_more_than_1_ratio = total_dollar_returns > total_dollar_returns[:, leverage_1_variant_index, np.newaxis]
+    start_dates = window_results.get_start_dates()
+    end_dates = window_results.get_end_dates()
+    scalar_start_years = get_scalar_years(start_dates)
+    scalar_end_years = get_scalar_years(end_dates)
+    ruin_dates = window_results.get_ruin_dates()
+    cagr_thresholds = get_default_cagr_thresholds() if cagr_thresholds is None else cagr_thresholds
+    for variant_index, leverage_variant in enumerate(leverage_variants):
+        leverage_ratio_str = leverage_variant.get_leverage_ratio_str()
+        if leverage_ratio_str not in leverage_results:
+            leverage_results[leverage_ratio_str] = InvestmentsStats(leverage_variant.leverage_ratio, leverage_ratio_str, cagr_thresholds)
+        leverage_results[leverage_ratio_str].add_results(CAGR_ratios[:, variant_index], total_dollar_returns[:, variant_index], total_return_ratios[:, variant_index],
+                                                         largest_return_variant_indexes == variant_index, returned_more_than_1_ratio[:, variant_index], start_dates, end_dates,
+                                                         scalar_start_years, scalar_end_years, ruin_dates[:, variant_index])
+
+def merge_leverage_results(leverage_results:Dict[str, InvestmentsStats], other_leverage_results:Dict[str, InvestmentsStats]):
+    for leverage_ratio_str, other_stats in other_leverage_results.items():
+        if leverage_ratio_str in leverage_results:
+            leverage_results[leverage_ratio_str].merge(other_stats)
+        else:
+            leverage_results[leverage_ratio_str] = other_stats
+
+def get_leverage_results(simulation_results:DefaultDict[str, hint_typed_dd]) -> Dict[str, InvestmentsStats]:
+    leverage_results = {}
+    fold_window_results(leverage_results, get_results_matrix(simulation_results))
+    return leverage_results
+
 def get_results_str(simulation_results:DefaultDict[str, hint_typed_dd]) -> str:
-    leverage_results = {leverage_ratio_str:InvestmentsStats(leverage_ratio, leverage_ratio_str) for leverage_ratio, leverage_ratio_str in simulation_results}
-    restructured_results = restructure_results(simulation_results)
-    
-    for period_investment_results in restructured_results:
-        largest_return_ratio = max(period_investment_results, key=lambda x: x.total_return_dollars).get_leverage_ratio_str()
-        
-        for leverage_ratio_results in period_investment_results:
-            is_greater_than_1_ratio = leverage_ratio_results.total_return_dollars > list(filter(lambda x: x.leverage_ratio == 1.0, period_investment_results))[0].total_return_dollars
-            cur_leverage_ratio = leverage_ratio_results.get_leverage_ratio_str()
-            is_best_ratio = cur_leverage_ratio == largest_return_ratio
-            leverage_results[cur_leverage_ratio].add_investment_results(leverage_ratio_results, is_best_ratio, is_greater_than_1_ratio)
+    return get_leverage_results_str(get_leverage_results(simulation_results))
 
+def get_leverage_results_str(leverage_results:Dict[str, InvestmentsStats]) -> str:
     spreadsheet_formatted_result = InvestmentsStats.get_tab_printed_overview_headers(cagr_threshold=common.EXTRA_STAT_CAGR_THRESHOLD,
                                                                                      cagr_threshold_stats=common.PRINT_EXTRA_STATS_SPECIFIC_CAGR_THRESHOLD,
                                                                                      return_threshold_stats=common.PRINT_EXTRA_RETURN_THRESHOLD_STATS)
@@ -236,10 +548,10 @@ def get_results_str(simulation_results:DefaultDict[str, hint_typed_dd]) -> str:
         worst_return_info_text = f"Worst Overall return Info: \n{InvestmentsStats.get_tab_printed_invesment_headers()}"
         best_return_info_text = f"Best overall return Info: \n{InvestmentsStats.get_tab_printed_invesment_headers()}"
         for leverage_ratio, total_leverage_result in leverage_results.items():
-            best_cagr_text += "\n" + total_leverage_result.get_tab_printed_investment(total_leverage_result.best_CAGR_index())
-            worst_cagr_text +=  "\n" + total_leverage_result.get_tab_printed_investment( total_leverage_result.worst_CAGR_index())
-            worst_return_info_text +=  "\n" + total_leverage_result.get_tab_printed_investment( total_leverage_result.worst_return_index())
-            best_return_info_text +=  "\n" + total_leverage_result.get_tab_printed_investment( total_leverage_result.best_return_index())
+            best_cagr_text += "\n" + total_leverage_result.get_tab_printed_investment(total_leverage_result.best_CAGR_investment())
+            worst_cagr_text +=  "\n" + total_leverage_result.get_tab_printed_investment( total_leverage_result.worst_CAGR_investment())
+            worst_return_info_text +=  "\n" + total_leverage_result.get_tab_printed_investment( total_leverage_result.worst_return_investment())
+            best_return_info_text +=  "\n" + total_leverage_result.get_tab_printed_investment( total_leverage_result.best_return_investment())
         results_str += f"{best_cagr_text}\n\n{worst_cagr_text}\n\n{worst_return_info_text}\n\n{best_return_info_text}\n\n\n\n\n\n"
 
     return results_str
@@ -256,33 +568,73 @@ if __name__ == "__main__":
         with open(common.OUTPUT_FILE_NAME, "w") as f:
             pass
 
+    leverage_ratios = [1.0, 1.1, 1.2, 1.3, 1.4, 1.5, 1.6, 1.7, 1.8, 1.9, 2.0, 2.1, 2.2, 2.3, 2.4, 2.5, 2.6, 2.7, 2.8, 2.9, 3.0, 3.1, 3.2, 3.3, 3.4, 3.5, 3.6, 3.7, 3.8, 3.9, 4.0]
+    run_in_parallel = common.NUMBER_OF_WORKERS > 1 and not common.SIMULATE_ALL_WINDOWS and not common.SIMULATE_BOOTSTRAP_PATHS
+    run_incremental = common.SIMULATE_ALL_WINDOWS and common.INCREMENTAL_STATS and not common.SIMULATE_BOOTSTRAP_PATHS
+    if common.RESULT_STORE_DIRECTORY and (run_in_parallel or run_incremental):
+        raise IncorrectUsage("RESULT_STORE_DIRECTORY is only written by single process runs, not with NUMBER_OF_WORKERS > 1 or INCREMENTAL_STATS.")
+    profile_capture = ProfileCapture(common.PROFILE_MODE) if common.PROFILE_MODE else None
+    if profile_capture is not None:
+        profile_capture.start()
+    if run_in_parallel:
+        import parallel
+        parallel_metrics = SimulationMetrics() if common.COLLECT_METRICS else None
+        all_leverage_results = parallel.run_parallel_stats(common.file_names, num_times=common.NUMBER_OF_INVESTMENTS, leverage_ratios=leverage_ratios,
+                                                           master_seed=common.RANDOM_SEED, max_workers=common.NUMBER_OF_WORKERS, instrumentation=parallel_metrics)
+        if parallel_metrics is not None:
+            print(f"Metrics for the parallel run of every file: {parallel_metrics.get_report()}")
+    elif common.RANDOM_SEED is not None:
+        random.seed(common.RANDOM_SEED)
+
     for file_name in common.file_names:
         file_name_str = f"File: {file_name}"
         print(file_name_str)
-        load_data(file_name)
-        verify_correctness()
-        simulation_results = run_simulation(num_times=common.NUMBER_OF_INVESTMENTS, leverage_ratios=[1.0, 1.1, 1.2, 1.3, 1.4, 1.5, 1.6, 1.7, 1.8, 1.9, 2.0, 2.1, 2.2, 2.3, 2.4, 2.5, 2.6, 2.7, 2.8, 2.9, 3.0, 3.1, 3.2, 3.3, 3.4, 3.5, 3.6, 3.7, 3.8, 3.9, 4.0])
+        metrics = SimulationMetrics() if common.COLLECT_METRICS else None
+        with get_instrumentation(metrics).phase(PHASE_DATA_LOAD):
+            context = SimulationContext.load(file_name)
+        verify_correctness(context)
+        verify_rebalancing(context=context)
+        result_store_writer = None
+        if common.RESULT_STORE_DIRECTORY:
+            result_store_writer = ResultStoreWriter(os.path.join(common.RESULT_STORE_DIRECTORY, os.path.splitext(os.path.basename(file_name))[0]), file_name,
+                                                    context.get_leverage_variants(leverage_ratios), context.config.starting_investment_amount)
+        if common.SIMULATE_BOOTSTRAP_PATHS:
+            leverage_results = run_bootstrap_stats(num_paths=common.NUMBER_OF_INVESTMENTS, leverage_ratios=leverage_ratios, result_store_writer=result_store_writer,
+                                                   context=context, instrumentation=metrics)
+        elif run_incremental:
+            import incremental
+            leverage_results = incremental.run_incremental_stats(file_name, leverage_ratios=leverage_ratios, context=context, instrumentation=metrics)
+        elif common.SIMULATE_ALL_WINDOWS:
+            leverage_results = run_all_windows_stats(leverage_ratios=leverage_ratios, result_store_writer=result_store_writer, context=context, instrumentation=metrics)
+        elif run_in_parallel:
+            leverage_results = all_leverage_results[file_name]
+        else:
+            leverage_results = run_simulation_stats(num_times=common.NUMBER_OF_INVESTMENTS, leverage_ratios=leverage_ratios, result_store_writer=result_store_writer,
+                                                    context=context, instrumentation=metrics)
         
-        output_results(file_name_str + "\n" + get_results_str(simulation_results))
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
+        with get_instrumentation(metrics).phase(PHASE_REPORT_FORMATTING):
+            results_str = file_name_str + "\n" + get_leverage_results_str(leverage_results)
+        output_results(results_str)
+        if metrics is not None:
+            print(f"Metrics for {file_name}: {metrics.get_report()}")
+
+    if common.PORTFOLIOS:
+        portfolios = [Portfolio(sleeves) for sleeves in common.PORTFOLIOS]
+        panel_file_names = list(dict.fromkeys(file_name for portfolio in portfolios for file_name in portfolio.get_file_names()))
+        portfolios_str = f"Portfolios: {', '.join(panel_file_names)}"
+        print(portfolios_str)
+        metrics = SimulationMetrics() if common.COLLECT_METRICS else None
+        with get_instrumentation(metrics).phase(PHASE_DATA_LOAD):
+            panel = load_panel(panel_file_names)
+        leverage_results = run_portfolio_stats(panel, portfolios, num_times=common.NUMBER_OF_INVESTMENTS, instrumentation=metrics)
+        with get_instrumentation(metrics).phase(PHASE_REPORT_FORMATTING):
+            results_str = portfolios_str + "\n" + get_leverage_results_str(leverage_results)
+        output_results(results_str)
+        if metrics is not None:
+            print(f"Metrics for the portfolios: {metrics.get_report()}")
+
+    if window_cache is not None:
+        window_cache.flush()
+    if profile_capture is not None:
+        profile_capture.stop()
+        print(profile_capture.get_report())
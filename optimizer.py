@@ -0,0 +1,197 @@
+"""
+/* Copyright (C) William Lyles - All Rights Reserved
+ * Unauthorized copying of this file, via any medium is strictly prohibited
+ * Proprietary and confidential
+ * Written by William Lyles <willglyles@gmail.com>, January 4th, 2022
+ */
+ """
+import math
+from typing import Callable, Tuple
+import numpy as np
+
+from common import DAYS_PER_YEAR, KnownIndexMetaData
+import engine
+from simulation_context import SimulationContext
+
+OBJECTIVE_MEAN_CAGR = "mean_CAGR"
+OBJECTIVE_CAGR_PERCENTILE = "CAGR_percentile"  # The median when percentile is 50
+OBJECTIVE_BEAT_1_PROBABILITY = "beat_1.0_probability"  # Fraction of windows that end with more money than 1.0 leverage
+OBJECTIVES = [OBJECTIVE_MEAN_CAGR, OBJECTIVE_CAGR_PERCENTILE, OBJECTIVE_BEAT_1_PROBABILITY]
+
+DEFAULT_TOLERANCE = 1e-4  # Leverage ratios closer than this are not told apart
+GOLDEN_RATIO = (math.sqrt(5) - 1) / 2
+
+
+class OptimizationResult():
+    def __init__(self, objective: str, leverage_ratio: float, objective_value: float, num_evaluations: int):
+        self.objective = objective
+        self.leverage_ratio = leverage_ratio
+        self.objective_value = objective_value
+        self.num_evaluations = num_evaluations  # Each one simulates every window at one leverage ratio
+
+    def __str__(self):
+        return f"Best leverage ratio for {self.objective}: {self.leverage_ratio:.4f} ({self.objective_value:.4%}, found in {self.num_evaluations} evaluations)"
+
+
+class LeverageObjective():
+    '''An objective to maximize, as a function of the leverage ratio of a (not split) leveraged ETF held over a fixed set of
+    windows of the context's price data, charged and paid as its index data says.
+    Every evaluation simulates every window at once from prefix sums of log(1 + L*r), so it costs O(days + windows).'''
+    def __init__(self, context: SimulationContext, start_indices, end_indices, objective: str=OBJECTIVE_MEAN_CAGR, percentile: float=50.0):
+        if objective not in OBJECTIVES:
+            raise ValueError(f"Unknown objective {objective}, expected one of {OBJECTIVES}")
+        self.context = context
+        self.series = context.series
+        self.start_indices = np.asarray(start_indices, dtype=np.int64)
+        self.end_indices = np.asarray(end_indices, dtype=np.int64)
+        self.objective = objective
+        self.percentile = percentile
+        self.investment_years = (self.series.dates[self.end_indices] - self.series.dates[self.start_indices]).astype(np.int64) / DAYS_PER_YEAR
+        self.num_evaluations = 0
+        if objective == OBJECTIVE_BEAT_1_PROBABILITY:
+            self.leverage_1_log_growth = self.get_log_growth(1.0)[0]
+
+    def get_ruin_leverages(self, min_leverage: float, max_leverage: float) -> np.ndarray:
+        '''Sorted leverage ratios in (min_leverage, max_leverage] at which another day of the windows loses everything
+        (1 + L*r <= 0 from L = -1/r on). The objective jumps there, but is smooth in between.'''
+        if len(self.start_indices) == 0:
+            return np.zeros(0)
+        ratio_changes = self.series.ratio_change[self.start_indices.min():self.end_indices.max()+1]
+        ratio_changes = ratio_changes[ratio_changes < -1 / max_leverage]
+        ruin_leverages = np.unique(-1 / ratio_changes)
+        return ruin_leverages[(ruin_leverages > min_leverage) & (ruin_leverages <= max_leverage)]
+
+    def has_gradient(self) -> bool:
+        return self.objective == OBJECTIVE_MEAN_CAGR
+
+    def get_log_growth(self, leverage_ratio: float, with_gradient: bool=False) -> Tuple[np.ndarray, np.ndarray]:
+        '''Log of the growth of every window (-inf if the ETF lost everything), and its derivative with respect to the
+        leverage ratio, sum(r / (1 + L*r)), if with_gradient. The yearly charges/dividends only change at the known
+        leverage ratios, so they add nothing to the derivative.'''
+        self.num_evaluations += 1
+        # The adjustment table is built for this leverage only and not cached on the series, since every evaluation uses a new leverage
+        prefix_tables = engine.PrefixTables(self.series, [leverage_ratio], engine.AnnualAdjustmentTable(self.series, [leverage_ratio], self.context.index_data),
+                                            index_data=self.context.index_data)
+        log_growth = prefix_tables.get_log_growth(self.start_indices, self.end_indices)[:, 0]
+        log_growth[prefix_tables.get_ruin_offsets(self.start_indices, self.end_indices)[:, 0] >= 0] = -np.inf
+        if not with_gradient:
+            return log_growth, None
+        daily_growth = 1 + (leverage_ratio * self.series.ratio_change)
+        daily_gradients = np.where(daily_growth > 0.0, self.series.ratio_change / np.where(daily_growth > 0.0, daily_growth, 1.0), 0.0)
+        gradient_prefix = np.concatenate(([0.0], np.cumsum(daily_gradients)))
+        return log_growth, gradient_prefix[self.end_indices + 1] - gradient_prefix[self.start_indices]
+
+    def get_value(self, leverage_ratio: float) -> float:
+        log_growth, log_growth_gradient = self.get_log_growth(leverage_ratio)
+        if self.objective == OBJECTIVE_BEAT_1_PROBABILITY:
+            return float(np.mean(log_growth > self.leverage_1_log_growth))
+        CAGR_ratios = np.exp(log_growth / self.investment_years) - 1
+        if self.objective == OBJECTIVE_CAGR_PERCENTILE:
+            return float(np.percentile(CAGR_ratios, self.percentile))
+        return float(np.mean(CAGR_ratios))
+
+    def get_gradient(self, leverage_ratio: float) -> float:
+        '''Derivative of the mean CAGR with respect to the leverage ratio: mean(CAGR growth * sum(r / (1 + L*r)) / years)'''
+        log_growth, log_growth_gradient = self.get_log_growth(leverage_ratio, with_gradient=True)
+        CAGR_growth = np.exp(log_growth / self.investment_years)  # 0 for ruined windows, which stay ruined nearby
+        return float(np.mean(CAGR_growth * log_growth_gradient / self.investment_years))
+
+
+def golden_section_search(function: Callable[[float], float], low: float, high: float, tolerance: float=DEFAULT_TOLERANCE) -> float:
+    '''x in [low, high] maximizing a unimodal function, to within tolerance'''
+    middle_low = high - GOLDEN_RATIO * (high - low)
+    middle_high = low + GOLDEN_RATIO * (high - low)
+    value_low = function(middle_low)
+    value_high = function(middle_high)
+    while high - low > tolerance:
+        if value_low >= value_high:
+            high, middle_high, value_high = middle_high, middle_low, value_low
+            middle_low = high - GOLDEN_RATIO * (high - low)
+            value_low = function(middle_low)
+        else:
+            low, middle_low, value_low = middle_low, middle_high, value_high
+            middle_high = low + GOLDEN_RATIO * (high - low)
+            value_high = function(middle_high)
+    return (low + high) / 2
+
+
+def brent_root(function: Callable[[float], float], low: float, high: float, tolerance: float=DEFAULT_TOLERANCE,
+               value_low: float=None, value_high: float=None) -> float:
+    '''Brent's method: x in [low, high] where function(x) == 0, to within tolerance. function(low) and function(high)
+    must have opposite signs. Inverse quadratic interpolation and secant steps, falling back to bisection.'''
+    a, b = low, high
+    value_a = function(a) if value_low is None else value_low
+    value_b = function(b) if value_high is None else value_high
+    if value_a * value_b > 0:
+        raise ValueError(f"The function must change sign between {low} and {high}")
+    if abs(value_a) < abs(value_b):
+        a, b, value_a, value_b = b, a, value_b, value_a
+    c, value_c = a, value_a
+    d = e = b - a
+    while True:
+        if value_b == 0:
+            return b
+        if value_a * value_b > 0:
+            a, value_a = c, value_c
+            d = e = b - c
+        if abs(value_a) < abs(value_b):
+            c, value_c = b, value_b
+            b, value_b = a, value_a
+            a, value_a = c, value_c
+        step_tolerance = 2 * np.finfo(float).eps * abs(b) + tolerance / 2
+        midpoint_step = (a - b) / 2
+        if abs(midpoint_step) <= step_tolerance:
+            return b
+        if abs(e) >= step_tolerance and abs(value_c) > abs(value_b):
+            s = value_b / value_c
+            if a == c:
+                p = 2 * midpoint_step * s
+                q = 1 - s
+            else:
+                q = value_c / value_a
+                r = value_b / value_a
+                p = s * (2 * midpoint_step * q * (q - r) - (b - c) * (r - 1))
+                q = (q - 1) * (r - 1) * (s - 1)
+            if p > 0:
+                q = -q
+            p = abs(p)
+            if 2 * p < min(3 * midpoint_step * q - abs(step_tolerance * q), abs(e * q)):
+                e, d = d, p / q
+            else:
+                d = e = midpoint_step
+        else:
+            d = e = midpoint_step
+        c, value_c = b, value_b
+        b += d if abs(d) > step_tolerance else math.copysign(step_tolerance, midpoint_step)
+        value_b = function(b)
+
+
+def _optimize_segment(leverage_objective: LeverageObjective, low: float, high: float, tolerance: float) -> float:
+    if leverage_objective.has_gradient():
+        gradient_low = leverage_objective.get_gradient(low)
+        gradient_high = leverage_objective.get_gradient(high)
+        if gradient_low <= 0.0:
+            return low
+        if gradient_high >= 0.0:
+            return high
+        return brent_root(leverage_objective.get_gradient, low, high, tolerance, gradient_low, gradient_high)
+    return golden_section_search(leverage_objective.get_value, low, high, tolerance)
+
+
+def optimize_leverage(context: SimulationContext, start_indices, end_indices, objective: str=OBJECTIVE_MEAN_CAGR, percentile: float=50.0,
+                      min_leverage: float=1.0, max_leverage: float=4.0, tolerance: float=DEFAULT_TOLERANCE) -> OptimizationResult:
+    '''Finds the leverage ratio between min_leverage and max_leverage that maximizes the objective over the given windows.
+    The range is split wherever more windows lose everything, and the objective is assumed to have a single peak in
+    each piece. The mean CAGR is maximized by finding the root of its analytic derivative with Brent's method; other
+    objectives, which have no useful derivative, by golden-section search. The known leverage ratios of real ETFs are
+    compared too, since their charges/dividends differ from every leverage ratio around them.'''
+    leverage_objective = LeverageObjective(context, start_indices, end_indices, objective, percentile)
+    segment_bounds = [min_leverage] + leverage_objective.get_ruin_leverages(min_leverage, max_leverage).tolist()
+    candidate_leverage_ratios = [known_leverage for known_leverage in KnownIndexMetaData.KNOWN_LEVERAGES if min_leverage <= known_leverage <= max_leverage]
+    for segment_index, low in enumerate(segment_bounds):
+        # Every piece but the last stops right before the next ruin leverage
+        high = max_leverage if segment_index == len(segment_bounds) - 1 else float(np.nextafter(segment_bounds[segment_index + 1], low))
+        candidate_leverage_ratios.append(_optimize_segment(leverage_objective, low, high, tolerance))
+    candidate_values = [leverage_objective.get_value(candidate_leverage_ratio) for candidate_leverage_ratio in candidate_leverage_ratios]
+    best_index = int(np.argmax(candidate_values))
+    return OptimizationResult(objective, candidate_leverage_ratios[best_index], candidate_values[best_index], leverage_objective.num_evaluations)
@@ -0,0 +1,215 @@
+"""
+/* Copyright (C) William Lyles - All Rights Reserved
+ * Unauthorized copying of this file, via any medium is strictly prohibited
+ * Proprietary and confidential
+ * Written by William Lyles <willglyles@gmail.com>, January 4th, 2022
+ */
+ """
+from concurrent.futures import Future, ProcessPoolExecutor, as_completed
+import os
+import tempfile
+from typing import DefaultDict, Dict, List
+import numpy as np
+
+from asset_data import PriceSeries
+from price_cache import load_price_series
+import common
+from common import SimulationConfig
+import engine
+from instrumentation import PHASE_DATA_LOAD, PHASE_STATS_AGGREGATION, Instrumentation, get_instrumentation
+from investment import InvestmentsStats, get_default_cagr_thresholds
+import main
+import shared_series
+from simulation_context import SimulationContext
+
+DEFAULT_BATCH_SIZE = 1000  # Samples per task. Results only depend on the batch size and seed, never on the number of workers
+
+# How workers get the price arrays
+SHARE_WITH_SHARED_MEMORY = "shared_memory"  # Attach read-only to one multiprocessing.shared_memory block per file
+SHARE_WITH_MEMMAP = "memmap"  # Memory map .npy files written once to a directory
+SHARE_WITH_PICKLE = "pickle"  # Copy the arrays into every worker once, when it starts
+
+_worker_series: Dict[str, PriceSeries] = {}
+_worker_prefix_tables: Dict[tuple, engine.PrefixTables] = {}
+_worker_contexts: Dict[str, SimulationContext] = {}
+_worker_config: SimulationConfig = None
+_worker_cagr_thresholds: tuple = None
+
+
+def get_batch_rng(master_seed: int, file_index: int, batch_index: int) -> np.random.Generator:
+    '''Independent random number generator for one batch of samples of one file, derived only from the master seed
+    and the batch's position, so every batch draws the same windows no matter which worker runs it'''
+    return np.random.default_rng(np.random.SeedSequence(master_seed, spawn_key=(file_index, batch_index)))
+
+def get_batch_sizes(num_times: int, batch_size: int) -> List[int]:
+    return [min(batch_size, num_times - batch_start) for batch_start in range(0, num_times, batch_size)]
+
+
+def _init_worker(price_data_by_file_name: dict, price_data_sharing: str, config: SimulationConfig, cagr_thresholds: tuple):
+    # Runs once per worker process, so the price arrays are handed over once instead of with every task.
+    # The parent's config is used, not the worker's own common, which a spawned worker imports afresh.
+    global _worker_config, _worker_cagr_thresholds
+    _worker_config = config
+    _worker_cagr_thresholds = cagr_thresholds
+    for file_name, price_data in price_data_by_file_name.items():
+        if price_data_sharing == SHARE_WITH_SHARED_MEMORY:
+            _worker_series[file_name] = shared_series.attach_price_series(price_data)
+        elif price_data_sharing == SHARE_WITH_MEMMAP:
+            _worker_series[file_name] = shared_series.load_memmap_series(price_data)
+        else:
+            _worker_series[file_name] = price_data
+
+def _simulate_batch_windows(file_name: str, file_index: int, batch_index: int, num_times: int, leverage_ratios: List[float], master_seed: int) -> engine.BatchResults:
+    if file_name not in _worker_contexts:
+        _worker_contexts[file_name] = SimulationContext(_worker_series[file_name], file_name, _worker_config)
+    context = _worker_contexts[file_name]
+    rng = get_batch_rng(master_seed, file_index, batch_index)
+    start_indices, end_indices = main.choose_random_windows(num_times, rng, context=context)
+    leverage_variants = context.get_leverage_variants(leverage_ratios)
+    sleeve_leverages = engine.get_sleeve_leverages(leverage_variants)
+    prefix_tables_key = (file_name, tuple(sleeve_leverages))
+    if prefix_tables_key not in _worker_prefix_tables:
+        _worker_prefix_tables[prefix_tables_key] = engine.PrefixTables(context.series, sleeve_leverages, index_data=context.index_data)
+    return engine.evaluate_windows(context.series, start_indices, end_indices, leverage_variants, context.config.starting_investment_amount, context.config.round_to_cents_daily,
+                                   prefix_tables=_worker_prefix_tables[prefix_tables_key], index_data=context.index_data)
+
+def _simulate_batch(file_name: str, file_index: int, batch_index: int, num_times: int, leverage_ratios: List[float], master_seed: int):
+    window_results = _simulate_batch_windows(file_name, file_index, batch_index, num_times, leverage_ratios, master_seed)
+    # Only the small result arrays travel back to the parent process
+    return window_results.start_indices, window_results.end_indices, window_results.end_values, window_results.ruin_offsets
+
+
+def _simulate_batch_stats(file_name: str, file_index: int, batch_index: int, num_times: int, leverage_ratios: List[float], master_seed: int) -> Dict[str, InvestmentsStats]:
+    leverage_results = {}
+    # Only the stats, whose size does not depend on num_times, travel back to the parent process
+    main.fold_window_results(leverage_results, _simulate_batch_windows(file_name, file_index, batch_index, num_times, leverage_ratios, master_seed),
+                             _worker_cagr_thresholds)
+    return leverage_results
+
+
+class _PriceDataSharing():
+    '''Hands the parsed price series over to worker processes as chosen by price_data_sharing, and frees them on exit'''
+    def __init__(self, series_by_file_name: Dict[str, PriceSeries], price_data_sharing: str, memmap_directory: str=None):
+        self._shared_price_series = []
+        self._temporary_directory = None
+        if price_data_sharing == SHARE_WITH_SHARED_MEMORY:
+            self._shared_price_series = [shared_series.SharedPriceSeries(series) for series in series_by_file_name.values()]
+            self.price_data_by_file_name = {file_name: shared.handle for file_name, shared in zip(series_by_file_name, self._shared_price_series)}
+        elif price_data_sharing == SHARE_WITH_MEMMAP:
+            if memmap_directory is None:
+                self._temporary_directory = tempfile.TemporaryDirectory()
+                memmap_directory = self._temporary_directory.name
+            self.price_data_by_file_name = {file_name: os.path.join(memmap_directory, os.path.basename(file_name)) for file_name in series_by_file_name}
+            for file_name, series in series_by_file_name.items():
+                shared_series.save_memmap_series(series, self.price_data_by_file_name[file_name])
+        else:
+            self.price_data_by_file_name = series_by_file_name
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        for shared in self._shared_price_series:
+            shared.close()
+        if self._temporary_directory is not None:
+            self._temporary_directory.cleanup()
+
+
+def _load_series_by_file_name(file_names: List[str], instrumentation: Instrumentation) -> Dict[str, PriceSeries]:
+    with instrumentation.phase(PHASE_DATA_LOAD):
+        return {file_name: load_price_series(file_name, should_break=common.should_break, use_cache=common.USE_PARSE_CACHE) for file_name in file_names}
+
+def _create_executor(sharing: _PriceDataSharing, price_data_sharing: str, config: SimulationConfig, max_workers: int) -> ProcessPoolExecutor:
+    return ProcessPoolExecutor(max_workers=max_workers, initializer=_init_worker,
+                               initargs=(sharing.price_data_by_file_name, price_data_sharing, config, get_default_cagr_thresholds()))
+
+def _submit_batches(executor: ProcessPoolExecutor, batch_function, file_names: List[str], num_times: int, leverage_ratios: List[float], master_seed: int, batch_size: int):
+    '''{file name: futures of every batch of that file, in batch order}'''
+    return {file_name: [executor.submit(batch_function, file_name, file_index, batch_index, batch_num_times, leverage_ratios, master_seed)
+                        for batch_index, batch_num_times in enumerate(get_batch_sizes(num_times, batch_size))]
+            for file_index, file_name in enumerate(file_names)}
+
+def _wait_for_batches(futures: Dict[str, List[Future]], num_times: int, batch_size: int, num_variants: int, instrumentation: Instrumentation):
+    '''Adds the progress of every batch as soon as it finishes, in whatever order the workers finish them'''
+    batch_sizes = get_batch_sizes(num_times, batch_size)
+    batch_futures = {future: batch_sizes[batch_index] for file_futures in futures.values() for batch_index, future in enumerate(file_futures)}
+    total_windows = num_times * len(futures)
+    num_finished_windows = 0
+    for future in as_completed(batch_futures):
+        instrumentation.add_progress(batch_futures[future], num_variants, total_windows)
+        num_finished_windows += batch_futures[future]
+        if common.PRINT_PROGRESS:
+            print(f"{num_finished_windows / total_windows:.0%} finished")
+
+
+def run_parallel_simulations(file_names: List[str], num_times=1000, leverage_ratios=[1.0, 2.0, 3.0], master_seed: int=None, max_workers: int=None,
+                             batch_size: int=DEFAULT_BATCH_SIZE, price_data_sharing: str=SHARE_WITH_SHARED_MEMORY, memmap_directory: str=None,
+                             config: SimulationConfig=None, instrumentation: Instrumentation=None) -> Dict[str, engine.BatchResults]:
+    '''Runs num_times random samples for every file, spreading batches of samples for all files over a process pool.
+    For a given master_seed, results are identical whatever max_workers is. A random master seed is used if none is given.
+    Every CSV is parsed once, here, and workers reach the parsed arrays as chosen by price_data_sharing.
+    memmap_directory keeps the memory mapped files between runs; a temporary directory is used if it is not given.
+    Every file is simulated with config, by default the settings in common as they are when this is called.
+    instrumentation is given the progress of every batch as it finishes.'''
+    if 1.0 not in leverage_ratios:
+        leverage_ratios = leverage_ratios + [1.0]
+    if master_seed is None:
+        master_seed = np.random.SeedSequence().entropy
+    config = SimulationConfig() if config is None else config
+    instrumentation = get_instrumentation(instrumentation)
+    series_by_file_name = _load_series_by_file_name(file_names, instrumentation)
+    # The same variants the workers simulate, rebalance policy included
+    leverage_variants_by_file_name = {file_name: SimulationContext(series, file_name, config).get_leverage_variants(leverage_ratios)
+                                      for file_name, series in series_by_file_name.items()}
+
+    with _PriceDataSharing(series_by_file_name, price_data_sharing, memmap_directory) as sharing:
+        with _create_executor(sharing, price_data_sharing, config, max_workers) as executor:
+            futures = _submit_batches(executor, _simulate_batch, file_names, num_times, leverage_ratios, master_seed, batch_size)
+            _wait_for_batches(futures, num_times, batch_size, len(leverage_variants_by_file_name[file_names[0]]) if file_names else 0, instrumentation)
+            simulation_results = {}
+            for file_name, file_futures in futures.items():
+                series = series_by_file_name[file_name]
+                leverage_variants = leverage_variants_by_file_name[file_name]
+                batches = [engine.BatchResults(series, leverage_variants, *future.result(), config.starting_investment_amount) for future in file_futures]
+                simulation_results[file_name] = engine.concatenate_batch_results(series, leverage_variants, batches, config.starting_investment_amount)
+    return simulation_results
+
+
+def run_parallel_stats(file_names: List[str], num_times=1000, leverage_ratios=[1.0, 2.0, 3.0], master_seed: int=None, max_workers: int=None,
+                       batch_size: int=DEFAULT_BATCH_SIZE, price_data_sharing: str=SHARE_WITH_SHARED_MEMORY, memmap_directory: str=None,
+                       config: SimulationConfig=None, instrumentation: Instrumentation=None) -> Dict[str, Dict[str, InvestmentsStats]]:
+    '''Same samples as run_parallel_simulations, but every worker folds its batch into InvestmentsStats, which are merged
+    here in batch order once every batch is done. Neither the workers nor this process ever hold more than one batch of investments.'''
+    if 1.0 not in leverage_ratios:
+        leverage_ratios = leverage_ratios + [1.0]
+    if master_seed is None:
+        master_seed = np.random.SeedSequence().entropy
+    config = SimulationConfig() if config is None else config
+    instrumentation = get_instrumentation(instrumentation)
+    series_by_file_name = _load_series_by_file_name(file_names, instrumentation)
+    num_variants = len(SimulationContext(series_by_file_name[file_names[0]], file_names[0], config).get_leverage_variants(leverage_ratios)) if file_names else 0
+
+    with _PriceDataSharing(series_by_file_name, price_data_sharing, memmap_directory) as sharing:
+        with _create_executor(sharing, price_data_sharing, config, max_workers) as executor:
+            futures = _submit_batches(executor, _simulate_batch_stats, file_names, num_times, leverage_ratios, master_seed, batch_size)
+            _wait_for_batches(futures, num_times, batch_size, num_variants, instrumentation)
+            all_leverage_results = {}
+            with instrumentation.phase(PHASE_STATS_AGGREGATION):
+                for file_name, file_futures in futures.items():
+                    all_leverage_results[file_name] = {}
+                    for future in file_futures:
+                        main.merge_leverage_results(all_leverage_results[file_name], future.result())
+    return all_leverage_results
+
+
+def run_parallel_investment_simulations(file_names: List[str], num_times=1000, leverage_ratios=[1.0, 2.0, 3.0], master_seed: int=None, max_workers: int=None,
+                                        batch_size: int=DEFAULT_BATCH_SIZE, price_data_sharing: str=SHARE_WITH_SHARED_MEMORY,
+                                        config: SimulationConfig=None, instrumentation: Instrumentation=None) -> Dict[str, DefaultDict[float, main.hint_typed_dd]]:
+    '''Same as run_parallel_simulations, but in the format returned by main.run_simulation'''
+    config = SimulationConfig() if config is None else config
+    simulation_results = run_parallel_simulations(file_names, num_times, leverage_ratios, master_seed, max_workers, batch_size, price_data_sharing, config=config,
+                                                  instrumentation=instrumentation)
+    investment_results = {}
+    for file_name, window_results in simulation_results.items():
+        investment_results[file_name] = main.get_investment_results(window_results, SimulationContext(window_results.series, file_name, config))
+    return investment_results
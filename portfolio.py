@@ -0,0 +1,131 @@
+"""
+/* Copyright (C) William Lyles - All Rights Reserved
+ * Unauthorized copying of this file, via any medium is strictly prohibited
+ * Proprietary and confidential
+ * Written by William Lyles <willglyles@gmail.com>, January 4th, 2022
+ */
+ """
+from functools import reduce
+from typing import Dict, List, Tuple
+import numpy as np
+
+from asset_data import PriceSeries
+from common import KnownIndexMetaData, SimulationConfig, dividend_cost_data
+import engine
+
+
+class AlignedPanel():
+    '''Several price series (by file name) restricted to their common trading calendar, the days every one of them
+    traded. Daily changes are recomputed from the aligned closes, so a day another index did not trade is folded
+    into the next common day. Built once, with the PrefixTables of every (file, leverages) kept for every window and
+    portfolio simulated over it. Charges and dividends follow the config of index_data (by default dividend_cost_data).'''
+    def __init__(self, series_by_file_name: Dict[str, PriceSeries], index_data: KnownIndexMetaData=None):
+        if len(series_by_file_name) == 0:
+            raise ValueError("A panel needs at least one price series")
+        self.file_names = list(series_by_file_name)
+        self.dates = reduce(np.intersect1d, [series.dates for series in series_by_file_name.values()])
+        self.series: Dict[str, PriceSeries] = {}
+        for file_name, series in series_by_file_name.items():
+            # Every common date is in every series, so searchsorted finds it exactly
+            indices = np.searchsorted(series.dates, self.dates)
+            self.series[file_name] = PriceSeries(self.dates, series.open[indices], series.high[indices], series.low[indices], series.close[indices], series.volume[indices])
+        self.index_data = dividend_cost_data if index_data is None else index_data
+        self._prefix_tables: Dict[tuple, engine.PrefixTables] = {}
+
+    def __len__(self):
+        return len(self.dates)
+
+    def get_calendar_series(self) -> PriceSeries:
+        '''A series on the common calendar, to draw windows from and date results with'''
+        return self.series[self.file_names[0]]
+
+    def get_prefix_tables(self, file_name: str, leverages) -> engine.PrefixTables:
+        '''PrefixTables of one aligned series, with the dividends and charges of its own file'''
+        key = (file_name, tuple(float(leverage) for leverage in leverages))
+        if key not in self._prefix_tables:
+            self._prefix_tables[key] = engine.PrefixTables(self.series[file_name], key[1], index_data=self.index_data.for_file(file_name))
+        return self._prefix_tables[key]
+
+
+class Portfolio():
+    '''Leveraged sleeves across indexes, given as (file name, leverage, weight), bought once and left to drift.
+    leverage_ratio is the weighted leverage of the sleeves. A sleeve that loses everything is worth nothing, and the
+    portfolio only loses all its money once every sleeve has.'''
+    def __init__(self, sleeves: List[Tuple[str, float, float]], name: str=None):
+        if len(sleeves) == 0:
+            raise ValueError("A portfolio needs at least one sleeve")
+        if abs(sum(weight for file_name, leverage, weight in sleeves) - 1.0) > 1e-8:
+            raise ValueError(f"The weights of a portfolio must add up to 1, not {sum(weight for file_name, leverage, weight in sleeves)}")
+        self.sleeves = [(file_name, float(leverage), float(weight)) for file_name, leverage, weight in sleeves]
+        self.name = name
+        self.leverage_ratio = round(sum(leverage * weight for file_name, leverage, weight in self.sleeves), 8)
+
+    def is_split(self) -> bool:
+        return False
+
+    def get_file_names(self) -> List[str]:
+        return [file_name for file_name, leverage, weight in self.sleeves]
+
+    def get_sleeve_investments(self, start_investment: float) -> List[Tuple[str, float, float]]:
+        '''(file name, leverage, amount invested) of each sleeve. Each sleeve is bought with whole cents.'''
+        return [(file_name, leverage, round(start_investment * weight, 2)) for file_name, leverage, weight in self.sleeves]
+
+    def get_leverage_ratio_str(self) -> str:
+        if self.name is not None:
+            return self.name
+        return ", ".join(f"{weight:.1%} {leverage} {file_name}" for file_name, leverage, weight in self.sleeves)
+
+    def __str__(self):
+        return self.get_leverage_ratio_str()
+
+    def __repr__(self):
+        return str(self)
+
+
+def get_benchmark_portfolio(file_names: List[str]) -> Portfolio:
+    '''Every index held unleveraged in equal parts, the 1.0 leverage every portfolio is compared against'''
+    return Portfolio([(file_name, 1.0, 1 / len(file_names)) for file_name in file_names])
+
+
+def evaluate_portfolios(panel: AlignedPanel, start_indices, end_indices, portfolios: List[Portfolio], start_investment: float=None,
+                        chunk_size: int=engine.DEFAULT_CHUNK_SIZE) -> engine.BatchResults:
+    '''Simulates every portfolio over every (start_indices[i], end_indices[i]) window of the panel's calendar in one
+    batched pass: the growth of every distinct (file, leverage) sleeve is read from the panel's prefix tables, and
+    the end values of every portfolio are one (windows x sleeves) @ (sleeves x portfolios) product.'''
+    start_investment = SimulationConfig().starting_investment_amount if start_investment is None else start_investment
+    start_indices = np.asarray(start_indices, dtype=np.int64)
+    end_indices = np.asarray(end_indices, dtype=np.int64)
+    sleeve_keys = sorted({(file_name, leverage) for portfolio in portfolios for file_name, leverage, weight in portfolio.sleeves})
+    sleeve_indexes = {sleeve_key: sleeve_index for sleeve_index, sleeve_key in enumerate(sleeve_keys)}
+    allocations = np.zeros((len(sleeve_keys), len(portfolios)))
+    for portfolio_index, portfolio in enumerate(portfolios):
+        for file_name, leverage, sleeve_investment in portfolio.get_sleeve_investments(start_investment):
+            allocations[sleeve_indexes[(file_name, leverage)], portfolio_index] += sleeve_investment
+    holds_sleeve = allocations > 0.0
+    file_leverages = {}
+    for file_name, leverage in sleeve_keys:
+        file_leverages.setdefault(file_name, []).append(leverage)
+
+    batches = []
+    for chunk_start in range(0, len(start_indices), chunk_size):
+        chunk_start_indices = start_indices[chunk_start:chunk_start+chunk_size]
+        chunk_end_indices = end_indices[chunk_start:chunk_start+chunk_size]
+        sleeve_values = np.zeros((len(chunk_start_indices), len(sleeve_keys)))
+        sleeve_ruin_offsets = np.full((len(chunk_start_indices), len(sleeve_keys)), -1, dtype=np.int64)
+        for file_name, leverages in file_leverages.items():
+            prefix_tables = panel.get_prefix_tables(file_name, leverages)
+            columns = [sleeve_indexes[(file_name, leverage)] for leverage in leverages]
+            sleeve_values[:, columns] = np.exp(prefix_tables.get_log_growth(chunk_start_indices, chunk_end_indices))
+            sleeve_ruin_offsets[:, columns] = prefix_tables.get_ruin_offsets(chunk_start_indices, chunk_end_indices)
+        sleeve_values[sleeve_ruin_offsets >= 0] = 0.0
+        end_values = np.round(sleeve_values @ allocations, 2)
+
+        ruin_offsets = np.full(end_values.shape, -1, dtype=np.int64)
+        if (sleeve_ruin_offsets >= 0).any():
+            for portfolio_index in range(len(portfolios)):
+                held_ruin_offsets = sleeve_ruin_offsets[:, holds_sleeve[:, portfolio_index]]
+                all_ruined = (held_ruin_offsets >= 0).all(axis=1)
+                ruin_offsets[all_ruined, portfolio_index] = held_ruin_offsets[all_ruined].max(axis=1)
+            end_values[ruin_offsets >= 0] = 0.0
+        batches.append(engine.BatchResults(panel.get_calendar_series(), portfolios, chunk_start_indices, chunk_end_indices, end_values, ruin_offsets, start_investment))
+    return engine.concatenate_batch_results(panel.get_calendar_series(), portfolios, batches, start_investment)
@@ -0,0 +1,152 @@
+"""
+/* Copyright (C) William Lyles - All Rights Reserved
+ * Unauthorized copying of this file, via any medium is strictly prohibited
+ * Proprietary and confidential
+ * Written by William Lyles <willglyles@gmail.com>, January 4th, 2022
+ */
+ """
+import csv
+import hashlib
+import io
+import os
+from typing import Callable, Dict, Optional, Tuple
+import uuid
+import zipfile
+import numpy as np
+
+from asset_data import PriceSeries, get_columns_of_rows, get_years, parse_date_column, read_csv_columns, read_csv_rows
+
+CACHE_VERSION = 1  # Bump whenever parsing changes, so every existing cache is rebuilt
+CACHE_FILE_SUFFIX = ".cache.npz"
+
+AppendedColumnsParser = Callable[[Dict[str, np.ndarray], int, str], Optional[Dict[str, np.ndarray]]]
+
+
+def get_cache_file_name(file_name: str) -> str:
+    return file_name + CACHE_FILE_SUFFIX
+
+def get_content_hash(file_name: str) -> str:
+    with open(file_name, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def _read_cache(cache_file_name: str):
+    '''(columns, size, modification time and content hash of the file they were parsed from), or None if there is no usable cache'''
+    if not os.path.exists(cache_file_name):
+        return None
+    # A damaged cache (eg cut short by a crash or a full disk) is a miss, rebuilt from the file it was parsed from
+    try:
+        with np.load(cache_file_name) as cache:
+            columns = {column_name: cache[column_name] for column_name in cache.files}
+        if int(columns.pop("_cache_version")) != CACHE_VERSION:
+            return None
+        return columns, int(columns.pop("_size")), int(columns.pop("_mtime_ns")), str(columns.pop("_content_hash"))
+    except (OSError, ValueError, EOFError, KeyError, zipfile.BadZipFile):
+        return None
+
+
+def _is_cache_valid(file_name: str, cache_file_name: str, columns: Dict[str, np.ndarray], cached_size: int, cached_mtime_ns: int, cached_content_hash: str) -> bool:
+    # The size and modification time are checked first so that a cache hit never reads the source file.
+    # If only the modification time changed (eg the file was touched or checked out again), the content hash decides.
+    source_stat = os.stat(file_name)
+    if source_stat.st_size == cached_size and source_stat.st_mtime_ns == cached_mtime_ns:
+        return True
+    if source_stat.st_size == cached_size and get_content_hash(file_name) == cached_content_hash:
+        _write_cache(file_name, cache_file_name, columns, cached_content_hash)
+        return True
+    return False
+
+
+def _read_appended_text(file_name: str, cached_size: int, cached_content_hash: str) -> Tuple[str, int, str]:
+    '''If file_name only had whole lines added to its end since its first cached_size bytes were cached, returns the
+    added text, the number of lines before it and the hash of the whole file. Otherwise returns (None, 0, None).'''
+    if os.stat(file_name).st_size <= cached_size:
+        return None, 0, None
+    with open(file_name, "rb") as f:
+        cached_bytes = f.read(cached_size)
+        content_hasher = hashlib.sha256(cached_bytes)
+        if content_hasher.hexdigest() != cached_content_hash or not cached_bytes.endswith(b"\n"):
+            return None, 0, None
+        appended_bytes = f.read()
+    content_hasher.update(appended_bytes)
+    return appended_bytes.decode(), cached_bytes.count(b"\n"), content_hasher.hexdigest()
+
+
+def _write_cache(file_name: str, cache_file_name: str, columns: Dict[str, np.ndarray], content_hash: str):
+    source_stat = os.stat(file_name)
+    # Unique to this write, so processes writing the same cache at once never replace it with each other's partial file
+    temporary_cache_file_name = f"{cache_file_name}.{uuid.uuid4().hex}.tmp.npz"
+    try:
+        np.savez(temporary_cache_file_name, _cache_version=CACHE_VERSION, _size=source_stat.st_size, _mtime_ns=source_stat.st_mtime_ns,
+                 _content_hash=content_hash, **columns)
+        os.replace(temporary_cache_file_name, cache_file_name)
+    except OSError:
+        # The cache is only an optimization, eg the data directory may be read only
+        if os.path.exists(temporary_cache_file_name):
+            os.remove(temporary_cache_file_name)
+
+
+def load_cached_columns(file_name: str, parse_columns: Callable[[], Dict[str, np.ndarray]], parse_appended_columns: AppendedColumnsParser=None) -> Dict[str, np.ndarray]:
+    '''Returns the columns parse_columns() builds from file_name, reading them from the binary cache next to file_name
+    when it still matches the file, and rebuilding the cache otherwise.
+    When rows were only appended to the file, parse_appended_columns(cached columns, number of lines cached, appended text)
+    can extend the cached columns instead of parsing everything again. It returns None when it cannot.'''
+    cache_file_name = get_cache_file_name(file_name)
+    cache = _read_cache(cache_file_name)
+    if cache is not None:
+        columns, cached_size, cached_mtime_ns, cached_content_hash = cache
+        if _is_cache_valid(file_name, cache_file_name, columns, cached_size, cached_mtime_ns, cached_content_hash):
+            return columns
+        if parse_appended_columns is not None:
+            appended_text, num_cached_lines, content_hash = _read_appended_text(file_name, cached_size, cached_content_hash)
+            columns = parse_appended_columns(columns, num_cached_lines, appended_text) if appended_text is not None else None
+            if columns is not None:
+                _write_cache(file_name, cache_file_name, columns, content_hash)
+                return columns
+    content_hash = get_content_hash(file_name)
+    columns = parse_columns()
+    _write_cache(file_name, cache_file_name, columns, content_hash)
+    return columns
+
+
+def append_price_rows(columns: Dict[str, np.ndarray], num_cached_lines: int, appended_text: str, should_break=None) -> Dict[str, np.ndarray]:
+    '''Columns of the cached PriceSeries with the rows of appended_text added, or None if the cached rows were not the
+    whole file before (eg parsing stopped at an empty row) or the new rows do not come after them'''
+    if num_cached_lines - 1 != len(columns["dates"]):  # The header is not a row
+        return None
+    appended_rows = read_csv_rows(csv.reader(io.StringIO(appended_text), delimiter=','), should_break)
+    try:
+        return PriceSeries.from_columns(columns).append(PriceSeries.from_csv_columns(get_columns_of_rows(appended_rows))).get_columns()
+    except ValueError:
+        return None
+
+
+def load_price_series(file_name: str, should_break=None, use_cache: bool=True) -> PriceSeries:
+    if not use_cache:
+        return PriceSeries.from_csv(file_name, should_break=should_break)
+    return PriceSeries.from_columns(load_cached_columns(file_name, lambda: PriceSeries.from_csv(file_name, should_break=should_break).get_columns(),
+                                                       lambda columns, num_cached_lines, appended_text: append_price_rows(columns, num_cached_lines, appended_text, should_break)))
+
+
+def parse_dividend_ratios(file_name: str, should_break=None) -> Dict[str, np.ndarray]:
+    '''Parses a "Date,Dividend (ratio)" file into rows of (year, dividend ratio), in file order.
+    Unparsable ratios count as 0.0.'''
+    columns = read_csv_columns(file_name, should_break)
+    if len(columns) == 0:
+        return {"years": np.zeros(0, dtype=np.int64), "dividend_ratios": np.zeros(0)}
+    years = get_years(parse_date_column(columns[0]))
+    dividend_ratios = np.zeros(len(years))
+    for index, dividend_ratio in enumerate(columns[1] if len(columns) > 1 else []):
+        try:
+            dividend_ratios[index] = float(dividend_ratio)
+        except:
+            pass
+    return {"years": years, "dividend_ratios": dividend_ratios}
+
+def load_dividend_ratios(file_name: str, should_break=None, use_cache: bool=True) -> Dict[int, float]:
+    '''{year: dividend ratio}. When a year appears more than once, the last row wins.'''
+    if use_cache:
+        columns = load_cached_columns(file_name, lambda: parse_dividend_ratios(file_name, should_break))
+    else:
+        columns = parse_dividend_ratios(file_name, should_break)
+    return dict(zip(columns["years"].tolist(), columns["dividend_ratios"].tolist()))
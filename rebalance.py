@@ -0,0 +1,282 @@
+"""
+/* Copyright (C) William Lyles - All Rights Reserved
+ * Unauthorized copying of this file, via any medium is strictly prohibited
+ * Proprietary and confidential
+ * Written by William Lyles <willglyles@gmail.com>, January 4th, 2022
+ */
+ """
+import math
+from typing import List, Tuple
+import numpy as np
+
+from asset_data import PriceSeries
+
+REBALANCE_DAILY = "daily"
+REBALANCE_MONTHLY = "monthly"
+REBALANCE_QUARTERLY = "quarterly"
+REBALANCE_ANNUAL = "annual"
+REBALANCE_FREQUENCIES = [REBALANCE_DAILY, REBALANCE_MONTHLY, REBALANCE_QUARTERLY, REBALANCE_ANNUAL]
+
+MAX_SEGMENTS_PER_CHUNK = 2**20  # Bounds the temporary (segments x leverages) arrays
+DRIFT_CHUNK_SIZE = 2**12  # Windows whose drift rebalances are searched together, since their number is only known once found
+DRIFT_BAND_TOLERANCE = 1e-9  # Log ratios this close to a drift bound are inside the band, so prefix differences and day by day sums agree on ties
+
+
+class RebalancePolicy():
+    '''When a split leverage variant sells and buys its real ETFs back to their target weights: after the close of
+    the last trading day of every period of frequency, or after any close where the weights have drifted more than
+    drift_band (eg 0.05 for 5 percentage points) from their targets. Drift is measured from the daily moves of
+    the ETFs since the last rebalance; the small yearly charges/dividends are left out of it.'''
+    def __init__(self, frequency: str=None, drift_band: float=None):
+        if (frequency is None) == (drift_band is None):
+            raise ValueError("A rebalance policy needs exactly one of a frequency or a drift band")
+        if frequency is not None and frequency not in REBALANCE_FREQUENCIES:
+            raise ValueError(f"Unknown rebalance frequency {frequency}, expected one of {REBALANCE_FREQUENCIES}")
+        if drift_band is not None and not 0.0 < drift_band < 1.0:
+            raise ValueError(f"The drift band must be between 0 and 1, not {drift_band}")
+        self.frequency = frequency
+        self.drift_band = drift_band
+
+    def __eq__(self, other):
+        return isinstance(other, RebalancePolicy) and (self.frequency, self.drift_band) == (other.frequency, other.drift_band)
+
+    def __hash__(self):
+        return hash((self.frequency, self.drift_band))
+
+    def __str__(self):
+        if self.frequency is not None:
+            return f"rebalanced {self.frequency}"
+        return f"rebalanced at {self.drift_band:.1%} drift"
+
+    def __repr__(self):
+        return f"RebalancePolicy({self.frequency!r}, {self.drift_band!r})"
+
+
+def get_rebalance_policy(frequency: str=None, drift_band: float=None) -> RebalancePolicy:
+    '''The RebalancePolicy of the given settings, or None when neither is set (the real ETFs are left to drift)'''
+    if frequency is None and drift_band is None:
+        return None
+    return RebalancePolicy(frequency, drift_band)
+
+
+def get_rebalance_days(series: PriceSeries, frequency: str) -> np.ndarray:
+    '''Sorted indices of the last trading day of every period of frequency in series (except the final one, which
+    no window can rebalance after). Kept on the series for reuse.'''
+    if getattr(series, "_rebalance_days", None) is None:
+        series._rebalance_days = {}
+    if frequency not in series._rebalance_days:
+        if frequency == REBALANCE_DAILY:
+            periods = np.arange(len(series))
+        elif frequency == REBALANCE_MONTHLY:
+            periods = series.dates.astype("datetime64[M]").astype(np.int64)
+        elif frequency == REBALANCE_QUARTERLY:
+            periods = series.dates.astype("datetime64[M]").astype(np.int64) // 3
+        else:
+            periods = series.dates.astype("datetime64[Y]").astype(np.int64)
+        series._rebalance_days[frequency] = np.flatnonzero(periods[1:] != periods[:-1])
+    return series._rebalance_days[frequency]
+
+
+def get_drift_bounds(high_weight: float, drift_band: float) -> Tuple[float, float]:
+    '''(low, high) bounds of the log of (growth of the high leverage ETF / growth of the low leverage ETF) since the
+    last rebalance, outside of which the weight of the high leverage ETF has drifted more than drift_band.
+    With x that log ratio, the weight is high_weight*e^x / (low_weight + high_weight*e^x).
+    Both bounds are widened by DRIFT_BAND_TOLERANCE, and both are inside the band.'''
+    low_weight = 1 - high_weight
+    upper = math.inf if high_weight + drift_band >= 1 else math.log((high_weight + drift_band) * low_weight / (high_weight * (low_weight - drift_band))) + DRIFT_BAND_TOLERANCE
+    lower = -math.inf if high_weight - drift_band <= 0 else math.log((high_weight - drift_band) * low_weight / (high_weight * (low_weight + drift_band))) - DRIFT_BAND_TOLERANCE
+    return lower, upper
+
+
+class DriftTable():
+    '''Sparse tables of the range minimum and maximum of the cumulative log ratio of the daily growth of a high and a
+    low leverage ETF, so the first day a window drifts out of its band is found in O(log days), for every window at once'''
+    def __init__(self, log_growth_prefix: np.ndarray, low_column: int, high_column: int):
+        log_ratio_prefix = log_growth_prefix[:, high_column] - log_growth_prefix[:, low_column]
+        self.minima = [log_ratio_prefix]
+        self.maxima = [log_ratio_prefix]
+        step = 1
+        while 2 * step <= len(log_ratio_prefix):
+            # Entries past the last full range are left stale, first_exits never reads them
+            minima = self.minima[-1].copy()
+            minima[:len(minima)-step] = np.minimum(self.minima[-1][:-step], self.minima[-1][step:])
+            maxima = self.maxima[-1].copy()
+            maxima[:len(maxima)-step] = np.maximum(self.maxima[-1][:-step], self.maxima[-1][step:])
+            self.minima.append(minima)
+            self.maxima.append(maxima)
+            step *= 2
+
+    def get_log_ratios(self, prefix_positions: np.ndarray) -> np.ndarray:
+        return self.minima[0][prefix_positions]
+
+    def first_exits(self, first_positions: np.ndarray, last_positions: np.ndarray, lower_bounds: np.ndarray, upper_bounds: np.ndarray) -> np.ndarray:
+        '''First prefix position in [first_positions, last_positions] where the log ratio leaves [lower_bounds, upper_bounds],
+        or last_positions + 1 where it never does. The longest run still inside is grown by halving jumps.'''
+        positions = np.asarray(first_positions, dtype=np.int64).copy()
+        for level in range(len(self.minima) - 1, -1, -1):
+            step = 1 << level
+            can_jump = positions + step - 1 <= last_positions
+            jump_positions = np.where(can_jump, positions, 0)
+            stays_inside = can_jump & (self.minima[level][jump_positions] >= lower_bounds) & (self.maxima[level][jump_positions] <= upper_bounds)
+            positions += np.where(stays_inside, step, 0)
+        return positions
+
+
+def get_calendar_segments(series: PriceSeries, start_indices: np.ndarray, end_indices: np.ndarray, frequency: str) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    '''(window index, first day, last day) of every segment the windows are cut into by rebalancing after the close
+    of every day in get_rebalance_days, ordered by window then day'''
+    rebalance_days = get_rebalance_days(series, frequency)
+    first_positions = np.searchsorted(rebalance_days, start_indices, side="left")
+    num_rebalances = np.searchsorted(rebalance_days, end_indices, side="left") - first_positions
+    segment_windows = np.repeat(np.arange(len(start_indices)), num_rebalances + 1)
+    # Position of each segment within its window
+    segment_offsets = np.arange(len(segment_windows)) - np.repeat(np.cumsum(num_rebalances + 1) - (num_rebalances + 1), num_rebalances + 1)
+    is_last = segment_offsets == num_rebalances[segment_windows]
+    rebalance_positions = np.minimum(first_positions[segment_windows] + segment_offsets, max(len(rebalance_days) - 1, 0))
+    segment_ends = np.where(is_last, end_indices[segment_windows], rebalance_days[rebalance_positions] if len(rebalance_days) > 0 else 0)
+    segment_starts = np.where(segment_offsets == 0, start_indices[segment_windows], np.concatenate(([0], segment_ends[:-1] + 1)))
+    return segment_windows, segment_starts, segment_ends
+
+def get_drift_segments(drift_table: DriftTable, start_indices: np.ndarray, end_indices: np.ndarray, high_weight: float, drift_band: float) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    '''(window index, first day, last day) of every segment the windows are cut into by rebalancing after the close
+    of every day the weights drift out of their band. All windows step from one rebalance to their next together.'''
+    lower, upper = get_drift_bounds(high_weight, drift_band)
+    segment_windows, segment_starts, segment_ends = [], [], []
+    window_indexes = np.arange(len(start_indices))
+    current_starts = np.asarray(start_indices, dtype=np.int64)
+    current_ends = np.asarray(end_indices, dtype=np.int64)
+    while len(window_indexes) > 0:
+        # Prefix position d+1 holds the log ratio up to the close of day d, and position current_starts the one the weights were last reset at
+        base_log_ratios = drift_table.get_log_ratios(current_starts)
+        exits = drift_table.first_exits(current_starts + 1, current_ends, base_log_ratios + lower, base_log_ratios + upper)
+        # Drifting out on the last day of the window needs no rebalance
+        rebalanced = exits <= current_ends
+        segment_windows.append(window_indexes)
+        segment_starts.append(current_starts)
+        segment_ends.append(np.where(rebalanced, exits - 1, current_ends))
+        window_indexes, current_starts, current_ends = window_indexes[rebalanced], exits[rebalanced], current_ends[rebalanced]
+    if len(segment_windows) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    return np.concatenate(segment_windows), np.concatenate(segment_starts), np.concatenate(segment_ends)
+
+
+def get_daily_rebalanced_log_growth(prefix_tables, start_indices: np.ndarray, end_indices: np.ndarray, sleeves: List[Tuple[float, float]],
+                                    sleeve_investments: List[Tuple[float, float]]) -> np.ndarray:
+    '''Log of the end value of a split leverage variant rebalanced every day, over every window. Every day is a
+    segment, so the windows are summed from a prefix table of the daily rebalanced growth (see
+    engine.PrefixTables.get_daily_rebalance_prefix), and only the days that differ are computed as segments: the first
+    day grows the amounts actually invested, and the window's first new year day and last day pay prorated years.'''
+    sleeve_columns = [prefix_tables.leverage_indexes[leverage] for leverage, weight in sleeves]
+    weights = np.array([weight for leverage, weight in sleeves])
+    allocations = np.array([sleeve_investment for leverage, sleeve_investment in sleeve_investments])
+    daily_rebalance_prefix = prefix_tables.get_daily_rebalance_prefix(sleeves)
+    log_values = daily_rebalance_prefix[end_indices + 1] - daily_rebalance_prefix[start_indices]
+
+    new_year_indices = prefix_tables.adjustment_table.new_year_indices
+    first_new_year_positions = np.searchsorted(new_year_indices, start_indices, side="right")
+    first_new_year_indices = new_year_indices[np.minimum(first_new_year_positions, len(new_year_indices) - 1)] if len(new_year_indices) > 0 else end_indices
+    pays_first_year = (first_new_year_positions < len(new_year_indices)) & (first_new_year_indices < end_indices)
+    for days, is_special in ((start_indices, np.ones(len(start_indices), dtype=bool)), (first_new_year_indices, pays_first_year), (end_indices, end_indices > start_indices)):
+        windows = np.flatnonzero(is_special)
+        special_days = days[windows]
+        log_values[windows] -= daily_rebalance_prefix[special_days + 1] - daily_rebalance_prefix[special_days]
+        sleeve_growth = np.exp(prefix_tables.get_segment_log_growth(start_indices[windows], end_indices[windows], special_days, special_days)[:, sleeve_columns])
+        log_values[windows] += np.log(np.where(special_days == start_indices[windows], sleeve_growth @ allocations, sleeve_growth @ weights))
+    return log_values
+
+
+def get_rebalanced_end_values(prefix_tables, start_indices: np.ndarray, end_indices: np.ndarray, sleeves: List[Tuple[float, float]],
+                              sleeve_investments: List[Tuple[float, float]], rebalance_policy: RebalancePolicy) -> np.ndarray:
+    '''Unrounded end value of a split leverage variant over every window, rebalanced to the sleeves' target weights
+    by rebalance_policy. Each window is cut into the segments between its rebalances, and every segment's growth
+    is read from the prefix tables (see engine.PrefixTables.get_segment_log_growth), so no day is looped over.
+    The first segment grows the amounts actually invested, every later one the portfolio split by weight.
+    Ruin is not looked at: windows where a sleeve loses everything must be handled by the caller.'''
+    start_indices = np.asarray(start_indices, dtype=np.int64)
+    end_indices = np.asarray(end_indices, dtype=np.int64)
+    if rebalance_policy.frequency == REBALANCE_DAILY:
+        return np.exp(get_daily_rebalanced_log_growth(prefix_tables, start_indices, end_indices, sleeves, sleeve_investments))
+    sleeve_columns = [prefix_tables.leverage_indexes[leverage] for leverage, weight in sleeves]
+    weights = np.array([weight for leverage, weight in sleeves])
+    allocations = np.array([sleeve_investment for leverage, sleeve_investment in sleeve_investments])
+    end_values = np.zeros(len(start_indices))
+
+    if rebalance_policy.frequency is not None:
+        rebalance_days = get_rebalance_days(prefix_tables.series, rebalance_policy.frequency)
+        num_segments = np.searchsorted(rebalance_days, end_indices, side="left") - np.searchsorted(rebalance_days, start_indices, side="left") + 1
+        chunk_ends = np.searchsorted(np.cumsum(num_segments), np.arange(MAX_SEGMENTS_PER_CHUNK, num_segments.sum() + MAX_SEGMENTS_PER_CHUNK, MAX_SEGMENTS_PER_CHUNK), side="right")
+        chunk_bounds = np.unique(np.concatenate(([0], np.maximum(chunk_ends, 1), [len(start_indices)])))
+    else:
+        chunk_bounds = np.unique(np.concatenate((np.arange(0, len(start_indices), DRIFT_CHUNK_SIZE), [len(start_indices)])))
+    for chunk_start, chunk_end in zip(chunk_bounds[:-1].tolist(), chunk_bounds[1:].tolist()):
+        chunk_start_indices = start_indices[chunk_start:chunk_end]
+        chunk_end_indices = end_indices[chunk_start:chunk_end]
+        if rebalance_policy.frequency is not None:
+            segment_windows, segment_starts, segment_ends = get_calendar_segments(prefix_tables.series, chunk_start_indices, chunk_end_indices, rebalance_policy.frequency)
+        else:
+            (low_leverage, low_weight), (high_leverage, high_weight) = sleeves
+            drift_table = prefix_tables.get_drift_table(low_leverage, high_leverage)
+            segment_windows, segment_starts, segment_ends = get_drift_segments(drift_table, chunk_start_indices, chunk_end_indices, high_weight, rebalance_policy.drift_band)
+        sleeve_growth = np.exp(prefix_tables.get_segment_log_growth(chunk_start_indices[segment_windows], chunk_end_indices[segment_windows],
+                                                                    segment_starts, segment_ends)[:, sleeve_columns])
+        is_first = segment_starts == chunk_start_indices[segment_windows]
+        log_values = np.log(np.where(is_first, sleeve_growth @ allocations, sleeve_growth @ weights))
+        end_values[chunk_start:chunk_end] = np.exp(np.bincount(segment_windows, weights=log_values, minlength=len(chunk_start_indices)))
+    return end_values
+
+
+def compute_rebalanced_equity_path(series: PriceSeries, start_index: int, end_index: int, sleeves: List[Tuple[float, float]], sleeve_investments: List[Tuple[float, float]],
+                                   rebalance_policy: RebalancePolicy, factors: np.ndarray, final_factors: np.ndarray, round_to_cents: bool=False) -> Tuple[np.ndarray, float]:
+    '''Day by day value of a split leverage variant rebalanced by rebalance_policy over one window, and its end value.
+    factors and final_factors are the yearly charge/dividend factors of every sleeve (see engine.get_adjustment_factors).
+    With round_to_cents, every amount is rounded after every day, adjustment and rebalance. A sleeve that loses
+    everything (1 + L*r <= 0) is worth nothing from then on, and later rebalances split the rest between the others.'''
+    leverages = [leverage for leverage, weight in sleeves]
+    weights = [weight for leverage, weight in sleeves]
+    amounts = [sleeve_investment for leverage, sleeve_investment in sleeve_investments]
+    is_alive = [True for leverage in leverages]
+    rebalance_days = set()
+    if rebalance_policy.frequency is not None:
+        rebalance_days = set(get_rebalance_days(series, rebalance_policy.frequency).tolist())
+    else:
+        lower, upper = get_drift_bounds(weights[1], rebalance_policy.drift_band)
+    log_ratio = 0.0
+    equity_path = []
+    for day_offset, ratio_change in enumerate(series.ratio_change[start_index:end_index+1].tolist()):
+        for sleeve_index, leverage in enumerate(leverages):
+            if not is_alive[sleeve_index]:
+                continue
+            if 1 + (ratio_change * leverage) <= 0.0:
+                # The ETF ceased operations, nothing of this sleeve is left to grow or rebalance
+                amounts[sleeve_index] = 0.0
+                is_alive[sleeve_index] = False
+                continue
+            amounts[sleeve_index] *= 1 + (ratio_change * leverage)
+            if round_to_cents:
+                amounts[sleeve_index] = round(amounts[sleeve_index], 2)
+            factor = float(factors[sleeve_index, day_offset])
+            if factor != 1.0:
+                amounts[sleeve_index] = round(amounts[sleeve_index] * factor, 2) if round_to_cents else amounts[sleeve_index] * factor
+        equity_path.append(sum(amounts))
+        day = start_index + day_offset
+        if day == end_index:
+            break
+        if rebalance_policy.frequency is not None:
+            should_rebalance = day in rebalance_days
+        elif all(is_alive):
+            log_ratio += math.log(1 + (ratio_change * leverages[1])) - math.log(1 + (ratio_change * leverages[0]))
+            should_rebalance = not lower <= log_ratio <= upper
+        else:
+            # A single ETF left cannot drift from anything
+            should_rebalance = False
+        if should_rebalance:
+            total = sum(amounts)
+            target_weights = weights
+            if not all(is_alive):
+                alive_weight = sum(weight for weight, alive in zip(weights, is_alive) if alive)
+                target_weights = [weight / alive_weight if alive else 0.0 for weight, alive in zip(weights, is_alive)]
+            amounts = [round(total * weight, 2) if round_to_cents else total * weight for weight in target_weights]
+            log_ratio = 0.0
+    end_amounts = [amount * float(final_factor) for amount, final_factor in zip(amounts, final_factors)]
+    end_value = sum(round(amount, 2) for amount in end_amounts) if round_to_cents else sum(end_amounts)
+    return np.array(equity_path), end_value
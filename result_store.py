@@ -0,0 +1,203 @@
+"""
+/* Copyright (C) William Lyles - All Rights Reserved
+ * Unauthorized copying of this file, via any medium is strictly prohibited
+ * Proprietary and confidential
+ * Written by William Lyles <willglyles@gmail.com>, January 4th, 2022
+ */
+ """
+from datetime import date
+import json
+import os
+from typing import Dict, List
+import numpy as np
+
+from accumulator import QuantileSketch, RunningStats
+from common import DAYS_PER_YEAR
+import engine
+
+STORE_VERSION = 1  # Bump whenever the chunk layout changes
+METADATA_FILE_NAME = "metadata.json"
+CHUNK_FILE_NAME_FORMAT = "chunk_{:06d}.npz"
+
+# Columns with one entry per window, and (windows x leverage variants) columns
+WINDOW_COLUMNS = ("start_dates", "end_dates", "start_indices", "end_indices")
+RESULT_COLUMNS = ("end_values", "CAGR_ratios", "ruined")
+
+
+class IncorrectStoreUsage(Exception):
+    pass
+
+
+class ResultStoreWriter():
+    '''Writes the results of every simulated window to a directory, one uncompressed .npz chunk per BatchResults
+    written, so a run never holds more than one chunk in memory. The metadata is rewritten after every chunk, so the
+    store can be read while (or after an interrupted) run writes to it. Any store already in the directory is replaced.'''
+    def __init__(self, directory: str, file_name: str, leverage_variants: List[engine.LeverageVariant], start_investment: float):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        for existing_file_name in os.listdir(directory):
+            if existing_file_name.startswith("chunk_") and existing_file_name.endswith(".npz"):
+                os.remove(os.path.join(directory, existing_file_name))
+        self.metadata = {"version": STORE_VERSION, "file_name": file_name, "start_investment": start_investment,
+                         "leverage_labels": [leverage_variant.get_leverage_ratio_str() for leverage_variant in leverage_variants],
+                         "leverage_ratios": [leverage_variant.leverage_ratio for leverage_variant in leverage_variants],
+                         "num_chunks": 0, "num_windows": 0}
+        self._write_metadata()
+
+    def _write_metadata(self):
+        metadata_file_name = os.path.join(self.directory, METADATA_FILE_NAME)
+        with open(metadata_file_name + ".tmp", "w") as f:
+            json.dump(self.metadata, f)
+        os.replace(metadata_file_name + ".tmp", metadata_file_name)
+
+    def write(self, window_results: engine.BatchResults):
+        if [leverage_variant.get_leverage_ratio_str() for leverage_variant in window_results.leverage_variants] != self.metadata["leverage_labels"]:
+            raise IncorrectStoreUsage(f"Every chunk of a store must have the leverage ratios {self.metadata['leverage_labels']}")
+        if window_results.num_windows() == 0:
+            return
+        np.savez(os.path.join(self.directory, CHUNK_FILE_NAME_FORMAT.format(self.metadata["num_chunks"])),
+                 start_dates=window_results.get_start_dates(), end_dates=window_results.get_end_dates(),
+                 start_indices=window_results.start_indices, end_indices=window_results.end_indices,
+                 end_values=window_results.end_values, CAGR_ratios=window_results.get_CAGR_ratios(), ruined=window_results.get_ruined())
+        self.metadata["num_chunks"] += 1
+        self.metadata["num_windows"] += window_results.num_windows()
+        self._write_metadata()
+
+
+class StoredResults():
+    '''Results read back from a ResultStore: window columns (one entry per window) and result columns
+    (windows x leverage variants, one column per entry of leverage_labels)'''
+    def __init__(self, leverage_labels: List[str], leverage_ratios: List[float], start_investment: float, columns: Dict[str, np.ndarray]):
+        self.leverage_labels = leverage_labels
+        self.leverage_ratios = leverage_ratios
+        self.start_investment = start_investment
+        for column_name in WINDOW_COLUMNS + RESULT_COLUMNS:
+            setattr(self, column_name, columns[column_name])
+
+    def num_windows(self) -> int:
+        return len(self.start_dates)
+
+    def get_investment_years(self) -> np.ndarray:
+        return (self.end_dates - self.start_dates).astype(np.int64) / DAYS_PER_YEAR
+
+    def get_total_return_ratios(self) -> np.ndarray:
+        return np.round(np.round(self.end_values - self.start_investment, 2) / self.start_investment, 5)
+
+    def get_column(self, column_name: str, leverage_label: str) -> np.ndarray:
+        '''One result column (eg "CAGR_ratios") of one leverage variant'''
+        return getattr(self, column_name)[:, self.leverage_labels.index(leverage_label)]
+
+
+class LeverageAggregate():
+    '''Aggregates of every stored window of one leverage variant, built a chunk at a time'''
+    def __init__(self, leverage_label: str):
+        self.leverage_label = leverage_label
+        self.CAGR_stats = RunningStats()
+        self.end_value_stats = RunningStats()
+        self.CAGR_sketch = QuantileSketch()
+        self.ruined_count = 0
+
+    def add(self, CAGR_ratios: np.ndarray, end_values: np.ndarray, ruined: np.ndarray):
+        self.CAGR_stats.add_values(CAGR_ratios)
+        self.end_value_stats.add_values(end_values)
+        self.CAGR_sketch.add_values(CAGR_ratios)
+        self.ruined_count += int(np.count_nonzero(ruined))
+
+    def count(self) -> int:
+        return self.CAGR_stats.count
+
+    def ruined_frequency(self) -> float:
+        return self.ruined_count / self.count()
+
+    def __str__(self):
+        if self.count() == 0:
+            return f"{self.leverage_label}: no windows"
+        return (f"{self.leverage_label}: {self.count()} windows, avg CAGR {self.CAGR_stats.mean():.2%}, median CAGR {self.CAGR_sketch.get_median():.2%}, "
+                f"worst CAGR {self.CAGR_stats.min:.2%}, best CAGR {self.CAGR_stats.max:.2%}, avg end value {self.end_value_stats.mean():.2f}, "
+                f"all money lost {self.ruined_frequency():.2%}")
+
+
+def _to_datetime64(day) -> np.datetime64:
+    return None if day is None else np.datetime64(day.isoformat() if isinstance(day, date) else day, "D")
+
+
+class ResultStore():
+    '''Reads and queries a store written by ResultStoreWriter, one chunk at a time.
+    Every query can be limited to windows starting and ending within date ranges (inclusive), to windows held for
+    min_years to max_years, and to some leverage variants, given by label (see LeverageVariant.get_leverage_ratio_str)
+    or by leverage ratio (every variant with that ratio).'''
+    def __init__(self, directory: str):
+        self.directory = directory
+        metadata_file_name = os.path.join(directory, METADATA_FILE_NAME)
+        if not os.path.exists(metadata_file_name):
+            raise IncorrectStoreUsage(f"{directory} is not a result store, it has no {METADATA_FILE_NAME}")
+        with open(metadata_file_name) as f:
+            self.metadata = json.load(f)
+        if self.metadata["version"] != STORE_VERSION:
+            raise IncorrectStoreUsage(f"{directory} was written by store version {self.metadata['version']}, but this is version {STORE_VERSION}")
+        self.file_name = self.metadata["file_name"]
+        self.start_investment = self.metadata["start_investment"]
+        self.leverage_labels = self.metadata["leverage_labels"]
+        self.leverage_ratios = self.metadata["leverage_ratios"]
+
+    def num_windows(self) -> int:
+        return self.metadata["num_windows"]
+
+    def _get_variant_indexes(self, leverage_labels: List[str]=None, leverage_ratios: List[float]=None) -> np.ndarray:
+        selected = np.ones(len(self.leverage_labels), dtype=bool)
+        if leverage_labels is not None:
+            unknown_labels = set(leverage_labels) - set(self.leverage_labels)
+            if len(unknown_labels) > 0:
+                raise IncorrectStoreUsage(f"Leverage ratios {sorted(unknown_labels)} are not in the store. Stored: {self.leverage_labels}")
+            selected &= np.isin(self.leverage_labels, leverage_labels)
+        if leverage_ratios is not None:
+            selected &= np.isin(self.leverage_ratios, leverage_ratios)
+        return np.flatnonzero(selected)
+
+    def iterate(self, start_date_from=None, start_date_to=None, end_date_from=None, end_date_to=None, min_years: float=None, max_years: float=None,
+                leverage_labels: List[str]=None, leverage_ratios: List[float]=None):
+        '''Yields the StoredResults of the windows of every chunk that pass the filters'''
+        variant_indexes = self._get_variant_indexes(leverage_labels, leverage_ratios)
+        selected_labels = [self.leverage_labels[variant_index] for variant_index in variant_indexes.tolist()]
+        selected_ratios = [self.leverage_ratios[variant_index] for variant_index in variant_indexes.tolist()]
+        date_bounds = [(column_name, _to_datetime64(day_from), _to_datetime64(day_to))
+                       for column_name, day_from, day_to in (("start_dates", start_date_from, start_date_to), ("end_dates", end_date_from, end_date_to))]
+        for chunk_index in range(self.metadata["num_chunks"]):
+            with np.load(os.path.join(self.directory, CHUNK_FILE_NAME_FORMAT.format(chunk_index))) as chunk:
+                columns = {column_name: chunk[column_name] for column_name in WINDOW_COLUMNS + RESULT_COLUMNS}
+            selected_windows = np.ones(len(columns["start_dates"]), dtype=bool)
+            for column_name, day_from, day_to in date_bounds:
+                if day_from is not None:
+                    selected_windows &= columns[column_name] >= day_from
+                if day_to is not None:
+                    selected_windows &= columns[column_name] <= day_to
+            if min_years is not None or max_years is not None:
+                investment_years = (columns["end_dates"] - columns["start_dates"]).astype(np.int64) / DAYS_PER_YEAR
+                selected_windows &= (investment_years >= (-np.inf if min_years is None else min_years)) & (investment_years <= (np.inf if max_years is None else max_years))
+            for column_name in WINDOW_COLUMNS:
+                columns[column_name] = columns[column_name][selected_windows]
+            for column_name in RESULT_COLUMNS:
+                columns[column_name] = columns[column_name][selected_windows][:, variant_indexes]
+            yield StoredResults(selected_labels, selected_ratios, self.start_investment, columns)
+
+    def query(self, **filters) -> StoredResults:
+        '''Every window that passes the filters (see iterate), in one StoredResults'''
+        chunks = list(self.iterate(**filters))
+        variant_indexes = self._get_variant_indexes(filters.get("leverage_labels"), filters.get("leverage_ratios"))
+        if len(chunks) == 0:
+            columns = {column_name: np.zeros(0, dtype="datetime64[D]" if column_name.endswith("dates") else np.int64) for column_name in WINDOW_COLUMNS}
+            columns.update({column_name: np.zeros((0, len(variant_indexes)), dtype=bool if column_name == "ruined" else np.float64) for column_name in RESULT_COLUMNS})
+            return StoredResults([self.leverage_labels[variant_index] for variant_index in variant_indexes.tolist()],
+                                 [self.leverage_ratios[variant_index] for variant_index in variant_indexes.tolist()], self.start_investment, columns)
+        return StoredResults(chunks[0].leverage_labels, chunks[0].leverage_ratios, self.start_investment,
+                             {column_name: np.concatenate([getattr(chunk, column_name) for chunk in chunks]) for column_name in WINDOW_COLUMNS + RESULT_COLUMNS})
+
+    def aggregate(self, **filters) -> Dict[str, LeverageAggregate]:
+        '''{leverage label: LeverageAggregate} of every window that passes the filters (see iterate), read a chunk at a time'''
+        aggregates = {}
+        for chunk in self.iterate(**filters):
+            for variant_index, leverage_label in enumerate(chunk.leverage_labels):
+                if leverage_label not in aggregates:
+                    aggregates[leverage_label] = LeverageAggregate(leverage_label)
+                aggregates[leverage_label].add(chunk.CAGR_ratios[:, variant_index], chunk.end_values[:, variant_index], chunk.ruined[:, variant_index])
+        return aggregates
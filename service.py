@@ -0,0 +1,296 @@
+"""
+/* Copyright (C) William Lyles - All Rights Reserved
+ * Unauthorized copying of this file, via any medium is strictly prohibited
+ * Proprietary and confidential
+ * Written by William Lyles <willglyles@gmail.com>, January 4th, 2022
+ */
+
+Long running simulation service. Run `python service.py` to parse every file in common.file_names once and listen on
+SERVICE_HOST:SERVICE_PORT (or SERVICE_UNIX_SOCKET) for HTTP requests:
+- POST /simulate with a JSON body like {"file_name": "spx_d.csv", "leverage_ratios": [2.0, 3.0], "min_years": 2,
+  "max_years": 4, "num_samples": 1000, "seed": 1}. Everything but file_name is optional. Returns the stats of every
+  leverage ratio, the same ones run_simulation_stats gets with np.random.default_rng(seed).
+- GET /health returns the files served and how many requests and batches were simulated.
+"""
+import asyncio
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+from typing import Dict, List, Tuple
+import numpy as np
+
+import common
+import engine
+from investment import InvestmentsStats
+import main
+from simulation_context import SimulationContext
+
+MAX_REQUEST_BYTES = 2**16
+HTTP_STATUSES = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed", 413: "Payload Too Large", 500: "Internal Server Error"}
+
+
+class IncorrectRequest(Exception):
+    pass
+
+
+class SimulationRequest():
+    '''One request to simulate num_samples random windows of file_name, drawn with np.random.default_rng(seed)'''
+    def __init__(self, file_name: str, leverage_ratios: List[float], min_years: float, max_years: float, num_samples: int, seed: int):
+        self.file_name = file_name
+        self.leverage_ratios = leverage_ratios
+        self.min_years = min_years
+        self.max_years = max_years
+        self.num_samples = num_samples
+        self.seed = seed
+
+    @classmethod
+    def from_json(cls, request_data: dict, context: SimulationContext, max_samples: int=common.SERVICE_MAX_SAMPLES,
+                  max_leverages: int=common.SERVICE_MAX_LEVERAGES) -> "SimulationRequest":
+        '''Validated request from a parsed JSON body. Missing horizons default to the ones of the context.'''
+        if not isinstance(request_data, dict):
+            raise IncorrectRequest("The request must be a JSON object")
+        unknown_fields = set(request_data) - {"file_name", "leverage_ratios", "min_years", "max_years", "num_samples", "seed"}
+        if len(unknown_fields) > 0:
+            raise IncorrectRequest(f"Unknown fields {sorted(unknown_fields)}")
+        requested_leverage_ratios = request_data.get("leverage_ratios", [1.0, 2.0, 3.0])
+        if (not isinstance(requested_leverage_ratios, list) or
+                not all(isinstance(leverage_ratio, (int, float)) and not isinstance(leverage_ratio, bool) for leverage_ratio in requested_leverage_ratios)):
+            raise IncorrectRequest("leverage_ratios must be a list of numbers")
+        if not 1 <= len(requested_leverage_ratios) <= max_leverages:
+            raise IncorrectRequest(f"leverage_ratios must have between 1 and {max_leverages} leverage ratios")
+        try:
+            leverage_ratios = [round(float(leverage_ratio), 8) for leverage_ratio in requested_leverage_ratios]
+            min_years = float(request_data.get("min_years", context.config.min_investment_years))
+            max_years = float(request_data.get("max_years", context.config.max_investment_years))
+            num_samples = int(request_data.get("num_samples", 1000))
+            seed = request_data.get("seed")
+            seed = int(seed) if seed is not None else int(np.random.SeedSequence().entropy % 2**63)
+        except (TypeError, ValueError) as e:
+            raise IncorrectRequest(f"Invalid request: {e}")
+        if 1.0 not in leverage_ratios:
+            leverage_ratios.append(1.0)
+        if not all(np.isfinite(leverage_ratios)) or not 0 <= min_years <= max_years:
+            raise IncorrectRequest("Leverage ratios must be finite and 0 <= min_years <= max_years")
+        if not 1 <= num_samples <= max_samples:
+            raise IncorrectRequest(f"num_samples must be between 1 and {max_samples}")
+        return cls(context.file_name, leverage_ratios, min_years, max_years, num_samples, seed)
+
+
+def get_stats_json(stats: InvestmentsStats) -> dict:
+    return {"leverage_ratio": stats.leverage_ratio, "leverage_ratio_str": stats.get_leverage_ratio_str(), "num_investments": stats.num_investments(),
+            "average_CAGR": stats.average_CAGR(), "median_CAGR": stats.median_CAGR(), "worst_CAGR": stats.worst_CAGR(), "best_CAGR": stats.best_CAGR(),
+            "average_return_ratio": stats.average_return_ratio(), "worst_return_ratio": stats.worst_return_ratio(), "best_return_ratio": stats.best_return_ratio(),
+            "average_dollar_return": stats.average_dollar_return(), "returned_more_than_leverage_1_frequency": stats.returned_more_than_leverage_1_frequency(),
+            "was_largest_return_frequency": stats.was_largest_return_frequency(), "all_money_lost_frequency": stats.all_money_lost_frequency(),
+            "avg_investment_time": stats.avg_investment_time()}
+
+
+class WarmFile():
+    '''Everything kept in memory for one file between requests: its context and the PrefixTables of the last
+    max_prefix_tables sets of sleeve leverages requested. Only one batch of a file is simulated at a time, so nothing
+    here is shared between threads.'''
+    def __init__(self, context: SimulationContext, chunk_size: int=engine.DEFAULT_CHUNK_SIZE, max_prefix_tables: int=common.SERVICE_MAX_PREFIX_TABLES):
+        self.context = context
+        self.chunk_size = chunk_size
+        self.max_prefix_tables = max_prefix_tables
+        self.prefix_tables: OrderedDict = OrderedDict()  # {sorted sleeve leverages: PrefixTables}, least recently used first
+
+    def get_prefix_tables(self, sleeve_leverages: List[float]) -> engine.PrefixTables:
+        '''PrefixTables with every given sleeve leverage: a kept one that has them all, or a new one of just these
+        leverages, which evicts the least recently used one when more than max_prefix_tables are kept'''
+        for leverages_key, prefix_tables in reversed(self.prefix_tables.items()):
+            if set(sleeve_leverages) <= set(prefix_tables.leverage_indexes):
+                self.prefix_tables.move_to_end(leverages_key)
+                return prefix_tables
+        leverages_key = tuple(sorted(set(sleeve_leverages)))
+        self.prefix_tables[leverages_key] = engine.PrefixTables(self.context.series, list(leverages_key), index_data=self.context.index_data)
+        while len(self.prefix_tables) > self.max_prefix_tables:
+            self.prefix_tables.popitem(last=False)
+        return self.prefix_tables[leverages_key]
+
+    def draw_windows(self, request: SimulationRequest) -> Tuple[np.ndarray, np.ndarray]:
+        '''The windows of a request, drawn a chunk at a time like run_simulation_stats draws them'''
+        rng = np.random.default_rng(request.seed)
+        windows = [main.choose_random_windows(min(self.chunk_size, request.num_samples - chunk_start), rng, request.min_years, request.max_years, self.context)
+                   for chunk_start in range(0, request.num_samples, self.chunk_size)]
+        return np.concatenate([start_indices for start_indices, end_indices in windows]), np.concatenate([end_indices for start_indices, end_indices in windows])
+
+    def simulate_batch(self, requests: List[SimulationRequest]) -> list:
+        '''Simulates the windows of every request that asked for the same leverage variants in one engine call,
+        then folds each request's rows into its own stats. A request whose windows cannot be drawn gets an
+        IncorrectRequest instead of stats, without failing the others.'''
+        request_results = []
+        request_groups: Dict[tuple, List[int]] = {}  # {leverage ratio strs: indexes of the requests that asked for them}
+        request_windows = {}
+        request_variants = {}
+        for request_index, request in enumerate(requests):
+            try:
+                request_windows[request_index] = self.draw_windows(request)
+            except main.IncorrectUsage as e:
+                request_results.append(IncorrectRequest(str(e)))
+                continue
+            request_results.append(None)
+            request_variants[request_index] = self.context.get_leverage_variants(request.leverage_ratios)
+            variants_key = tuple(leverage_variant.get_leverage_ratio_str() for leverage_variant in request_variants[request_index])
+            request_groups.setdefault(variants_key, []).append(request_index)
+
+        config = self.context.config
+        for request_indexes in request_groups.values():
+            leverage_variants = request_variants[request_indexes[0]]
+            window_results = engine.evaluate_windows(self.context.series, np.concatenate([request_windows[request_index][0] for request_index in request_indexes]),
+                                                     np.concatenate([request_windows[request_index][1] for request_index in request_indexes]), leverage_variants,
+                                                     config.starting_investment_amount, config.round_to_cents_daily, self.chunk_size,
+                                                     self.get_prefix_tables(engine.get_sleeve_leverages(leverage_variants)), self.context.index_data)
+            request_start = 0
+            for request_index in request_indexes:
+                num_samples = requests[request_index].num_samples
+                leverage_results = {}
+                for chunk_start in range(request_start, request_start + num_samples, self.chunk_size):
+                    rows = slice(chunk_start, min(chunk_start + self.chunk_size, request_start + num_samples))
+                    main.fold_window_results(leverage_results, engine.BatchResults(window_results.series, leverage_variants, window_results.start_indices[rows],
+                                                                                   window_results.end_indices[rows], window_results.end_values[rows],
+                                                                                   window_results.ruin_offsets[rows], window_results.start_investment))
+                request_results[request_index] = leverage_results
+                request_start += num_samples
+        return request_results
+
+
+class SimulationService():
+    '''Keeps the parsed files warm and simulates requests for them. Requests for the same file that arrive within
+    coalesce_seconds of each other, or while a batch of that file is being simulated, are simulated together in the
+    next batch. Batches run in a thread pool, so the event loop keeps accepting requests and files simulate at once.'''
+    def __init__(self, contexts: List[SimulationContext], coalesce_seconds: float=common.SERVICE_COALESCE_SECONDS,
+                 max_samples: int=common.SERVICE_MAX_SAMPLES, max_leverages: int=common.SERVICE_MAX_LEVERAGES, max_workers: int=None):
+        self.warm_files = {context.file_name: WarmFile(context) for context in contexts}
+        self.coalesce_seconds = coalesce_seconds
+        self.max_samples = max_samples
+        self.max_leverages = max_leverages
+        self.executor = ThreadPoolExecutor(max_workers=max_workers if max_workers is not None else max(1, len(contexts)))
+        self._pending: Dict[str, List[Tuple[SimulationRequest, asyncio.Future]]] = {file_name: [] for file_name in self.warm_files}
+        self._draining: Dict[str, asyncio.Task] = {}
+        self.num_requests = 0
+        self.num_batches = 0
+
+    @classmethod
+    def load(cls, file_names: List[str], config: common.SimulationConfig=None, **kwargs) -> "SimulationService":
+        return cls([SimulationContext.load(file_name, config) for file_name in file_names], **kwargs)
+
+    def parse_request(self, request_data: dict) -> SimulationRequest:
+        file_name = request_data.get("file_name") if isinstance(request_data, dict) else None
+        if file_name not in self.warm_files:
+            raise IncorrectRequest(f"file_name must be one of {list(self.warm_files)}, not {file_name!r}")
+        return SimulationRequest.from_json(request_data, self.warm_files[file_name].context, self.max_samples, self.max_leverages)
+
+    async def simulate(self, request: SimulationRequest) -> Dict[str, InvestmentsStats]:
+        '''The stats of every leverage ratio of request, once the batch it joins is simulated'''
+        future = asyncio.get_running_loop().create_future()
+        self._pending[request.file_name].append((request, future))
+        self.num_requests += 1
+        if request.file_name not in self._draining:
+            self._draining[request.file_name] = asyncio.ensure_future(self._drain(request.file_name))
+        return await future
+
+    async def _drain(self, file_name: str):
+        try:
+            while len(self._pending[file_name]) > 0:
+                await asyncio.sleep(self.coalesce_seconds)
+                batch = self._pending[file_name]
+                self._pending[file_name] = []
+                self.num_batches += 1
+                try:
+                    request_results = await asyncio.get_running_loop().run_in_executor(self.executor, self.warm_files[file_name].simulate_batch,
+                                                                                       [request for request, future in batch])
+                except Exception as e:
+                    for request, future in batch:
+                        if not future.done():
+                            future.set_exception(e)
+                    continue
+                for (request, future), leverage_results in zip(batch, request_results):
+                    if future.done():
+                        continue
+                    if isinstance(leverage_results, Exception):
+                        future.set_exception(leverage_results)
+                    else:
+                        future.set_result(leverage_results)
+        finally:
+            del self._draining[file_name]
+
+    async def handle_json(self, request_data: dict) -> dict:
+        request = self.parse_request(request_data)
+        leverage_results = await self.simulate(request)
+        return {"file_name": request.file_name, "num_samples": request.num_samples, "seed": request.seed, "min_years": request.min_years, "max_years": request.max_years,
+                "leverage_results": [get_stats_json(stats) for stats in leverage_results.values()]}
+
+    def get_health(self) -> dict:
+        return {"file_names": list(self.warm_files), "num_requests": self.num_requests, "num_batches": self.num_batches}
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        '''Serves one HTTP/1.1 request per connection'''
+        try:
+            status, response = await self._handle_http(reader)
+        except Exception as e:
+            status, response = 500, {"error": f"{type(e).__name__}: {e}"}
+        body = json.dumps(response).encode()
+        writer.write(f"HTTP/1.1 {status} {HTTP_STATUSES[status]}\r\nContent-Type: application/json\r\nContent-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body)
+        try:
+            await writer.drain()
+        finally:
+            writer.close()
+
+    async def _handle_http(self, reader: asyncio.StreamReader) -> Tuple[int, dict]:
+        try:
+            request_line = (await reader.readline()).decode("latin-1").split()
+            headers = {}
+            while True:
+                header_line = (await reader.readline()).decode("latin-1").strip()
+                if header_line == "":
+                    break
+                header_name, _, header_value = header_line.partition(":")
+                headers[header_name.strip().lower()] = header_value.strip()
+            content_length = int(headers.get("content-length", 0))
+        except (UnicodeDecodeError, ValueError):
+            return 400, {"error": "Malformed HTTP request"}
+        if len(request_line) < 2:
+            return 400, {"error": "Malformed HTTP request"}
+        method, path = request_line[0], request_line[1]
+        if path == "/health":
+            return (200, self.get_health()) if method == "GET" else (405, {"error": "Use GET /health"})
+        if path != "/simulate":
+            return 404, {"error": f"Unknown path {path}"}
+        if method != "POST":
+            return 405, {"error": "Use POST /simulate"}
+        if content_length > MAX_REQUEST_BYTES:
+            return 413, {"error": f"Requests are at most {MAX_REQUEST_BYTES} bytes"}
+        try:
+            request_data = json.loads(await reader.readexactly(content_length))
+            return 200, await self.handle_json(request_data)
+        except (asyncio.IncompleteReadError, json.JSONDecodeError, UnicodeDecodeError):
+            return 400, {"error": "The body must be a JSON object"}
+        except IncorrectRequest as e:
+            return 400, {"error": str(e)}
+
+    async def start_server(self, host: str=common.SERVICE_HOST, port: int=common.SERVICE_PORT, unix_socket: str=None) -> asyncio.AbstractServer:
+        if unix_socket is not None:
+            if os.path.exists(unix_socket):
+                os.remove(unix_socket)
+            return await asyncio.start_unix_server(self.handle_connection, path=unix_socket)
+        return await asyncio.start_server(self.handle_connection, host, port)
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+
+async def serve(file_names: List[str], host: str=common.SERVICE_HOST, port: int=common.SERVICE_PORT, unix_socket: str=common.SERVICE_UNIX_SOCKET):
+    service = SimulationService.load(file_names)
+    server = await service.start_server(host, port, unix_socket)
+    print(f"Serving {', '.join(file_names)} on {unix_socket if unix_socket is not None else f'{host}:{port}'}")
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        service.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(serve(common.file_names))
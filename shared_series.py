@@ -0,0 +1,78 @@
+"""
+/* Copyright (C) William Lyles - All Rights Reserved
+ * Unauthorized copying of this file, via any medium is strictly prohibited
+ * Proprietary and confidential
+ * Written by William Lyles <willglyles@gmail.com>, January 4th, 2022
+ */
+ """
+from multiprocessing import shared_memory
+import os
+from typing import List, Tuple
+import numpy as np
+
+from asset_data import PriceSeries
+
+
+class SharedSeriesHandle():
+    '''Everything a process needs to attach to a PriceSeries in shared memory. Small and cheap to pickle.'''
+    def __init__(self, shared_memory_name: str, length: int, column_layout: List[Tuple[str, str, int]]):
+        self.shared_memory_name = shared_memory_name
+        self.length = length
+        self.column_layout = column_layout  # (column name, dtype, byte offset) of every column
+
+
+class SharedPriceSeries():
+    '''Owns one shared memory block holding every column of a PriceSeries. Other processes attach to it read-only
+    with attach_price_series(handle), without parsing the CSV or copying the arrays.
+    The owner must close() the block when done, which also frees it.'''
+    def __init__(self, series: PriceSeries):
+        columns = series.get_columns()
+        column_layout = []
+        total_bytes = 0
+        for column_name, column in columns.items():
+            column_layout.append((column_name, column.dtype.str, total_bytes))
+            total_bytes += column.nbytes
+        self._shared_memory = shared_memory.SharedMemory(create=True, size=max(total_bytes, 1))
+        self.handle = SharedSeriesHandle(self._shared_memory.name, len(series), column_layout)
+        for column_name, dtype, offset in column_layout:
+            np.ndarray(len(series), dtype=dtype, buffer=self._shared_memory.buf, offset=offset)[:] = columns[column_name]
+        self.series = _wrap_shared_memory(self._shared_memory, self.handle)
+
+    def close(self):
+        self.series = None
+        self._shared_memory.close()
+        self._shared_memory.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def _wrap_shared_memory(shared_memory_block: shared_memory.SharedMemory, handle: SharedSeriesHandle) -> PriceSeries:
+    columns = {}
+    for column_name, dtype, offset in handle.column_layout:
+        column = np.ndarray(handle.length, dtype=dtype, buffer=shared_memory_block.buf, offset=offset)
+        column.flags.writeable = False
+        columns[column_name] = column
+    series = PriceSeries.from_columns(columns)
+    series._shared_memory = shared_memory_block  # The arrays are only valid while the block stays open
+    return series
+
+
+def attach_price_series(handle: SharedSeriesHandle) -> PriceSeries:
+    '''Read-only PriceSeries backed by the shared memory block of a SharedPriceSeries in another process'''
+    return _wrap_shared_memory(shared_memory.SharedMemory(name=handle.shared_memory_name), handle)
+
+
+def save_memmap_series(series: PriceSeries, directory: str):
+    '''Writes every column to its own .npy file in directory, for load_memmap_series'''
+    os.makedirs(directory, exist_ok=True)
+    for column_name, column in series.get_columns().items():
+        np.save(os.path.join(directory, f"{column_name}.npy"), column)
+
+def load_memmap_series(directory: str) -> PriceSeries:
+    '''Read-only PriceSeries memory mapped from the files written by save_memmap_series. Pages are shared
+    through the OS page cache by every process mapping the same directory.'''
+    return PriceSeries.from_columns({column_name: np.load(os.path.join(directory, f"{column_name}.npy"), mmap_mode="r") for column_name in PriceSeries.COLUMNS})
@@ -0,0 +1,42 @@
+"""
+/* Copyright (C) William Lyles - All Rights Reserved
+ * Unauthorized copying of this file, via any medium is strictly prohibited
+ * Proprietary and confidential
+ * Written by William Lyles <willglyles@gmail.com>, January 4th, 2022
+ */
+ """
+from typing import List
+
+from asset_data import PriceSeries
+import common
+from common import KnownIndexMetaData, SimulationConfig
+import engine
+from price_cache import load_price_series
+from rebalance import get_rebalance_policy
+
+
+class SimulationContext():
+    '''Everything one simulation reads: the price data of one file, the settings it is simulated with and the expenses
+    and dividends charged and paid for that file. Nothing in a context changes once it is built, so one context can
+    be shared by many simulations and simulations of different contexts can run at once, in threads or tasks.'''
+    def __init__(self, series: PriceSeries, file_name: str=None, config: SimulationConfig=None, index_data: KnownIndexMetaData=None):
+        self.series = series
+        self.file_name = file_name
+        self.config = SimulationConfig() if config is None else config
+        self.index_data = KnownIndexMetaData(file_name, self.config) if index_data is None else index_data
+
+    @classmethod
+    def load(cls, file_name: str, config: SimulationConfig=None) -> "SimulationContext":
+        '''The context of file_name, parsed (or read from the parse cache) like main.load_data does'''
+        return cls(load_price_series(file_name, should_break=common.should_break, use_cache=common.USE_PARSE_CACHE), file_name, config)
+
+    def replace(self, **settings) -> "SimulationContext":
+        '''The same price data with some settings changed (see SimulationConfig.replace)'''
+        return SimulationContext(self.series, self.file_name, self.config.replace(**settings))
+
+    def get_leverage_variants(self, leverage_ratios) -> List[engine.LeverageVariant]:
+        return engine.get_leverage_variants(leverage_ratios, self.config.use_realistic_split_leverage,
+                                            [get_rebalance_policy(self.config.split_rebalance_frequency, self.config.split_rebalance_drift_band)])
+
+    def __repr__(self):
+        return f"SimulationContext({self.file_name!r}, {len(self.series)} days, {self.config!r})"
@@ -0,0 +1,266 @@
+"""
+/* Copyright (C) William Lyles - All Rights Reserved
+ * Unauthorized copying of this file, via any medium is strictly prohibited
+ * Proprietary and confidential
+ * Written by William Lyles <willglyles@gmail.com>, January 4th, 2022
+ */
+ """
+from collections import OrderedDict
+import hashlib
+import os
+import threading
+from typing import Dict, List, Tuple
+import uuid
+import numpy as np
+
+from asset_data import PriceSeries
+import common
+import engine
+
+CACHE_VERSION = 3  # Bump whenever the simulation changes, so results cached by older versions are never used
+BLOCK_FILE_SUFFIX = ".npz"
+# Bloom filter bits per window key of a spilled block, and hashes per key. A lookup has thousands of keys, so false
+# positives must be rare (about 1 in 100,000 keys here) for most blocks without them to be skipped.
+FILTER_BITS_PER_KEY = 32
+FILTER_NUM_HASHES = 7
+
+
+def get_series_hash(series: PriceSeries) -> str:
+    '''Hash of the dates and daily changes of series, kept on the series since they never change'''
+    if getattr(series, "_content_hash", None) is None:
+        content_hasher = hashlib.sha256(np.ascontiguousarray(series.dates).tobytes())
+        content_hasher.update(np.ascontiguousarray(series.ratio_change).tobytes())
+        series._content_hash = content_hasher.hexdigest()
+    return series._content_hash
+
+def get_namespace(series: PriceSeries, start_investment: float, round_to_cents: bool, index_data: common.KnownIndexMetaData=None) -> str:
+    '''Content address of everything but the window and leverage variant a result depends on: the price data and
+    the expense/dividend settings and data of the file they are charged for (index_data, by default common.dividend_cost_data)'''
+    index_data = common.dividend_cost_data if index_data is None else index_data
+    settings = (CACHE_VERSION, get_series_hash(series), start_investment, round_to_cents) + index_data.get_settings_key()
+    return hashlib.sha256(repr(settings).encode()).hexdigest()
+
+def get_variant_key(leverage_variant: engine.LeverageVariant) -> str:
+    return hashlib.sha256(repr((leverage_variant.leverage_ratio, leverage_variant.real_large_leverage, leverage_variant.real_small_leverage,
+                                 leverage_variant.rebalance_policy)).encode()).hexdigest()[:32]
+
+def get_window_keys(start_indices: np.ndarray, end_indices: np.ndarray) -> np.ndarray:
+    return (np.asarray(start_indices, dtype=np.int64) << 32) | np.asarray(end_indices, dtype=np.int64)
+
+
+class _Block():
+    '''Results of one leverage variant over a set of windows, sorted by window key for lookups with searchsorted'''
+    def __init__(self, window_keys: np.ndarray, end_values: np.ndarray, ruin_offsets: np.ndarray, file_name: str=None):
+        order = np.argsort(window_keys, kind="stable")
+        self.window_keys = window_keys[order]
+        self.end_values = end_values[order]
+        self.ruin_offsets = ruin_offsets[order]
+        self.file_name = file_name  # Where the block is spilled to, None until it is
+
+    def __len__(self):
+        return len(self.window_keys)
+
+    def lookup(self, window_keys: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        '''(index into the block of every window key, whether it was found)'''
+        positions = np.minimum(np.searchsorted(self.window_keys, window_keys), len(self.window_keys) - 1)
+        return positions, self.window_keys[positions] == window_keys
+
+
+class _KeyFilter():
+    '''The smallest and largest window key of a spilled block and a bloom filter of all of them, kept in memory so
+    lookups only load the spilled blocks that may hold some of their keys'''
+    def __init__(self, window_keys: np.ndarray):
+        self.min_key = window_keys.min()
+        self.max_key = window_keys.max()
+        self.num_bits = FILTER_BITS_PER_KEY * len(window_keys)
+        bits = np.zeros(self.num_bits, dtype=bool)
+        bits[self._get_bit_positions(window_keys).ravel()] = True
+        self.bits = np.packbits(bits)
+
+    def _get_bit_positions(self, window_keys: np.ndarray) -> np.ndarray:
+        # Double hashing: the i-th position of a key is hash1 + i * hash2, both multiplicative hashes of the key
+        window_keys = window_keys.astype(np.uint64)
+        first_hashes = (window_keys * np.uint64(0x9E3779B97F4A7C15)) >> np.uint64(16)
+        second_hashes = ((window_keys * np.uint64(0xC2B2AE3D27D4EB4F)) >> np.uint64(16)) | np.uint64(1)
+        hashes = first_hashes[:, np.newaxis] + np.arange(FILTER_NUM_HASHES, dtype=np.uint64) * second_hashes[:, np.newaxis]
+        return (hashes % np.uint64(self.num_bits)).astype(np.int64)
+
+    def may_contain(self, window_keys: np.ndarray) -> np.ndarray:
+        '''Whether each window key may be in the block. Keys that are in it always are, a few others may be too.'''
+        bit_positions = self._get_bit_positions(window_keys)
+        is_set = (self.bits[bit_positions >> 3] >> (7 - (bit_positions & 7)).astype(np.uint8)) & 1
+        return (window_keys >= self.min_key) & (window_keys <= self.max_key) & is_set.all(axis=1).astype(bool)
+
+
+class WindowResultCache():
+    '''Content-addressed cache of the end value and ruin offset of (window, leverage variant) results, shared by runs
+    of the same price data and expense/dividend settings (see get_namespace), whatever else they change.
+    Results are kept in blocks, one per leverage variant per batch of windows. At most max_cells results stay in memory:
+    the least recently used blocks are evicted first, and written to spill_directory (if given) unless they already are.
+    Blocks in spill_directory are searched by lookups that miss in memory, including those of later runs. A small filter
+    of the window keys of every spilled block is kept in memory, so only blocks that may hold a missed window are loaded.
+    One cache can be shared by simulations running in threads: lookups, adds and flushes are made one at a time.'''
+    def __init__(self, max_cells: int=common.WINDOW_CACHE_MAX_CELLS, spill_directory: str=None):
+        self.max_cells = max_cells
+        self.spill_directory = spill_directory
+        self._blocks: OrderedDict = OrderedDict()  # {(namespace, variant key, block id): _Block}, least recently used first
+        self._block_ids: Dict[tuple, List[str]] = {}  # {(namespace, variant key): ids of its blocks in memory}
+        self._spilled_block_ids: Dict[tuple, List[str]] = {}  # {(namespace, variant key): ids of its blocks on disk but not in memory}
+        self._spilled_block_filters: Dict[tuple, _KeyFilter] = {}  # {(namespace, variant key, block id): filter of a spilled block, once known}
+        self._num_cells = 0
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def _get_spill_directory(self, namespace: str, variant_key: str) -> str:
+        return os.path.join(self.spill_directory, namespace, variant_key)
+
+    def _get_block_ids(self, namespace: str, variant_key: str) -> List[str]:
+        key = (namespace, variant_key)
+        if key not in self._block_ids:
+            self._block_ids[key] = []
+            spill_directory = self._get_spill_directory(namespace, variant_key) if self.spill_directory is not None else None
+            self._spilled_block_ids[key] = ([file_name[:-len(BLOCK_FILE_SUFFIX)] for file_name in sorted(os.listdir(spill_directory))
+                                             if file_name.endswith(BLOCK_FILE_SUFFIX) and not file_name.endswith(".tmp" + BLOCK_FILE_SUFFIX)]
+                                            if spill_directory is not None and os.path.isdir(spill_directory) else [])
+        return self._block_ids[key]
+
+    def _load_block(self, namespace: str, variant_key: str, block_id: str) -> _Block:
+        file_name = os.path.join(self._get_spill_directory(namespace, variant_key), block_id + BLOCK_FILE_SUFFIX)
+        try:
+            with np.load(file_name) as block_data:
+                return _Block(block_data["window_keys"], block_data["end_values"], block_data["ruin_offsets"], file_name)
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def _add_block(self, namespace: str, variant_key: str, block_id: str, block: _Block):
+        self._blocks[(namespace, variant_key, block_id)] = block
+        self._block_ids[(namespace, variant_key)].append(block_id)
+        self._num_cells += len(block)
+        while self._num_cells > self.max_cells and len(self._blocks) > 1:
+            self._evict()
+
+    def _evict(self):
+        (namespace, variant_key, block_id), block = self._blocks.popitem(last=False)
+        self._block_ids[(namespace, variant_key)].remove(block_id)
+        self._num_cells -= len(block)
+        if self.spill_directory is None:
+            return
+        if block.file_name is None:
+            self._spill(namespace, variant_key, block_id, block)
+        self._spilled_block_ids[(namespace, variant_key)].append(block_id)
+        self._spilled_block_filters[(namespace, variant_key, block_id)] = _KeyFilter(block.window_keys)
+
+    def _spill(self, namespace: str, variant_key: str, block_id: str, block: _Block):
+        spill_directory = self._get_spill_directory(namespace, variant_key)
+        os.makedirs(spill_directory, exist_ok=True)
+        block.file_name = os.path.join(spill_directory, block_id + BLOCK_FILE_SUFFIX)
+        # Written under a temporary name first, so other processes never load a partial block
+        temporary_file_name = block.file_name + ".tmp" + BLOCK_FILE_SUFFIX
+        np.savez(temporary_file_name, window_keys=block.window_keys, end_values=block.end_values, ruin_offsets=block.ruin_offsets)
+        os.replace(temporary_file_name, block.file_name)
+
+    def lookup(self, namespace: str, variant_key: str, window_keys: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        '''(whether each window was found, end values, ruin offsets) of one leverage variant over the given windows.
+        Blocks in memory are searched first, then the spilled ones that may hold a missing window (see _KeyFilter), which
+        are loaded back into memory when they have a hit. Spilled blocks of earlier runs are loaded once to build their filter.'''
+        with self._lock:
+            return self._lookup(namespace, variant_key, window_keys)
+
+    def _lookup(self, namespace: str, variant_key: str, window_keys: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        found = np.zeros(len(window_keys), dtype=bool)
+        end_values = np.zeros(len(window_keys))
+        ruin_offsets = np.full(len(window_keys), -1, dtype=np.int64)
+
+        def find_in_block(block: _Block) -> bool:
+            missing = np.flatnonzero(~found)
+            positions, block_found = block.lookup(window_keys[missing])
+            found_indexes = missing[block_found]
+            found[found_indexes] = True
+            end_values[found_indexes] = block.end_values[positions[block_found]]
+            ruin_offsets[found_indexes] = block.ruin_offsets[positions[block_found]]
+            return len(found_indexes) > 0
+
+        for block_id in list(self._get_block_ids(namespace, variant_key)):
+            if found.all():
+                break
+            if find_in_block(self._blocks[(namespace, variant_key, block_id)]):
+                self._blocks.move_to_end((namespace, variant_key, block_id))
+        spilled_block_ids = self._spilled_block_ids[(namespace, variant_key)]
+        for block_id in list(spilled_block_ids):
+            if found.all():
+                break
+            block_filter = self._spilled_block_filters.get((namespace, variant_key, block_id))
+            if block_filter is not None and not block_filter.may_contain(window_keys[~found]).any():
+                continue
+            block = self._load_block(namespace, variant_key, block_id)
+            if block is None:
+                spilled_block_ids.remove(block_id)
+                self._spilled_block_filters.pop((namespace, variant_key, block_id), None)
+            elif find_in_block(block):
+                spilled_block_ids.remove(block_id)
+                self._spilled_block_filters.pop((namespace, variant_key, block_id), None)
+                self._add_block(namespace, variant_key, block_id, block)
+            elif block_filter is None:
+                self._spilled_block_filters[(namespace, variant_key, block_id)] = _KeyFilter(block.window_keys)
+        self.hits += int(found.sum())
+        self.misses += int(len(found) - found.sum())
+        return found, end_values, ruin_offsets
+
+    def add(self, namespace: str, variant_key: str, window_keys: np.ndarray, end_values: np.ndarray, ruin_offsets: np.ndarray):
+        if len(window_keys) == 0:
+            return
+        block = _Block(np.asarray(window_keys, dtype=np.int64), np.asarray(end_values, dtype=np.float64), np.asarray(ruin_offsets, dtype=np.int64))
+        with self._lock:
+            self._get_block_ids(namespace, variant_key)
+            self._add_block(namespace, variant_key, uuid.uuid4().hex, block)
+
+    def flush(self):
+        '''Writes every block still only in memory to spill_directory, so later runs can use them'''
+        if self.spill_directory is None:
+            return
+        with self._lock:
+            for (namespace, variant_key, block_id), block in self._blocks.items():
+                if block.file_name is None:
+                    self._spill(namespace, variant_key, block_id, block)
+
+    def __len__(self):
+        return self._num_cells
+
+
+def evaluate_windows_cached(cache: WindowResultCache, series: PriceSeries, start_indices, end_indices, leverage_variants: List[engine.LeverageVariant],
+                            start_investment: float=None, round_to_cents: bool=None,
+                            chunk_size: int=engine.DEFAULT_CHUNK_SIZE, prefix_tables: engine.PrefixTables=None, index_data: common.KnownIndexMetaData=None) -> engine.BatchResults:
+    '''Same as engine.evaluate_windows, but (window, leverage variant) results found in cache are reused. Only the
+    windows missing some variant are simulated, and only for the variants they miss. New results are added to cache.'''
+    config = common.SimulationConfig()
+    start_investment = config.starting_investment_amount if start_investment is None else start_investment
+    round_to_cents = config.round_to_cents_daily if round_to_cents is None else round_to_cents
+    start_indices = np.asarray(start_indices, dtype=np.int64)
+    end_indices = np.asarray(end_indices, dtype=np.int64)
+    namespace = get_namespace(series, start_investment, round_to_cents, index_data)
+    window_keys = get_window_keys(start_indices, end_indices)
+    variant_keys = [get_variant_key(leverage_variant) for leverage_variant in leverage_variants]
+    end_values = np.zeros((len(start_indices), len(leverage_variants)))
+    ruin_offsets = np.full((len(start_indices), len(leverage_variants)), -1, dtype=np.int64)
+    found = np.zeros((len(start_indices), len(leverage_variants)), dtype=bool)
+    for variant_index, variant_key in enumerate(variant_keys):
+        found[:, variant_index], end_values[:, variant_index], ruin_offsets[:, variant_index] = cache.lookup(namespace, variant_key, window_keys)
+
+    # A window drawn more than once is simulated once
+    missing_window_keys, missing_window_indexes = np.unique(window_keys[~found.all(axis=1)], return_index=True)
+    missing_windows = np.flatnonzero(~found.all(axis=1))[missing_window_indexes]
+    missing_variants = np.flatnonzero(~found[missing_windows].all(axis=0))
+    if len(missing_windows) > 0:
+        window_results = engine.evaluate_windows(series, start_indices[missing_windows], end_indices[missing_windows], [leverage_variants[variant_index] for variant_index in missing_variants.tolist()],
+                                                 start_investment, round_to_cents, chunk_size, prefix_tables, index_data)
+        for result_index, variant_index in enumerate(missing_variants.tolist()):
+            computed = ~found[missing_windows, variant_index]
+            cache.add(namespace, variant_keys[variant_index], missing_window_keys[computed], window_results.end_values[computed, result_index], window_results.ruin_offsets[computed, result_index])
+        # Every draw of a window gets its results
+        missing_positions = np.searchsorted(missing_window_keys, window_keys)
+        for result_index, variant_index in enumerate(missing_variants.tolist()):
+            is_missing = ~found[:, variant_index]
+            end_values[is_missing, variant_index] = window_results.end_values[missing_positions[is_missing], result_index]
+            ruin_offsets[is_missing, variant_index] = window_results.ruin_offsets[missing_positions[is_missing], result_index]
+    return engine.BatchResults(series, leverage_variants, start_indices, end_indices, end_values, ruin_offsets, start_investment)